@@ -14,18 +14,32 @@ import numpy as np
 import multiprocessing as mp
 
 import timeit
+import time
 import queue
 
 import os
 import platform
-from shutil import which
+from shutil import which, rmtree, copy2
 import configparser
 import subprocess
 import threading
+import concurrent.futures
 import collections
+import itertools
 import copy
 import math
 import json
+import sqlite3
+import struct
+import re
+import hashlib
+import argparse
+import sys
+
+try:
+  import resource
+except ImportError:  # not available on Windows
+  resource = None
 
 
 
@@ -36,8 +50,17 @@ class App(TkinterDnD.Tk):
 
     # instance variables
     self.after_handle = None
-
-    self.input_images = [] # list of filenames
+    self.autosave_error = None   # last autosave failure reported in the log
+
+    self.input_images = ImageRegistry()   # the input images in order, indexed by filepath
+    self.image_loading = {      # images being listed/probed in the background by add_images()
+      'queue'   : queue.Queue(),
+      'rows'    : collections.deque(),   # (filepath, probe, added by the user) from the queue, not inserted yet
+      'loaders' : 0,
+      'rejected': [],
+      'handle'  : None,
+      'generation': 0     # bumped by load_project(), the loads started before are ignored
+    }
     self.widgets = {}      # list of widgets
     self.config  = {}      # configurations
     self.flags   = {       # various flags used internally
@@ -49,24 +72,16 @@ class App(TkinterDnD.Tk):
     self.mask_clipboard = []  # clipboard for copying/pasting masks
 
     self.output_image = None
+    self.output_preview = None   # the reduced images of the output (and first input) to show
     self.save_file    = None
-
-
-    self.preview_cache = {
-      'slots' : [None] * 5,
-      'head'   : 0,
-      'width'  : -1,
-      'height' : -1
+    self.unsaved = {            # what changed since the project file was written, for autosave
+      'images': False,
+      'masks' : set()           # image_ids whose masks changed
     }
 
-    self.mask_preview_cache = {
-      'slots' : [None] * 5,
-      'head'   : 0,
-    }
 
-    self.thread = None
-    self.subprocess = None
-    self.opencv_aligner = None
+    self.engine = JobEngine()   # runs the stacking jobs
+    self.watcher = None         # FolderWatcher while watching a folder
 
     self.load_config()
 
@@ -83,6 +98,8 @@ class App(TkinterDnD.Tk):
     self.rowconfigure(0, weight=1)
 
     self.protocol("WM_DELETE_WINDOW", self.on_closing)
+    self.autosave_handle = self.after(AUTOSAVE_INTERVAL, self.autosave)
+    self.prune_tiles_handle = self.after(TILE_PRUNE_INTERVAL, self.prune_tiles)
 
     # set up font and style
     style = ttk.Style()
@@ -118,16 +135,19 @@ class App(TkinterDnD.Tk):
     tab_images = ttk.Frame(nb)
     tab_masks  = ttk.Frame(nb)
     tab_stack  = ttk.Frame(nb)
+    tab_queue  = ttk.Frame(nb)
     tab_prefs  = ttk.Frame(nb)
 
     tab_images.grid(column=0, row=0, sticky=(tk.NS, tk.EW))
     tab_masks.grid(column=0, row=0, sticky=(tk.NS, tk.EW))
     tab_stack.grid(column=0, row=0, sticky=(tk.NS, tk.EW))
+    tab_queue.grid(column=0, row=0, sticky=(tk.NS, tk.EW))
     tab_prefs.grid(column=0, row=0, sticky=(tk.NS, tk.EW))
 
     nb.add(tab_images, text='Images')
     nb.add(tab_masks, text='Masks')
     nb.add(tab_stack, text='Stack')
+    nb.add(tab_queue, text='Queue')
     nb.add(tab_prefs, text='Preferences')
 
 
@@ -158,7 +178,17 @@ class App(TkinterDnD.Tk):
     fr_images.rowconfigure(0, weight=1)
 
     # image list
-    w['tr_images'] = ttk.Treeview(fr_images, selectmode=tk.EXTENDED)
+    w['tr_images'] = ttk.Treeview(fr_images, selectmode=tk.EXTENDED,
+                                  columns=('size', 'mode', 'depth', 'orientation'))
+    w['tr_images'].column('size', width=100, anchor=tk.CENTER)
+    w['tr_images'].heading('size', text='Size')
+    w['tr_images'].column('mode', width=60, anchor=tk.CENTER)
+    w['tr_images'].heading('mode', text='Mode')
+    w['tr_images'].column('depth', width=90, anchor=tk.CENTER)
+    w['tr_images'].heading('depth', text='Depth')
+    w['tr_images'].column('orientation', width=110, anchor=tk.CENTER)
+    w['tr_images'].heading('orientation', text='Orientation')
+
     w['tr_images'].grid(column=0, row=0, sticky=(tk.NS, tk.EW))
     w['tr_images'].bind('<<TreeviewSelect>>', self.ui_tr_images_selected)
     self.drop_target_register(DND_FILES)
@@ -173,6 +203,8 @@ class App(TkinterDnD.Tk):
     w['cv_image_preview'] = tk.Canvas(pn_tabimages, background='#eeeeee')
     w['cv_image_preview'].grid(column=1, row=0, sticky=(tk.NS, tk.EW))
     w['cv_image_preview'].bind('<Configure>', lambda x: self.update_input_image_preview())
+    w['cv_image_preview'].view = TileView(w['cv_image_preview'])
+    self.bind_zoom(w['cv_image_preview'], self.update_input_image_preview)
     pn_tabimages.add(w['cv_image_preview'], weight=3)
 
     fr_image_actions = ttk.Frame(tab_images)
@@ -285,10 +317,21 @@ class App(TkinterDnD.Tk):
     # canvas to draw masks
     w['cv_image_masks'] = tk.Canvas(pn_tabmasks, background='#eeeeee')
     w['cv_image_masks'].grid(column=1, row=0, sticky=(tk.NS, tk.EW))
-    w['cv_image_masks'].old_width  = w['cv_image_masks'].winfo_width()
-    w['cv_image_masks'].old_height = w['cv_image_masks'].winfo_height()
+
+    # retained canvas items, updated in place by update_mask_canvas()
+    w['cv_image_masks'].view = TileView(w['cv_image_masks'])   # the image tiles
+    w['cv_image_masks'].mask_items = []     # one polygon per mask of the current image
+    w['cv_image_masks'].mask_state = []     # what each polygon was last drawn with
+    w['cv_image_masks'].masks = {}          # polygon ==> mask_id
+    w['cv_image_masks'].editable_mask = None
+    w['cv_image_masks'].new_mask = None
 
     w['cv_image_masks'].bind('<Configure>', lambda x: self.update_mask_canvas())
+    self.bind_zoom(w['cv_image_masks'], self.update_mask_canvas)
+    for tag, on_move in (('editable', self.mask_canvas_on_move_polygon), ('handle', self.mask_canvas_on_move_handle)):
+      w['cv_image_masks'].tag_bind(tag, '<ButtonPress-1>', self.mask_canvas_on_press_tag)
+      w['cv_image_masks'].tag_bind(tag, '<ButtonRelease-1>', self.mask_canvas_on_release_tag)
+      w['cv_image_masks'].tag_bind(tag, '<B1-Motion>', on_move)
     w['cv_image_masks'].bind('<Motion>', self.ui_cv_image_masks_motion)
     w['cv_image_masks'].bind('<Button-1>', self.ui_cv_image_masks_b1)
     w['cv_image_masks'].bind('<Double-Button-1>', self.end_new_mask)
@@ -339,6 +382,13 @@ class App(TkinterDnD.Tk):
     w['cb_stack_aligner'].bind('<<ComboboxSelected>>', lambda x: self.ui_cb_stack_aligner_changed())
     w['cb_stack_aligner'].var = v_cb_stack_aligner
 
+    v_ck_prepass = tk.BooleanVar()
+    w['ck_prepass'] = ttk.Checkbutton(fr_stack_align, text='Focus pre-pass: order frames, use the sharpest as anchor, '
+                                      'drop duplicate and out-of-focus frames', onvalue=True, offvalue=False,
+                                      variable=v_ck_prepass)
+    w['ck_prepass'].grid(column=0, columnspan=3, row=1, sticky=(tk.W, tk.N), padx=20, pady=(0, 20))
+    w['ck_prepass'].var = v_ck_prepass
+
 
     # padding between frames
     ttk.Frame(fr_stack_left_pane.view_port).grid(column=0, row=1, sticky=(tk.N, tk.EW), pady=7)
@@ -439,15 +489,82 @@ class App(TkinterDnD.Tk):
     w['sp_ecc_ter_eps'].grid(column=1, row=1, sticky=(tk.W), padx=20, pady=10)
     w['sp_ecc_ter_eps'].var = v_sp_ecc_ter_eps
 
+    # motion model, auto starts affine and moves to a homography where it fits clearly better
+    ttk.Label(fr_stack_ecc, text='Motion model: ').grid(column=0, row=2, sticky=(tk.E), padx=20, pady=10)
+
+    v_cb_ecc_motion = tk.StringVar()
+    w['cb_ecc_motion'] = ttk.Combobox(fr_stack_ecc, justify=tk.CENTER, values=tuple(MOTION_MODELS),
+                                      state='readonly', width=10, textvariable=v_cb_ecc_motion)
+    w['cb_ecc_motion'].grid(column=1, row=2, sticky=(tk.W), padx=20, pady=10)
+    w['cb_ecc_motion'].bind('<<ComboboxSelected>>', lambda x : w['cb_ecc_motion'].selection_clear())
+    w['cb_ecc_motion'].var = v_cb_ecc_motion
+
     # number of processes in the Pool
     ttk.Label(fr_stack_ecc, text='Multiprocessing pool: ').grid(column=0, row=3, sticky=(tk.E), padx=20, pady=10)
 
     v_sp_ecc_pool = tk.IntVar()
     w['sp_ecc_pool'] = ttk.Spinbox(fr_stack_ecc, from_=1, to=mp.cpu_count()-1, increment=1,
                                    justify=tk.CENTER, width=10, textvariable=v_sp_ecc_pool)
-    w['sp_ecc_pool'].grid(column=1, row=3, sticky=(tk.W), padx=20, pady=(10, 20))
+    w['sp_ecc_pool'].grid(column=1, row=3, sticky=(tk.W), padx=20, pady=10)
     w['sp_ecc_pool'].var = v_sp_ecc_pool
 
+    # memory budget for the Pool, limits the number of concurrent processes on large images
+    ttk.Label(fr_stack_ecc, text='Memory budget (GB): ').grid(column=0, row=4, sticky=(tk.E), padx=20, pady=10)
+
+    v_sp_ecc_mem_budget = tk.IntVar()
+    w['sp_ecc_mem_budget'] = ttk.Spinbox(fr_stack_ecc, from_=1, to=max(1, math.ceil(total_memory()/2**30)),
+                                         increment=1, justify=tk.CENTER, width=10, textvariable=v_sp_ecc_mem_budget)
+    w['sp_ecc_mem_budget'].grid(column=1, row=4, sticky=(tk.W), padx=20, pady=10)
+    w['sp_ecc_mem_budget'].var = v_sp_ecc_mem_budget
+
+    # interpolation used to warp the aligned images
+    ttk.Label(fr_stack_ecc, text='Warp interpolation: ').grid(column=0, row=5, sticky=(tk.E), padx=20, pady=10)
+
+    v_cb_ecc_interpolation = tk.StringVar()
+    w['cb_ecc_interpolation'] = ttk.Combobox(fr_stack_ecc, justify=tk.CENTER, values=tuple(INTERPOLATIONS),
+                                             state='readonly', width=10, textvariable=v_cb_ecc_interpolation)
+    w['cb_ecc_interpolation'].grid(column=1, row=5, sticky=(tk.W), padx=20, pady=10)
+    w['cb_ecc_interpolation'].bind('<<ComboboxSelected>>', lambda x : w['cb_ecc_interpolation'].selection_clear())
+    w['cb_ecc_interpolation'].var = v_cb_ecc_interpolation
+
+    # reuse the warp maps of a rig's repeated positions
+    v_ck_ecc_remap_cache = tk.BooleanVar()
+    w['ck_ecc_remap_cache'] = ttk.Checkbutton(fr_stack_ecc, text='Cache warp maps for repeated geometries',
+                                              onvalue=True, offvalue=False, variable=v_ck_ecc_remap_cache)
+    w['ck_ecc_remap_cache'].grid(column=0, columnspan=2, row=8, sticky=(tk.W), padx=20, pady=10)
+    w['ck_ecc_remap_cache'].var = v_ck_ecc_remap_cache
+
+    # rig profile: warps solved by previous stacks of the same rig, as the initial guess
+    ttk.Label(fr_stack_ecc, text='Rig profile: ').grid(column=0, row=6, sticky=(tk.E), padx=20, pady=10)
+
+    v_cb_ecc_rig = tk.StringVar()
+    w['cb_ecc_rig'] = ttk.Combobox(fr_stack_ecc, justify=tk.CENTER, width=16, textvariable=v_cb_ecc_rig,
+                                   postcommand=lambda: w['cb_ecc_rig'].configure(values=tuple(load_rig_profiles())))
+    w['cb_ecc_rig'].grid(column=1, row=6, sticky=(tk.W), padx=20, pady=10)
+    w['cb_ecc_rig'].var = v_cb_ecc_rig
+
+    v_ck_ecc_rig_update = tk.BooleanVar()
+    w['ck_ecc_rig_update'] = ttk.Checkbutton(fr_stack_ecc, text='Save the solved warps to the rig profile',
+                                             onvalue=True, offvalue=False, variable=v_ck_ecc_rig_update)
+    w['ck_ecc_rig_update'].grid(column=0, columnspan=2, row=7, sticky=(tk.W), padx=20, pady=(0, 10))
+    w['ck_ecc_rig_update'].var = v_ck_ecc_rig_update
+
+    # crop the aligned images to the area where all of them have pixels, as align_image_stack -C
+    v_ck_ecc_autocrop = tk.BooleanVar()
+    w['ck_ecc_autocrop'] = ttk.Checkbutton(fr_stack_ecc, text='Crop to the area common to all frames (reads each frame twice)',
+                                           onvalue=True, offvalue=False, variable=v_ck_ecc_autocrop)
+    w['ck_ecc_autocrop'].grid(column=0, columnspan=2, row=9, sticky=(tk.W), padx=20, pady=(0, 10))
+    w['ck_ecc_autocrop'].var = v_ck_ecc_autocrop
+
+    # time allowed to each attempt at aligning a frame, before it's retried (0: no limit)
+    ttk.Label(fr_stack_ecc, text='Frame timeout (s): ').grid(column=0, row=10, sticky=(tk.E), padx=20, pady=(10, 20))
+
+    v_sp_ecc_timeout = tk.IntVar()
+    w['sp_ecc_timeout'] = ttk.Spinbox(fr_stack_ecc, from_=0, to=3600, increment=30,
+                                      justify=tk.CENTER, width=10, textvariable=v_sp_ecc_timeout)
+    w['sp_ecc_timeout'].grid(column=1, row=10, sticky=(tk.W), padx=20, pady=(10, 20))
+    w['sp_ecc_timeout'].var = v_sp_ecc_timeout
+
 
 
     # padding between frames
@@ -559,6 +676,17 @@ class App(TkinterDnD.Tk):
     w['cb_gray_proj'].bind('<<ComboboxSelected>>', lambda x : w['cb_gray_proj'].selection_clear())
     w['cb_gray_proj'].var = v_cb_gray_proj
 
+    # parameter sweep: one output per combination of the values, fused from the same aligned images
+    ttk.Label(fr_stack_fusion, text='Sweep: ').grid(column=0, row=6, sticky=(tk.E), padx=10, pady=7)
+
+    v_en_sweep = tk.StringVar()
+    w['en_sweep'] = ttk.Entry(fr_stack_fusion, textvariable=v_en_sweep, width=30)
+    w['en_sweep'].grid(column=1, columnspan=3, row=6, sticky=(tk.W), padx=20, pady=(7, 0))
+    w['en_sweep'].var = v_en_sweep
+
+    ttk.Label(fr_stack_fusion, text='e.g. window=5,9; projector=l-star,luminance (' + ', '.join(SWEEP_SETTINGS) + ')') \
+       .grid(column=1, columnspan=3, row=7, sticky=(tk.W), padx=20, pady=(0, 7))
+
 
     # padding between frames
     ttk.Frame(fr_stack_left_pane.view_port).grid(column=0, row=5, sticky=(tk.N, tk.EW), pady=7)
@@ -681,10 +809,23 @@ class App(TkinterDnD.Tk):
 
     ttk.Button(fr_stack_actions, text='Toggle log', command=self.toggle_log).grid(column=2, row=0, sticky=(tk.E))
 
+    w['lb_stack_status'] = ttk.Label(fr_stack_actions, text='')
+    w['lb_stack_status'].grid(column=0, columnspan=3, row=1, sticky=(tk.W), pady=(10, 0))
+
+    v_ck_preview_compare = tk.BooleanVar()
+    w['ck_preview_compare'] = ttk.Checkbutton(fr_stack_actions, text='Compare with the first input (left of the pointer)',
+                                               onvalue=True, offvalue=False, variable=v_ck_preview_compare,
+                                               command=self.update_compare_split)
+    w['ck_preview_compare'].grid(column=0, columnspan=3, row=2, sticky=(tk.W), pady=(10, 0))
+    w['ck_preview_compare'].var = v_ck_preview_compare
+
     # stacked preview pane
     w['cv_stacked_preview'] = tk.Canvas(tab_stack, background='#eeeeee')
     w['cv_stacked_preview'].grid(column=2, row=0, sticky=(tk.NS, tk.EW), padx=(4,0))
     w['cv_stacked_preview'].bind("<Configure>", lambda x: self.update_output_image_preview())
+    w['cv_stacked_preview'].bind("<Motion>", lambda event: self.update_compare_split(event.x))
+    w['cv_stacked_preview'].photos = None   # PhotoImages for the current canvas size
+    w['cv_stacked_preview'].split = 0.5     # compare split, as a fraction of the preview width
     w['cv_stacked_preview'].grid_remove()
 
 
@@ -699,6 +840,116 @@ class App(TkinterDnD.Tk):
     w['tx_log'].scroll = s
 
 
+    # ==== set up Queue tab ====
+    tab_queue.columnconfigure(0, weight=1)
+    tab_queue.rowconfigure(0, weight=1)
+
+    pn_tabqueue = ttk.PanedWindow(tab_queue, orient=tk.VERTICAL)
+    pn_tabqueue.grid(column=0, row=0, sticky=(tk.NS, tk.EW))
+
+    fr_queue = ttk.Frame(pn_tabqueue)
+    fr_queue.columnconfigure(0, weight=1)
+    fr_queue.rowconfigure(0, weight=1)
+    pn_tabqueue.add(fr_queue, weight=1)
+
+    # job list
+    w['tr_queue'] = ttk.Treeview(fr_queue, selectmode=tk.EXTENDED, columns=('state', 'output'))
+    w['tr_queue'].heading('#0', text='Job', anchor=tk.W)
+    w['tr_queue'].heading('state', text='State', anchor=tk.W)
+    w['tr_queue'].heading('output', text='Output', anchor=tk.W)
+    w['tr_queue'].column('state', width=200, stretch=False)
+    w['tr_queue'].grid(column=0, row=0, sticky=(tk.NS, tk.EW))
+    w['tr_queue'].bind('<<TreeviewSelect>>', self.ui_tr_queue_selected)
+
+    s = ttk.Scrollbar(fr_queue, orient=tk.VERTICAL, command=w['tr_queue'].yview)
+    s.grid(column=1, row=0, sticky=(tk.NS))
+    w['tr_queue']['yscrollcommand'] = s.set
+
+    # log of the selected job
+    fr_queue_log = ttk.Frame(pn_tabqueue)
+    fr_queue_log.columnconfigure(0, weight=1)
+    fr_queue_log.rowconfigure(0, weight=1)
+    pn_tabqueue.add(fr_queue_log, weight=1)
+
+    w['tx_queue_log'] = tk.Text(fr_queue_log, borderwidth=5, relief=tk.FLAT)
+    w['tx_queue_log'].grid(column=0, row=0, sticky=(tk.NS, tk.EW))
+
+    s = ttk.Scrollbar(fr_queue_log, orient=tk.VERTICAL, command=w['tx_queue_log'].yview)
+    s.grid(column=1, row=0, sticky=(tk.NS))
+    w['tx_queue_log']['yscrollcommand'] = s.set
+
+    # queue actions
+    fr_queue_actions = ttk.Frame(tab_queue, padding=(15, 10))
+    fr_queue_actions.grid(column=0, row=1, sticky=(tk.EW))
+    fr_queue_actions.columnconfigure(4, weight=1)
+
+    ttk.Button(fr_queue_actions, text='Add projects', command=self.ui_bt_queue_add_projects) \
+       .grid(column=0, row=0, padx=(0, 10))
+    ttk.Button(fr_queue_actions, text='Add folder', command=self.ui_bt_queue_add_folder) \
+       .grid(column=1, row=0, padx=(0, 10))
+
+    w['bt_queue_cancel'] = ttk.Button(fr_queue_actions, text='Cancel', command=self.cancel_queue_jobs)
+    w['bt_queue_cancel'].grid(column=2, row=0, padx=(0, 10))
+
+    ttk.Button(fr_queue_actions, text='Clear finished', command=self.clear_finished_jobs) \
+       .grid(column=3, row=0, padx=(0, 10))
+
+    # concurrency limits
+    ttk.Label(fr_queue_actions, text='Concurrent stacks: ').grid(column=5, row=0, sticky=(tk.E), padx=5)
+
+    v_sp_queue_jobs = tk.IntVar()
+    w['sp_queue_jobs'] = ttk.Spinbox(fr_queue_actions, justify=tk.CENTER, from_=1, to=32,
+                                     increment=1, width=5, textvariable=v_sp_queue_jobs,
+                                     command=self.ui_sp_queue_changed)
+    w['sp_queue_jobs'].grid(column=6, row=0, sticky=(tk.W), padx=(5, 20))
+    w['sp_queue_jobs'].var = v_sp_queue_jobs
+
+    ttk.Label(fr_queue_actions, text='Concurrent enfuse: ').grid(column=7, row=0, sticky=(tk.E), padx=5)
+
+    v_sp_queue_enfuse = tk.IntVar()
+    w['sp_queue_enfuse'] = ttk.Spinbox(fr_queue_actions, justify=tk.CENTER, from_=1, to=32,
+                                       increment=1, width=5, textvariable=v_sp_queue_enfuse,
+                                       command=self.ui_sp_queue_changed)
+    w['sp_queue_enfuse'].grid(column=8, row=0, sticky=(tk.W), padx=5)
+    w['sp_queue_enfuse'].var = v_sp_queue_enfuse
+
+    # watch folder
+    fr_queue_watch = ttk.Frame(fr_queue_actions)
+    fr_queue_watch.grid(column=0, columnspan=9, row=1, sticky=(tk.EW), pady=(10, 0))
+    fr_queue_watch.columnconfigure(7, weight=1)
+
+    w['bt_queue_watch'] = ttk.Button(fr_queue_watch, text='Watch folder', command=self.toggle_watch)
+    w['bt_queue_watch'].grid(column=0, row=0, padx=(0, 10))
+
+    ttk.Label(fr_queue_watch, text='Group by: ').grid(column=1, row=0, sticky=(tk.E), padx=5)
+
+    v_cb_watch_group = tk.StringVar()
+    w['cb_watch_group'] = ttk.Combobox(fr_queue_watch, justify=tk.CENTER, values=('time gap', 'filename sequence'),
+                                       state='readonly', width=18, textvariable=v_cb_watch_group)
+    w['cb_watch_group'].grid(column=2, row=0, sticky=(tk.W), padx=(5, 20))
+    w['cb_watch_group'].bind('<<ComboboxSelected>>', lambda x : w['cb_watch_group'].selection_clear())
+    w['cb_watch_group'].var = v_cb_watch_group
+
+    ttk.Label(fr_queue_watch, text='Gap (seconds): ').grid(column=3, row=0, sticky=(tk.E), padx=5)
+
+    v_sp_watch_gap = tk.IntVar()
+    w['sp_watch_gap'] = ttk.Spinbox(fr_queue_watch, justify=tk.CENTER, from_=1, to=600,
+                                    increment=1, width=5, textvariable=v_sp_watch_gap)
+    w['sp_watch_gap'].grid(column=4, row=0, sticky=(tk.W), padx=(5, 20))
+    w['sp_watch_gap'].var = v_sp_watch_gap
+
+    ttk.Label(fr_queue_watch, text='Frames per stack (0: any): ').grid(column=5, row=0, sticky=(tk.E), padx=5)
+
+    v_sp_watch_frames = tk.IntVar()
+    w['sp_watch_frames'] = ttk.Spinbox(fr_queue_watch, justify=tk.CENTER, from_=0, to=999,
+                                       increment=1, width=5, textvariable=v_sp_watch_frames)
+    w['sp_watch_frames'].grid(column=6, row=0, sticky=(tk.W), padx=5)
+    w['sp_watch_frames'].var = v_sp_watch_frames
+
+    w['lb_watch_status'] = ttk.Label(fr_queue_actions, text='')
+    w['lb_watch_status'].grid(column=0, columnspan=9, row=2, sticky=(tk.W), pady=(10, 0))
+
+
     # ==== preferences panel ====
     tab_prefs.rowconfigure(5, weight=1)
     tab_prefs.columnconfigure(1, weight=1)
@@ -761,6 +1012,33 @@ class App(TkinterDnD.Tk):
     w['ck_prefs_align_gpu'].var = v_ck_prefs_align_gpu
 
 
+    # scratch area for the intermediates
+    fr_prefs_scratch = ttk.Labelframe(tab_prefs, text=' Scratch area ')
+    fr_prefs_scratch.grid(column=0, row=3, sticky=(tk.N, tk.EW), pady=(0,20))
+
+    ttk.Label(fr_prefs_scratch, text='   intermediates folder:').grid(column=0, row=0, sticky=(tk.E), padx=5, pady=7)
+
+    v_en_prefs_scratch = tk.StringVar()
+    w['en_prefs_scratch'] = ttk.Entry(fr_prefs_scratch, textvariable=v_en_prefs_scratch, width=60)
+    w['en_prefs_scratch'].grid(column=1, row=0, sticky=(tk.W, tk.N), padx=10, pady=7)
+    w['en_prefs_scratch'].var = v_en_prefs_scratch
+
+    ttk.Button(fr_prefs_scratch, text="Browse", command=self.browse_scratch) \
+       .grid(column=3, row=0, sticky=(tk.W), padx=(10, 20), pady=0)
+
+    v_ck_prefs_prefetch = tk.BooleanVar()
+    w['ck_prefs_prefetch'] = ttk.Checkbutton(fr_prefs_scratch, variable=v_ck_prefs_prefetch,
+                                             text='copy the input images there while stacking')
+    w['ck_prefs_prefetch'].grid(column=1, row=1, sticky=(tk.W, tk.N), padx=10, pady=0)
+    w['ck_prefs_prefetch'].var = v_ck_prefs_prefetch
+
+    v_ck_prefs_incremental = tk.BooleanVar()
+    w['ck_prefs_incremental'] = ttk.Checkbutton(fr_prefs_scratch, variable=v_ck_prefs_incremental,
+                                                text='keep the intermediates, restacking only redoes the frames that changed')
+    w['ck_prefs_incremental'].grid(column=1, row=2, sticky=(tk.W, tk.N), padx=10, pady=(0,18))
+    w['ck_prefs_incremental'].var = v_ck_prefs_incremental
+
+
     # GUI options
     fr_prefs_gui = ttk.Labelframe(tab_prefs, text=' GUI options ')
     fr_prefs_gui.grid(column=0, row=4, sticky=(tk.N, tk.EW))
@@ -810,6 +1088,7 @@ class App(TkinterDnD.Tk):
     w['bt_mask_copy'].configure(state=tk.DISABLED)
 
     w['bt_cancel_stack'].configure(state=tk.DISABLED)
+    w['bt_queue_cancel'].configure(state=tk.DISABLED)
 
     self.ui_cb_stack_aligner_changed()
 
@@ -823,11 +1102,11 @@ class App(TkinterDnD.Tk):
         custom_exec = w[widget].var.get()
         if custom_exec.strip() == '':
           tk.messagebox.showerror(message='Cannot find "' + cmd + '".\nPlease specify the file location manually.')
-          nb.select(3)  # show the preferences tab
+          nb.select(tab_prefs)  # show the preferences tab
           break
         elif not os.path.exists(custom_exec):
           tk.messagebox.showerror(message='Cannot find "' + custom_exec + '".\nPlease specify the correct location for ' + cmd)
-          nb.select(3)  # show the preferences tab
+          nb.select(tab_prefs)  # show the preferences tab
           break
 
 
@@ -981,6 +1260,13 @@ class App(TkinterDnD.Tk):
       self.widgets['en_exec_exiftool'].var.set(filepath)
 
 
+  def browse_scratch(self):
+    folder = tk.filedialog.askdirectory(title='Select a folder for the intermediate images')
+
+    if folder != '':
+      self.widgets['en_prefs_scratch'].var.set(folder)
+
+
   def toggle_log(self, show = None):
     w = self.widgets
 
@@ -1025,28 +1311,114 @@ class App(TkinterDnD.Tk):
 
 
 
-  def add_images(self, filepaths):
+  def add_images(self, filepaths, user = True):
+    """ add images (and the images of folders, recursively). Listing and probing run in a
+        background thread, the rows are added to the lists in chunks by insert_loaded_images().
+        user: False for the images of a loaded project, which don't need saving """
     if len(filepaths) == 0:
       return
 
     # save the current location
     self.config.set('prefs', 'last_opened_location', os.path.dirname(filepaths[0]))
 
-    # update the image list in Images and Stacks tabs
+    settings = {'en_prefs_align_prefix': self.widgets['en_prefs_align_prefix'].var.get()}
+    loading = self.image_loading
+    loading['loaders'] += 1
+    generation = loading['generation']
+
+    def load():
+      try:
+        # read the headers up front, so that unreadable/mismatched images are rejected now
+        # rather than after minutes of alignment
+        found = []
+        for filepath in filepaths:
+          if os.path.isdir(filepath):
+            found += list_images(filepath, settings, recursive=True)
+          elif os.path.exists(filepath):
+            found.append(filepath)
+
+        for start in range(0, len(found), IMAGE_CHUNK):
+          if loading['generation'] != generation:
+            break   # another project was loaded meanwhile
+
+          chunk = found[start : start + IMAGE_CHUNK]
+          probes = probe_images(chunk)
+          loading['queue'].put((generation, [(filepath, probes[filepath], user) for filepath in chunk]))
+      finally:
+        loading['queue'].put(None)   # this loader is done
+
+    threading.Thread(target=load, daemon=True).start()
+
+    if loading['handle'] == None:
+      loading['handle'] = self.after(50, self.insert_loaded_images)
+
+
+
+  def insert_loaded_images(self):
+    """ add the images probed by add_images() to the Images and Masks lists, at most
+        IMAGE_CHUNK rows per call so that the GUI stays responsive """
     w = self.widgets
-    for filepath in filepaths:
+    loading = self.image_loading
+
+    while True:
+      try:
+        chunk = loading['queue'].get_nowait()
+      except queue.Empty:
+        break
+
+      if chunk == None:
+        loading['loaders'] -= 1
+      elif chunk[0] == loading['generation']:
+        loading['rows'].extend(chunk[1])
+
+    inserted = min(IMAGE_CHUNK, len(loading['rows']))
+
+    for i in range(inserted):
+      filepath, probe, user = loading['rows'].popleft()
+      filename = os.path.basename(filepath)
+
       if filepath in self.input_images:
         continue
 
-      if not os.path.exists(filepath):
+      if isinstance(probe, Exception):
+        loading['rejected'].append(filename + ': not a readable image (' + str(probe) + ')')
         continue
 
-      filename = os.path.basename(filepath)
+      reference = self.input_images.probe(self.input_images[0]) if len(self.input_images) > 0 else probe
+      mismatch = image_mismatch(reference, probe)
+      if mismatch:
+        loading['rejected'].append(filename + ': ' + mismatch)
+        continue
+
+      values = (str(probe['width']) + 'x' + str(probe['height']), probe['mode'],
+                format_depth(probe['depth']), ORIENTATIONS.get(probe['orientation'], str(probe['orientation'])))
 
-      w['tr_images'].insert('', tk.END, filepath, text=filename)
-      self.input_images.append(filepath)
+      w['tr_images'].insert('', tk.END, filepath, text=filename, values=values)
+      self.input_images.add(filepath, probe)
 
       w['tr_mask_images'].insert('', tk.END, filepath, text=filename)
+      if user:
+        self.unsaved['images'] = True
+
+    if loading['loaders'] > 0 or len(loading['rows']) > 0:
+      loading['handle'] = self.after(10 if inserted > 0 else 50, self.insert_loaded_images)
+      return
+
+    loading['handle'] = None
+
+    # masks of images that didn't make it (e.g. from a project) are dropped
+    for image_id in list(self.masks):
+      if image_id not in self.input_images:
+        del self.masks[image_id]
+        self.unsaved['masks'].add(image_id)
+
+    self.update_mask_image_list()
+
+    if len(loading['rejected']) > 0:
+      rejected = loading['rejected']
+      loading['rejected'] = []
+      tk.messagebox.showerror(message='These images were not added:\n\n' + '\n'.join(rejected[:30]) +
+                              ('\n... and ' + str(len(rejected) - 30) + ' more' if len(rejected) > 30 else ''))
 
 
 
@@ -1054,14 +1426,17 @@ class App(TkinterDnD.Tk):
     w = self.widgets
     selection = w['tr_images'].selection()
 
-    for image_id in selection:
-      w['tr_images'].delete(image_id)
-      w['tr_mask_images'].delete(image_id)
+    if len(selection) > 0:
+      w['tr_images'].delete(*selection)
+      w['tr_mask_images'].delete(*selection)
+      self.input_images.remove(selection)
 
-    for image_id in self.input_images[:]:
-      if image_id in selection:
-        self.input_images.remove(image_id)
+      # their masks go with them
+      for image_id in selection:
+        if self.masks.pop(image_id, None) is not None:
+          self.unsaved['masks'].add(image_id)
 
+    self.unsaved['images'] = True
     w['bt_image_remove'].configure(state=tk.DISABLED)
 
     # clear the image and mask preview
@@ -1081,50 +1456,44 @@ class App(TkinterDnD.Tk):
 
 
   def update_input_image_preview(self):
-    """ update the preview with the specified image at index """
+    """ update the preview with the selected image """
     cv = self.widgets['cv_image_preview']
 
     selection = self.widgets['tr_images'].selection()
 
     if len(selection) != 1:
-      cv.delete(tk.ALL)
+      cv.view.clear()
       return
 
-    image_id = selection[0]
+    cv.view.show(selection[0])
+    cv.view.redraw()
 
-    width = cv.winfo_width()
-    height = cv.winfo_height()
 
-    # if size changed, clear buffer
-    hit = False
-    cache = self.preview_cache
+  def bind_zoom(self, cv, redraw):
+    """ zoom the TileView of a canvas with the mouse wheel (around the pointer) and pan it by
+        dragging with the middle or right button; double-click with them to fit the image again """
+    def on_wheel(event):
+      cv.view.zoom(1.25 if event.num == 4 or event.delta > 0 else 0.8, event.x, event.y)
+      redraw()
 
-    if cache['width'] != width or cache['height'] != height:
-      cache['slots'] = [None] * len(cache['slots'])
-      cache['width'] = width
-      cache['height'] = height
-    else:
-      # check buffer
-      for item in cache['slots']:
-        if item and item['filename'] == image_id:
-          img = item['img']
-          hit = True
-          break
+    def on_drag(event):
+      cv.view.pan_to(event.x, event.y)
+      redraw()
 
-    if hit == False:
-      img = Image.open(image_id)
-      img.thumbnail((width, height), Image.Resampling.LANCZOS)
-      img = ImageTk.PhotoImage(img)
+    def on_reset(event):
+      cv.view.reset()
+      redraw()
 
-      buffer_slot = cache['head'] % len(cache['slots'])
-      cache['slots'][buffer_slot] = {
-        'filename' : image_id,
-        'img'      : img
-      }
-      cache['head'] = (cache['head']+1) % len(cache['slots'])
+    if platform.system() == 'Linux':
+      cv.bind('<Button-4>', on_wheel)
+      cv.bind('<Button-5>', on_wheel)
+    else:
+      cv.bind('<MouseWheel>', on_wheel)
 
-    cv.create_image(width/2, height/2, anchor=tk.CENTER, image=img)
-    cv.image = img
+    for button in ('2', '3'):
+      cv.bind('<ButtonPress-' + button + '>', lambda event: cv.view.start_pan(event.x, event.y))
+      cv.bind('<B' + button + '-Motion>', on_drag)
+      cv.bind('<Double-Button-' + button + '>', on_reset)
 
 
   def get_current_mask_image(self):
@@ -1185,7 +1554,7 @@ class App(TkinterDnD.Tk):
         has_duplicate = False
         for i in range(old_mask_count):
           old_mask = self.masks[image_id][i]
-          if collections.Counter(old_mask['mask']) == collections.Counter(mask['mask']):
+          if np.array_equal(old_mask['mask'], mask['mask']):
             old_mask['type'] = mask['type'] # update existing mask
             has_duplicate = True
             break
@@ -1193,6 +1562,8 @@ class App(TkinterDnD.Tk):
         if has_duplicate == False:
           self.masks[image_id].append(copy.deepcopy(mask))
 
+      self.unsaved['masks'].add(image_id)
+
     self.update_mask_list()
     self.update_mask_canvas()
 
@@ -1204,6 +1575,7 @@ class App(TkinterDnD.Tk):
     for image_id in selection:
       if image_id in self.masks:
         del self.masks[image_id]
+        self.unsaved['masks'].add(image_id)
 
     self.update_mask_list()
     self.update_mask_canvas()
@@ -1216,6 +1588,7 @@ class App(TkinterDnD.Tk):
     for mask_id in reversed(selection):
       image_id, mask_index = mask_id.split('|')
       self.masks[image_id].pop(int(mask_index))
+      self.unsaved['masks'].add(image_id)
 
     self.update_mask_list()
     self.update_mask_canvas()
@@ -1229,6 +1602,7 @@ class App(TkinterDnD.Tk):
       image_id, mask_index = mask_id.split('|')
       mask = self.masks[image_id][int(mask_index)]
       mask['type'] = 'include'
+      self.unsaved['masks'].add(image_id)
 
     self.update_mask_list()
     self.update_mask_canvas()
@@ -1242,6 +1616,7 @@ class App(TkinterDnD.Tk):
       image_id, mask_index = mask_id.split('|')
       mask = self.masks[image_id][int(mask_index)]
       mask['type'] = 'exclude'
+      self.unsaved['masks'].add(image_id)
 
     self.update_mask_list()
     self.update_mask_canvas()
@@ -1267,7 +1642,7 @@ class App(TkinterDnD.Tk):
     if len(current_item) == 0:
        return
 
-    if cv.type(current_item[0]) == 'polygon':
+    if cv.type(current_item[0]) == 'polygon' and current_item[0] in cv.masks:
       if cv.masks[current_item[0]] == 'editable':
         return
 
@@ -1316,21 +1691,26 @@ class App(TkinterDnD.Tk):
       self.new_mask = None
       w['bt_mask_add'].configure(state=tk.NORMAL)
       cv.delete(cv.new_mask)
+      cv.new_mask = None
       return
 
     if image_id not in self.masks:
       self.masks[image_id] = []
 
 
+    # drop the redundant points of the outline (within half a screen pixel), then
     # map/scale the mask to full image width
-    mask = self.unscale_polygon(self.new_mask, cv.origin, cv.image_scale)
+    points = simplify_polygon(polygon_array(self.new_mask), 0.5)
+    mask = self.unscale_polygon(points, cv.origin, cv.image_scale)
 
     self.masks[image_id].append({
       'mask': mask,
       'type': w['sp_mask_add_type'].var.get()
     })
+    self.unsaved['masks'].add(image_id)
 
     self.new_mask = None
+    cv.delete(cv.new_mask)
     cv.new_mask = None
 
     w['bt_mask_add'].configure(state=tk.NORMAL)
@@ -1362,69 +1742,48 @@ class App(TkinterDnD.Tk):
 
 
   def update_mask_canvas(self):
-    """ update the mask canvas with the specified item_id/filepath """
+    """ sync the mask canvas with the currently selected image and its masks. Canvas items are
+        kept between calls: the TileView only swaps the tiles that came in or out of view, and
+        only the mask polygons whose points, type or view changed are updated """
     cv = self.widgets['cv_image_masks']
-    cv.delete(tk.ALL)
+
+    # drop a mask left unfinished (e.g. another image was selected)
+    if self.new_mask == None and cv.new_mask != None:
+      cv.delete(cv.new_mask)
+      cv.new_mask = None
 
     image_id = self.get_current_mask_image()
     if image_id == None:
+      cv.view.clear()
+      cv.delete('mask', 'handle')
+      cv.mask_items = []
+      cv.mask_state = []
+      cv.masks = {}
+      cv.editable_mask = None
       return
 
-    width = cv.winfo_width()
-    height = cv.winfo_height()
-
-    # if size changed, clear buffer
-    hit = False
-    cache = self.mask_preview_cache
-
-    if cv.old_width != width or cv.old_height != height:
-      # clear cache
-      cache['slots'] = [None] * len(cache['slots'])
-      cv.old_width  = width
-      cv.old_height = height
-    else:
-      # check buffer
-      for item in cache['slots']:
-        if item and item['filename'] == image_id:
-          tkimg = item['img']
-          hit = True
-          break
-
-    if hit == False:
-      img = Image.open(image_id)
-      img_full_width = img.width
-
-      img.thumbnail((width, height), Image.Resampling.LANCZOS)
-      cv.image_scale = img.width/img_full_width
-
-      tkimg = ImageTk.PhotoImage(img)
+    previous_view = (cv.view.origin, cv.view.scale)
+    cv.view.show(image_id)
+    cv.view.redraw()
+    cv.origin = cv.view.origin
+    cv.image_scale = cv.view.scale
 
-      buffer_slot = cache['head'] % len(cache['slots'])
-      cache['slots'][buffer_slot] = {
-        'filename' : image_id,
-        'img'      : tkimg
-      }
-      cache['head'] = (cache['head']+1) % len(cache['slots'])
-
-    cv_image = cv.create_image(width/2, height/2, anchor=tk.CENTER, image=tkimg)
-    cv.image = tkimg
+    # keep the points of a mask being drawn on the same image points
+    if self.new_mask and previous_view != (cv.origin, cv.image_scale):
+      points = self.unscale_polygon(self.new_mask, *previous_view)
+      self.new_mask = self.scale_polygon(points, cv.origin, cv.image_scale)
+      if len(self.new_mask) >= 4:
+        cv.coords(cv.new_mask, self.new_mask)
 
-    # calculate the image top-left corner
-    img_center = cv.coords(cv_image)
-    cv.origin = (img_center[0] - tkimg.width()/2, img_center[1] - tkimg.height()/2)
-
-    # add the masks of the image
-    if self.new_mask != None:
-      cv.new_mask = cv.create_polygon(self.new_mask, fill='', outline='#ffffff')
+    self.draw_masks(image_id, self.masks.get(image_id, []))
 
-    # add the existing masks of the current image
-    if image_id in self.masks:
-      self.draw_masks(self.masks[image_id], cv.origin, cv.image_scale)
+    if cv.new_mask != None:
+      cv.tag_raise(cv.new_mask)
 
 
 
-  def draw_masks(self, masks, origin, scale):
-    """ helper to add a list of masks on the canvas """
+  def draw_masks(self, image_id, masks):
+    """ sync the mask polygons of the canvas with a list of masks """
     w = self.widgets
     cv = w['cv_image_masks']
 
@@ -1434,73 +1793,96 @@ class App(TkinterDnD.Tk):
     if len(selection) == 1:
       editable_mask = selection[0]
 
-    #print(self.masks[self.current_mask_image])
-    cv.masks ={}
-    image_id = self.get_current_mask_image()
+    # one polygon per mask, reused by index
+    while len(cv.mask_items) > len(masks):
+      cv.delete(cv.mask_items.pop())
+      cv.mask_state.pop()
+
+    while len(cv.mask_items) < len(masks):
+      cv.mask_items.append(cv.create_polygon(0, 0, 0, 0, 0, 0, fill='', tags=('mask')))
+      cv.mask_state.append(None)
+
+    cv.masks = {}
+    editable = None
+    redrawn = False   # the editable polygon changed, its handles need to follow
+    view = (cv.origin, cv.image_scale)
 
     for i, mask in enumerate(masks):
-      mask_color = self.config.get('widgets', 'en_prefs_gui_mask_include')
-      if mask['type'] == 'exclude':
-        mask_color = self.config.get('widgets', 'en_prefs_gui_mask_exclude')
-
-      if editable_mask != None and editable_mask == (image_id + '|' + str(i)):
-        cv.editable_mask = {
-          'mask_id':str(i + 1),
-          'mask': mask,
-          'polygon': None
-        }
-        self.draw_editable_mask()
+      item = cv.mask_items[i]
+      state = cv.mask_state[i]
+      is_editable = editable_mask == (image_id + '|' + str(i))
+      style = (mask['type'], is_editable)
+
+      if is_editable:
+        editable = i
+        cv.masks[item] = 'editable'
       else:
-        object_id = cv.create_polygon(self.scale_polygon(mask['mask'], cv.origin, scale),
-                                      fill='', outline=mask_color)
-        cv.masks[object_id] = image_id + '|' + str(i)  # revert mapping back to the mask
+        cv.masks[item] = image_id + '|' + str(i)  # revert mapping back to the mask
+
+      if state == None or state['style'] != style:
+        redrawn = redrawn or is_editable
+        if is_editable:
+          mask_color = self.config.get('widgets', 'en_prefs_gui_mask_active')
+          cv.addtag_withtag('editable', item)
+        else:
+          mask_color = self.config.get('widgets', 'en_prefs_gui_mask_' + mask['type'])
+          cv.dtag(item, 'editable')
+        cv.itemconfigure(item, outline=mask_color)
+
+      if state == None or state['view'] != view or not np.array_equal(state['points'], mask['mask']):
+        redrawn = redrawn or is_editable
+        cv.coords(item, self.scale_polygon(mask['mask'], cv.origin, cv.image_scale))
+
+      cv.mask_state[i] = {'style': style, 'view': view, 'points': polygon_array(mask['mask']).copy()}
 
-    # bring the editable mask up top (after drawing all masks)
-    if editable_mask != None and cv.editable_mask['polygon'] != None:
-      cv.tag_raise(cv.editable_mask['polygon'])
-      cv.tag_raise('handle')
+    self.draw_editable_mask(None if editable == None else masks[editable], editable, redrawn)
 
 
 
-  def draw_editable_mask(self):
+  def draw_editable_mask(self, mask, index, redrawn = True):
+    """ point the editable mask at a mask (or none) and place its handles, which only
+        move if the polygon was redrawn """
     cv = self.widgets['cv_image_masks']
 
-    if not cv.editable_mask:
+    if mask == None:
+      cv.delete('handle')
+      cv.editable_mask = None
       return
 
-    # remove current editable mask and handles
-    if 'polygon' in cv.editable_mask and cv.editable_mask['polygon'] != None:
-      cv.delete(cv.editable_mask['polygon'])
+    handles = [] if cv.editable_mask == None else cv.editable_mask['handles']
 
-    mask = cv.editable_mask['mask']
-    points = self.scale_polygon(mask['mask'], cv.origin, cv.image_scale)
+    if redrawn or len(handles) != len(mask['mask']):
+      points = self.scale_polygon(mask['mask'], cv.origin, cv.image_scale)
 
-    # create the mask
-    mask_color = self.config.get('widgets', 'en_prefs_gui_mask_active')
-    p = cv.create_polygon(points, fill='', outline=mask_color, tags=('editable'))
-    cv.masks[p] = 'editable'
-    cv.editable_mask['polygon'] = p
-
-    cv.tag_bind(p, '<ButtonPress-1>',   lambda event, tag=p: self.mask_canvas_on_press_tag(event, tag))
-    cv.tag_bind(p, '<ButtonRelease-1>', self.mask_canvas_on_release_tag)
-    cv.tag_bind(p, '<B1-Motion>', self.mask_canvas_on_move_polygon)
-
-    # add handles for editable mask
-    handle_size = 5
-    cv.editable_mask['handles'] = []
-    for i in range(math.floor(len(points)/2)):
-      handle = cv.create_oval(points[2*i]-handle_size, points[2*i+1]-handle_size,
-                              points[2*i]+handle_size, points[2*i+1]+handle_size,
-                              fill=mask_color, outline=mask_color, tags=('handle'))
-      cv.editable_mask['handles'].append(handle)
-      cv.tag_bind(handle, '<ButtonPress-1>',   lambda event, tag=handle: self.mask_canvas_on_press_tag(event, tag))
-      cv.tag_bind(handle, '<ButtonRelease-1>', self.mask_canvas_on_release_tag)
-      cv.tag_bind(handle, '<B1-Motion>', lambda event, number=i: self.mask_canvas_on_move_handle(event, number))
-
-
-  def mask_canvas_on_press_tag(self, event, tag):
+      # add/remove handles to match the number of points
+      handle_size = 5
+      mask_color = self.config.get('widgets', 'en_prefs_gui_mask_active')
+      while len(handles) > len(points)//2:
+        cv.delete(handles.pop())
+
+      while len(handles) < len(points)//2:
+        handles.append(cv.create_oval(0, 0, 0, 0, fill=mask_color, outline=mask_color, tags=('handle')))
+
+      for i, handle in enumerate(handles):
+        cv.coords(handle, points[2*i]-handle_size, points[2*i+1]-handle_size,
+                          points[2*i]+handle_size, points[2*i+1]+handle_size)
+
+    cv.editable_mask = {
+      'mask'    : mask,
+      'index'   : index,
+      'polygon' : cv.mask_items[index],
+      'handles' : handles,
+      'selected': None
+    }
+
+    # bring the editable mask up top
+    cv.tag_raise(cv.editable_mask['polygon'])
+    cv.tag_raise('handle')
+
+
+  def mask_canvas_on_press_tag(self, event):
     cv = self.widgets['cv_image_masks']
-    cv.editable_mask['selected'] = tag
+    cv.editable_mask['selected'] = cv.find_withtag(tk.CURRENT)[0]
     cv.editable_mask['previous_x'] = event.x
     cv.editable_mask['previous_y'] = event.y
 
@@ -1511,6 +1893,11 @@ class App(TkinterDnD.Tk):
     cv.editable_mask['previous_x'] = None
     cv.editable_mask['previous_y'] = None
 
+    # the polygon already shows the moved points
+    state = cv.mask_state[cv.editable_mask['index']]
+    state['points'] = polygon_array(cv.editable_mask['mask']['mask']).copy()
+    self.unsaved['masks'].add(self.get_current_mask_image())
+
 
   def mask_canvas_on_move_polygon(self, event):
     ''' move editable mask polygon and handles '''
@@ -1528,39 +1915,30 @@ class App(TkinterDnD.Tk):
         cv.move(handle, dx, dy)
 
       # update mask data
-      points = self.scale_polygon(cv.editable_mask['mask']['mask'], cv.origin, cv.image_scale)
-
-      for i in range(math.floor(len(points)/2)):
-        points[2*i]   += dx
-        points[2*i+1] += dy
-
-      cv.editable_mask['mask']['mask'] = self.unscale_polygon(points, cv.origin, cv.image_scale)
+      cv.editable_mask['mask']['mask'] += (dx/cv.image_scale, dy/cv.image_scale)
 
       cv.editable_mask['previous_x'] = event.x
       cv.editable_mask['previous_y'] = event.y
 
 
-  def mask_canvas_on_move_handle(self, event, number):
+  def mask_canvas_on_move_handle(self, event):
     '''move single hadnle of mask polygon'''
     cv= self.widgets['cv_image_masks']
 
     if cv.editable_mask['selected']:
       dx = event.x - cv.editable_mask['previous_x']
       dy = event.y - cv.editable_mask['previous_y']
+      number = cv.editable_mask['handles'].index(cv.editable_mask['selected'])
 
       # move handle
       cv.move(cv.editable_mask['selected'], dx, dy)
 
       # update mask data
-      points = self.scale_polygon(cv.editable_mask['mask']['mask'], cv.origin, cv.image_scale)
-
-      points[2*number]    += dx
-      points[2*number+1]  += dy
-
-      cv.editable_mask['mask']['mask'] = self.unscale_polygon(points, cv.origin, cv.image_scale)
+      mask = cv.editable_mask['mask']['mask']
+      mask[number] += (dx/cv.image_scale, dy/cv.image_scale)
 
       # update mask polygon
-      cv.coords(cv.editable_mask['polygon'], points)
+      cv.coords(cv.editable_mask['polygon'], self.scale_polygon(mask, cv.origin, cv.image_scale))
 
       cv.editable_mask['previous_x'] = event.x
       cv.editable_mask['previous_y'] = event.y
@@ -1604,114 +1982,79 @@ class App(TkinterDnD.Tk):
 
 
   def scale_polygon(self, poly, new_origin, new_scale) :
-    ''' calculate the point of a polygon at specified scale and origin '''
-    p = []
-
-    for i in range(math.floor(len(poly)/2)):
-      p.append(poly[2*i]*new_scale + new_origin[0])
-      p.append(poly[2*i+1]*new_scale + new_origin[1])
-
-    return p
+    ''' calculate the point of a polygon at specified scale and origin,
+        as the flat coordinate list expected by the canvas '''
+    return (polygon_array(poly)*new_scale + new_origin).ravel().tolist()
 
 
   def unscale_polygon(self, poly, current_origin, current_scale):
-    ''' Calculate the points of a polygon at actual/image scale '''
-    p = []
-
-    for i in range(math.floor(len(poly)/2)):
-      p.append((poly[2*i]   - current_origin[0])/current_scale)
-      p.append((poly[2*i+1] - current_origin[1])/current_scale)
-
-    return p
+    ''' Calculate the points of a polygon at actual/image scale (Nx2 array) '''
+    return polygon_array((polygon_array(poly) - current_origin)/current_scale)
 
 
   def update_output_image_preview(self):
+    """ show the reduced preview of the output, only rescaled again when the canvas size changed """
     cv = self.widgets['cv_stacked_preview']
-    cv.delete(tk.ALL)
 
-    if len(self.input_images) == 0:
+    if self.output_preview == None:
+      cv.delete(tk.ALL)
+      cv.photos = None
       return
 
-    if self.output_image == None:
-       return
-
     width = cv.winfo_width()
     height = cv.winfo_height()
 
-    img = Image.open(self.output_image)
-    img.thumbnail((width, height), Image.Resampling.LANCZOS)
-    img = ImageTk.PhotoImage(img)
+    if cv.photos == None or cv.photos['size'] != (width, height):
+      output = Image.fromarray(self.output_preview['output'])
+      output.thumbnail((width, height), Image.Resampling.LANCZOS)
 
-    cv.create_image(width/2, height/2, anchor=tk.CENTER, image=img)
-    cv.image = img
+      # the input is shown at the size of the output, for the compare view
+      input_img = None
+      if self.output_preview.get('input') is not None:
+        input_img = Image.fromarray(self.output_preview['input']).resize(output.size, Image.Resampling.LANCZOS)
+
+      cv.delete(tk.ALL)
+      cv.photos = {
+        'size'     : (width, height),
+        'output'   : ImageTk.PhotoImage(output),
+        'input'    : None,
+        'input_img': input_img
+      }
+      cv.origin = ((width - output.width)//2, (height - output.height)//2)
+      cv.create_image(cv.origin[0], cv.origin[1], anchor=tk.NW, image=cv.photos['output'])
+      cv.input_item = cv.create_image(cv.origin[0], cv.origin[1], anchor=tk.NW, state=tk.HIDDEN)
+      cv.split_item = cv.create_line(0, 0, 0, 0, fill=self.config.get('widgets', 'en_prefs_gui_mask_active'),
+                                     state=tk.HIDDEN)
 
+    self.update_compare_split()
 
-  def load_config(self):
-    self.config = configparser.ConfigParser()
-    c = self.config
 
-    if os.path.isfile('config.ini'):
-      c.read('config.ini')
-
-    c['DEFAULT'] = {
-      'ck_align'                : 'True',
-      'cb_stack_aligner'        : 'ECC',
-      'sp_ecc_iterations'       : '50',
-      'sp_ecc_ter_eps'          : '1e-1',
-      'sp_ecc_pool'             : math.floor(mp.cpu_count()/2),
-      'ck_autocrop'             : 'True',
-      'ck_centershift'          : 'True',
-      'ck_fov'                  : 'True',
-      'sp_corr_threshold'       : '0.95',
-      'sp_error_threshold'      : '1',
-      'sp_control_points'       : '20',
-      'sp_grid_size'            : '5',
-      'sp_scale_factor'         : '0',
-      'ck_hard_mask'            : 'True',
-      'sp_levels'               : '29',
-      'ck_levels'               : 'True',
-      'sp_window_size'          : '5',
-      'ck_edge_scale'           : 'False',
-      'sp_edge_scale'           : '0',
-      'sp_lce_scale'            : '0',
-      'ck_lce_scale'            : 'False',
-      'sp_lce_level'            : '0',
-      'ck_lce_level'            : 'False',
-      'ck_curvature'            : 'False',
-      'sp_curvature'            : '0',
-      'ck_curvature_pc'         : 'False',
-      'cb_gray_proj'            : 'l-star',
-      'en_preview_w'            : '640',
-      'en_preview_h'            : '640',
-      'ck_output_size'          : 'False',
-      'en_output_w'             : '0',
-      'en_output_h'             : '0',
-      'en_output_xoffset'       : '0',
-      'en_output_yoffset'       : '0',
-      'cb_file_format'          : 'JPG',
-      'sp_jpg_quality'          : '90',
-      'cb_tif_compression'      : 'lzw',
-      'ck_keep_aligned'         : False,
-      'ck_keep_masked'          : False,
-
-      # preferences
-      'sp_mask_add_type'        : 'exclude',
-      'en_exec_align'           : 'align_image_stack',
-      'en_exec_enfuse'          : 'enfuse',
-      'en_exec_exiftool'        : 'exiftool',
-      'ck_prefs_align_gpu'      : False,
-
-      'en_prefs_align_prefix'     : 'aligned__',
-      'en_prefs_gui_mask_include' : '#00ff00',
-      'en_prefs_gui_mask_exclude' : '#ff0000',
-      'en_prefs_gui_mask_active'  : '#ffff00'
-    }
+  def update_compare_split(self, x = None):
+    """ in compare mode, show the first input left of x (or of the last split) over the output """
+    w = self.widgets
+    cv = w['cv_stacked_preview']
+
+    if cv.photos == None:
+      return
+
+    input_img = cv.photos['input_img']
+    if not w['ck_preview_compare'].var.get() or input_img is None:
+      cv.itemconfigure(cv.input_item, state=tk.HIDDEN)
+      cv.itemconfigure(cv.split_item, state=tk.HIDDEN)
+      return
+
+    if x != None:
+      cv.split = min(max((x - cv.origin[0]) / input_img.width, 0), 1)
 
-    if not c.has_section('prefs'):
-      c.add_section('prefs')
+    split = max(1, round(cv.split * input_img.width))
+    cv.photos['input'] = ImageTk.PhotoImage(input_img.crop((0, 0, split, input_img.height)))
+    cv.itemconfigure(cv.input_item, image=cv.photos['input'], state=tk.NORMAL)
+    cv.coords(cv.split_item, cv.origin[0] + split, cv.origin[1], cv.origin[0] + split, cv.origin[1] + input_img.height)
+    cv.itemconfigure(cv.split_item, state=tk.NORMAL)
 
-    if not c.has_section('widgets'):
-      c.add_section('widgets')
+
+  def load_config(self):
+    self.config = load_config()
 
 
   def apply_config(self):
@@ -1743,13 +2086,10 @@ class App(TkinterDnD.Tk):
 
   def save_configs(self):
     # read the current values of the widgets
-    w = self.widgets
     wc = self.config['widgets']
 
-    for w_name in w:
-      #w_class = w[w_name].winfo_class()
-      if hasattr(w[w_name], 'var'):
-        wc[w_name] = str(w[w_name].var.get())
+    for w_name, w_value in self.get_settings().items():
+      wc[w_name] = str(w_value)
 
 
     with open('config.ini', 'w') as configfile:
@@ -1766,452 +2106,2881 @@ class App(TkinterDnD.Tk):
     if self.after_handle != None:
       self.after_cancel(self.after_handle)
 
+    self.after_cancel(self.autosave_handle)
+    self.after_cancel(self.prune_tiles_handle)
+    self.autosave()
+
+    if self.watcher is not None:
+      self.watcher.stop()
+
+    self.engine.shutdown()
+
     self.destroy()
 
 
-  def build_align_command(self):
+  def get_settings(self):
+    """ snapshot of the current widget values, indexed by widget name. Jobs use this
+        instead of the widgets since they run outside of the Tk thread """
     w = self.widgets
+    settings = {}
 
-    align_exec = self.config.get('widgets', 'en_exec_align')
-    align_prefix = self.config.get('widgets', 'en_prefs_align_prefix')
+    for w_name in w:
+      if hasattr(w[w_name], 'var'):
+        settings[w_name] = w[w_name].var.get()
 
-    cmd = [align_exec, '-v', '-a'+align_prefix, '--use-given-order', '--distortion']
+    return settings
 
-    if w['ck_prefs_align_gpu'].var.get():
-      cmd.append('--gpu')
 
-    # get the alignment options
 
-    if w['ck_autocrop'].var.get():
-      cmd.append('-C')
+  def stack_images(self):
+    """ queue a job to perform optional alignment and fusing the images """
+    w = self.widgets
 
-    if w['ck_centershift'].var.get():
-      cmd.append('-i')
+    # check if we have at least 2 images
+    if len(self.input_images) < 2:
+      tk.messagebox.showinfo(message='Please add at least two images.')
+      w['nb'].select(0)
+      return
 
-    if w['ck_fov'].var.get():
-      cmd.append('-m')
+    try:
+      sweep = parse_sweep(w['en_sweep'].var.get())
+    except ValueError as e:
+      tk.messagebox.showerror(message='Invalid sweep: ' + str(e))
+      return
 
-    cmd.append('--corr=' + str(w['sp_corr_threshold'].var.get()))
-    cmd.append('-t ' + str(w['sp_error_threshold'].var.get()))
-    cmd.append('-c ' + str(w['sp_control_points'].var.get()))
-    cmd.append('-g ' + str(w['sp_grid_size'].var.get()))
-    cmd.append('-s ' + str(w['sp_scale_factor'].var.get()))
+    extension = '.jpg' if w['cb_file_format'].var.get() == 'JPG' else '.tif'
+    default_filename = os.path.splitext(os.path.basename(self.input_images[0]))[0] + '_fused' + extension
 
-    cmd = cmd + self.input_images
-    return cmd
+    output_name = tk.filedialog.asksaveasfilename(
+      initialdir=self.config['prefs']['last_opened_location'],
+      confirmoverwrite=True,
+      defaultextension=extension,
+      initialfile=default_filename
+    )
 
+    if not output_name:
+      return
 
+    # start a new log unless other jobs are still running
+    if len(self.interactive_jobs()) == 0:
+      w['tx_log'].delete(1.0, tk.END)
+      self.output_image = None
+      self.output_preview = None
+      self.update_output_image_preview()
 
-  def build_enfuse_command(self, images):
-    enfuse_exec = self.config.get('widgets', 'en_exec_enfuse')
+    self.toggle_log(True)
 
-    cmd = [enfuse_exec, '-v', '-o', self.output_name,
-           '--exposure-weight=0',
-           '--saturation-weight=0',
-           '--contrast-weight=1',
-           '--blend-colorspace=CIECAM']
+    job = StackJob(self.input_images, self.masks, output_name, self.get_settings(), main_queue,
+                   name=os.path.basename(output_name), interactive=True, sweep=sweep)
+    self.submit_job(job)
 
-    w = self.widgets
+    w['bt_cancel_stack'].configure(state=tk.NORMAL)
 
-    if w['ck_hard_mask'].var.get():
-      cmd.append('--hard-mask')
 
-    if not w['ck_levels'].var.get():
-      cmd.append('--levels=' + str(w['sp_levels'].var.get()))
 
-    if w['ck_edge_scale'].var.get():
-      opt = str(w['sp_edge_scale'].var.get()) + ':'
-      opt += str(w['sp_lce_scale'].var.get()) + ('%' if w['ck_lce_scale'].var.get() else '')
-      opt += ':' + str(w['sp_lce_level'].var.get()) + ('%' if w['ck_lce_level'].var.get() else '')
-      cmd.append('--contrast-edge-scale=' + opt)
+  def submit_job(self, job):
+    """ hand a job to the engine and start polling for its events """
+    self.engine.configure(job.settings)
+    self.engine.submit(job)
 
-    if w['ck_curvature'].var.get():
-      cmd.append('--contrast-min-curvature=' + str(w['sp_curvature'].var.get()) +
-                 '%' if w['ck_curvature_pc'].var.get() else '')
+    self.update_stack_status()
+    self.update_queue_list()
 
-    cmd.append('--gray-projector=' + str(w['cb_gray_proj'].var.get()))
-    cmd.append('--contrast-window-size=' + str(w['sp_window_size'].var.get()))
+    if self.flags['queue_is_active'] == False:
+      self.flags['queue_is_active'] = True
+      self.read_queue()
 
-    if w['cb_file_format'].var.get() == 'JPG':
-      cmd.append('--compression=' + str(w['sp_jpg_quality'].var.get()))
-    else:
-      cmd.append('--compression=' + str(w['cb_tif_compression'].var.get()))
 
-    cmd = cmd + images
-    return cmd
 
+  def interactive_jobs(self):
+    """ active jobs started with the Stack button """
+    return [job for job in self.engine.active_jobs() if job.interactive]
 
 
-  def apply_masks_to_images(self, images):
-    """ applied masks to images, assuming that they are aligned """
-    masked_images = []
 
-    # images might have different filename/path from original input
-    images_map = {}
-    for i, filepath in enumerate(self.input_images):
-      images_map[filepath] = images[i]
+  def cancel_stack_images(self):
+    w = self.widgets
 
-    # each "include" mask is equivalent to "exclude" masks for each of the other images
-    file_masks = copy.deepcopy(self.masks)
+    w['bt_cancel_stack'].configure(state=tk.DISABLED)
 
-    for filepath in self.masks:
-      for mask in file_masks[filepath]:
-        if mask['type'] == 'include':
-          for other_filepath in self.input_images:
-            if filepath != other_filepath:
-              exclude_mask = copy.deepcopy(mask)
-              exclude_mask['type'] = 'exclude'
+    for job in self.interactive_jobs():
+      self.engine.cancel(job.id)
 
-              if other_filepath not in file_masks:
-                file_masks[other_filepath] = []
+    w['tx_log'].insert(tk.END, '\n\nStacking cancelled by user, stacking the same images again resumes the run.\n\n')
+    w['tx_log'].see(tk.END)
 
-              file_masks[other_filepath].append(exclude_mask)
 
-    for filepath in self.input_images:
-      # important: treat every image as having mask. Our outputs might have
-      # different format/setting than the original, don't mix them
-      img  = Image.open(images_map[filepath]).convert('RGBA')
 
-      alpha = Image.new('L', img.size, 255)
-      alpha_mask = ImageDraw.Draw(alpha)
+  def stack_finished(self, job):
+    """ called from read_queue() when a job has completed, failed or been cancelled """
+    w = self.widgets
 
-      if filepath in file_masks:
-        for mask in file_masks[filepath]:
-          if mask['type'] == 'exclude':
-            alpha_mask.polygon(mask['mask'], fill=126)
+    # queued projects only report through the Queue tab
+    if job.interactive:
+      if job.state == 'done':
+        self.output_image = job.output_name
+        self.output_preview = job.preview
 
-        # add include mask after exclude masks
-        for mask in file_masks[filepath]:
-          if mask['type'] == 'include':
-            alpha_mask.polygon(mask['mask'], fill=255)
+        if self.output_preview == None:
+          try:
+            self.output_preview = {'output': image_preview(job.output_name)}
+          except (OSError, cv2.error):
+            pass
 
-      img.putalpha(alpha)
+        self.update_output_image_preview()
 
-      new_path = os.path.join(
-        os.path.dirname(images_map[filepath]),
-        'masked_' + os.path.splitext(os.path.basename(images_map[filepath]))[0] + '.tif'
-      )
+        if len(self.interactive_jobs()) == 0:
+          self.toggle_log(False)
 
-      img.save(new_path)
-      masked_images.append(new_path)
+      elif job.state == 'failed':
+        tk.messagebox.showerror(message=job.error)
 
-    return masked_images
+    if len(self.interactive_jobs()) == 0:
+      w['bt_cancel_stack'].configure(state=tk.DISABLED)
 
+    if len(self.engine.active_jobs()) == 0 and self.watcher is None:
+      self.flags['queue_is_active'] = False
 
-  def stack_images(self):
-    """ perform optional alignment and fusing the images """
-    w = self.widgets
+    self.update_stack_status()
+    self.update_queue_list()
 
-    # check if we have at least 2 images
-    if len(self.input_images) < 2:
-      tk.messagebox.showinfo(message='Please add at least two images.')
-      w['nb'].select(0)
-      return
 
-    extension = '.jpg' if w['cb_file_format'].var.get() == 'JPG' else '.tif'
-    default_filename = os.path.splitext(os.path.basename(self.input_images[0]))[0] + '_fused' + extension
 
-    self.output_name = tk.filedialog.asksaveasfilename(
-      initialdir=self.config['prefs']['last_opened_location'],
-      confirmoverwrite=True,
-      defaultextension=extension,
-      initialfile=default_filename
-    )
+  def update_stack_status(self):
+    """ show the state of the running and queued jobs below the Stack button """
+    jobs = self.engine.active_jobs()
+    running = [job for job in jobs if job.state != 'queued']
 
-    if not self.output_name:
-      return
+    status = [job.describe() for job in running]
+    if len(jobs) > len(running):
+      status.append(str(len(jobs) - len(running)) + ' queued')
 
-    w['bt_stack'].configure(state=tk.DISABLED)
-    w['bt_cancel_stack'].configure(state=tk.NORMAL)
+    self.widgets['lb_stack_status'].configure(text=', '.join(status))
 
-    w['tx_log'].delete(1.0, tk.END)
-    self.toggle_log(True)
 
-    self.output_image = None
-    self.update_output_image_preview()
 
-    self.flags['queue_is_active'] = True
-    self.read_queue()
+  def ui_bt_queue_add_projects(self):
+    filepaths = tk.filedialog.askopenfilenames(
+      title = 'Queue project files',
+      initialdir = self.config['prefs']['last_opened_location'],
+      filetypes = [('MFTker project file', '.mft')]
+    )
 
-    self.stack_cancelled = False
-    self.returncode = tk.IntVar()
+    self.queue_paths(filepaths)
 
-    if w['ck_align'].var.get():
-      aligned_prefix = self.config.get('widgets', 'en_prefs_align_prefix')
 
-      if w['cb_stack_aligner'].var.get() == 'align_image_stack':
-        self.aligned_images = []
+  def ui_bt_queue_add_folder(self):
+    folder = tk.filedialog.askdirectory(
+      title = 'Queue a folder of images',
+      initialdir = self.config['prefs']['last_opened_location'],
+      mustexist = True
+    )
 
-        for i, image in enumerate(self.input_images):
-          self.aligned_images.append(os.path.join(
-            os.path.dirname(image),
-            aligned_prefix + '{:04d}'.format(i) + '.tif'))
+    if folder:
+      self.queue_paths([folder])
 
-        align_cmd = self.build_align_command()
-        print(align_cmd)
 
-        self.returncode.set(-1)
-        self.thread = threading.Thread(target=self.execute_cmd, args=[align_cmd], daemon=True).start()
-        self.wait_variable(self.returncode)
+  def queue_paths(self, paths):
+    """ queue a stacking job for each project file/image folder, with the current settings """
+    errors = []
 
-        if self.returncode.get() > 0:
-          tk.messagebox.showerror(message='Error aligning images, please check output log.')
-          w['bt_cancel_stack'].configure(state=tk.DISABLED)
-          w['bt_stack'].configure(state=tk.NORMAL)
-          return
+    for path in paths:
+      try:
+        job = batch_job(path, self.get_settings(), main_queue)
+      except (OSError, ValueError) as e:
+        errors.append(os.path.basename(path) + ': ' + str(e))
+        continue
+
+      self.submit_job(job)
+      self.config.set('prefs', 'last_opened_location', os.path.dirname(path))
+
+    if len(errors) > 0:
+      tk.messagebox.showerror(message='Could not queue:\n' + '\n'.join(errors))
+
+
+  def cancel_queue_jobs(self):
+    for item in self.widgets['tr_queue'].selection():
+      self.engine.cancel(int(item))
+
+
+  def clear_finished_jobs(self):
+    tr = self.widgets['tr_queue']
+
+    for job_id in self.engine.forget_finished():
+      tr.delete(str(job_id))
+
+    self.ui_tr_queue_selected(None)
+
+
+  def ui_tr_queue_selected(self, event):
+    """ show the log of the selected job, enable Cancel if any selected job is active """
+    w = self.widgets
+    selection = w['tr_queue'].selection()
+
+    w['tx_queue_log'].delete(1.0, tk.END)
+    if len(selection) == 1:
+      job = self.engine.jobs.get(int(selection[0]))
+      if job is not None:
+        w['tx_queue_log'].insert(tk.END, ''.join(job.log_lines))
+        w['tx_queue_log'].see(tk.END)
+
+    state = tk.DISABLED
+    for item in selection:
+      job = self.engine.jobs.get(int(item))
+      if job is not None and not job.is_finished():
+        state = tk.NORMAL
+
+    w['bt_queue_cancel'].configure(state=state)
+
+
+  def ui_sp_queue_changed(self):
+    self.engine.configure(self.get_settings())
+
+
+  def toggle_watch(self):
+    """ start/stop queuing the brackets that arrive in a folder """
+    w = self.widgets
+
+    if self.watcher is not None:
+      self.watcher.stop()
+      self.watcher = None
+      w['bt_queue_watch'].configure(text='Watch folder')
+      return
+
+    folder = tk.filedialog.askdirectory(
+      title = 'Watch a folder for new images',
+      initialdir = self.config['prefs']['last_opened_location'],
+      mustexist = True
+    )
+
+    if not folder:
+      return
+
+    settings = self.get_settings()
+    self.engine.configure(settings)
+
+    self.watcher = FolderWatcher(folder, settings, self.engine, main_queue)
+    self.watcher.start()
+    w['bt_queue_watch'].configure(text='Stop watching')
+
+    if self.flags['queue_is_active'] == False:
+      self.flags['queue_is_active'] = True
+      self.read_queue()
+
+
+  def update_queue_list(self):
+    """ add the new jobs to the Queue tab and refresh the state of the others """
+    tr = self.widgets['tr_queue']
+
+    for job in list(self.engine.jobs.values()):
+      values = (job.status(), job.output_name)
+
+      if tr.exists(str(job.id)):
+        tr.item(str(job.id), values=values)
+      else:
+        tr.insert('', tk.END, str(job.id), text=str(job.id) + ': ' + job.name, values=values)
+
+
+
+  def read_queue(self):
+    # global main_queue
+    w = self.widgets
+
+    while main_queue.qsize():
+      try:
+        item = main_queue.get(0)
+        job = self.engine.jobs.get(item.get('job'))
+
+        if item['type'] == 'message':
+          if job is not None:
+            job.log_lines.append(item['msg'])
+
+            if w['tr_queue'].selection() == (str(job.id),):
+              w['tx_queue_log'].insert(tk.END, item['msg'])
+              w['tx_queue_log'].see(tk.END)
+
+          if job is None or job.interactive:
+            w['tx_log'].insert(tk.END, item['msg'])
+            w['tx_log'].see(tk.END)
+
+        elif item['type'] in ('state', 'progress'):
+          self.update_stack_status()
+          self.update_queue_list()
+
+        elif item['type'] == 'finished' and job is not None:
+          self.stack_finished(job)
+
+        elif item['type'] == 'watch':
+          w['lb_watch_status'].configure(text=item['msg'])
+
+      except queue.Empty:
+        pass
+
+    if self.flags['queue_is_active'] == True:
+      self.after_handle = self.after(500, self.read_queue)
+
+
+
+  def save_project(self):
+    # ask if we don't have a save file yet
+    if self.save_file == None:
+      if len(self.input_images) > 0:
+        initial_dir = os.path.dirname(self.input_images[0])
+        default_filename = os.path.splitext(os.path.basename(self.input_images[0]))[0] + '.mft'
+      else:
+        initial_dir = self.config['prefs']['last_opened_location']
+        default_filename = 'new_project.mft'
+
+      save_file = tk.filedialog.asksaveasfilename(
+        initialdir= initial_dir,
+        confirmoverwrite=True,
+        defaultextension='mft',
+        initialfile=default_filename
+      )
+
+      if save_file == '':
+        return
+
+      self.save_file = save_file
+
+    try:
+      write_project(self.save_file, self.input_images, self.masks)
+    except (OSError, sqlite3.Error) as e:
+      tk.messagebox.showerror(message='Error saving project file "' +
+                              os.path.basename(self.save_file) + '":\n' + str(e))
+      return
+
+    self.unsaved['images'] = False
+    self.unsaved['masks'].clear()
+
+    # set the window title to the filename
+    self.title('MFTker - ' + os.path.basename(self.save_file))
+
+
+  def load_project(self):
+    w = self.widgets
+
+    load_file = tk.filedialog.askopenfilename(
+      title = 'Load a project file',
+      initialdir = self.config['prefs']['last_opened_location'],
+      filetypes = [('MFTker project file', '.mft')],
+      multiple = False
+    )
+
+    if load_file != '':
+      try:
+        data = read_project(load_file)
+      except (OSError, ValueError) as e:
+        tk.messagebox.showerror(message='Error parsing project file "' +
+                                os.path.basename(load_file) + '":\n' + str(e))
+        return
+
+      # drop the images still being added to the current project
+      loading = self.image_loading
+      loading['generation'] += 1
+      loading['rows'].clear()
+      loading['rejected'] = []
+
+      # clean out the current files
+      if len(self.input_images) > 0:
+        w['tr_images'].delete(*self.input_images)
+        w['tr_mask_images'].delete(*self.input_images)
+        self.input_images.clear()
+
+      # the masks of images that can't be added are dropped once they're all loaded
+      self.masks.clear()
+      self.masks.update(data['masks'])
+
+      self.add_images(data['input_images'], user=False)
+
+      self.update_mask_image_list()
+      self.update_mask_canvas()
+
+      # set the window title to the filename
+      self.title('MFTker - ' + os.path.basename(load_file))
+      self.save_file = load_file
+      self.unsaved['images'] = False
+      self.unsaved['masks'].clear()
+
+
+  def autosave(self):
+    """ write what changed since the last save into the project file, every AUTOSAVE_INTERVAL.
+        Only projects already saved in the SQLite format are autosaved: an old JSON project
+        is converted by the next manual save """
+    try:
+      if self.save_file != None and (self.unsaved['images'] or len(self.unsaved['masks']) > 0) \
+         and is_project_db(self.save_file):
+        update_project(self.save_file, self.input_images if self.unsaved['images'] else None,
+                       {image_id: self.masks.get(image_id, []) for image_id in self.unsaved['masks']})
+        self.unsaved['images'] = False
+        self.unsaved['masks'].clear()
+        self.autosave_error = None
+
+    except (OSError, sqlite3.Error) as e:
+      # in the log, once rather than at every retry (e.g. the project file was moved)
+      msg = 'Autosave of ' + os.path.basename(self.save_file) + ' failed: ' + str(e)
+      if msg != self.autosave_error:
+        self.autosave_error = msg
+        self.widgets['tx_log'].insert(tk.END, '\n' + msg + '\n')
+        self.widgets['tx_log'].see(tk.END)
+
+    finally:
+      self.autosave_handle = self.after(AUTOSAVE_INTERVAL, self.autosave)
+
+
+  def prune_tiles(self):
+    """ trim the tile cache in the background every TILE_PRUNE_INTERVAL, keeping the pyramids shown """
+    keep = [cv.view.pyramid.folder for cv in (self.widgets['cv_image_preview'], self.widgets['cv_image_masks'])
+            if cv.view.pyramid != None]
+    tile_builder.submit(prune_tile_cache, keep)
+
+    self.prune_tiles_handle = self.after(TILE_PRUNE_INTERVAL, self.prune_tiles)
+
+
+
+
+
+
+class JobCancelled(Exception):
+  """ raised inside a StackJob when the user cancelled it """
+
+
+
+class StackJob():
+  """ a single stacking run (optional alignment, masks, enfuse and EXIF copy), executed by a
+      JobEngine outside of the Tk thread. Progress is reported as events on a queue:
+        {'type': 'message',  'job': id, 'msg': ...}
+        {'type': 'state',    'job': id, 'state': ...}
+        {'type': 'progress', 'job': id, 'done': n, 'total': n}
+        {'type': 'finished', 'job': id, 'state': ...}
+  """
+  states = ('queued', 'analysing', 'aligning', 'masking', 'fusing', 'exif', 'done', 'failed', 'cancelled')
+
+  def __init__(self, input_images, masks, output_name, settings, events, name = None, interactive = False,
+               aligned_images = None, sweep = None):
+    self.id = None          # set by JobEngine.submit()
+    self.input_images = list(input_images)
+    self.masks = copy.deepcopy(masks)
+    self.output_name = output_name
+    self.settings = settings
+    self.events = events
+    self.name = name or os.path.basename(output_name)
+    self.interactive = interactive   # started with the Stack button rather than queued
+    self.log_lines = []     # the job's messages, collected by whoever reads the events
+    self.aligned_images = aligned_images   # already aligned by ECC (e.g. by FolderWatcher), skips aligning
+    self.sweep = sweep or []   # [(label, settings)] of parse_sweep, fused concurrently instead of the output
+
+    self.state = 'queued'
+    self.progress = None    # (done, total) of the current stage, if known
+    self.error = None
+    self.preview = None     # {'output': ..., 'input': ...} reduced RGB arrays, for interactive jobs
+
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()   # protects subprocesses/aligner against cancel()
+    self.subprocesses = set()
+    self.aligner = None
+    self.engine = None      # set by JobEngine.submit()
+    self.manifest = None    # RunManifest of the checkpoints, while running
+    self.scratch = None     # the stack's folder in the scratch area, None: intermediates next to the inputs
+    self.prefetched = {}    # input filepath ==> future of its copy in the scratch folder
+
+
+  def post(self, event_type, **kwargs):
+    event = {'type': event_type, 'job': self.id}
+    event.update(kwargs)
+    self.events.put(event)
+
+
+  def log(self, msg):
+    self.post('message', msg=msg)
+
+
+  def set_state(self, state):
+    self.state = state
+    self.progress = None
+    self.post('state', state=state)
+
+
+  def set_progress(self, done, total):
+    self.progress = (done, total)
+    self.post('progress', done=done, total=total)
+
+
+  def status(self):
+    """ state and progress of the current stage """
+    text = self.state
+
+    if self.progress:
+      text += ' ' + str(self.progress[0]) + '/' + str(self.progress[1])
+
+    return text
+
+
+  def describe(self):
+    """ short status shown in the GUI """
+    return 'Job ' + str(self.id) + ': ' + self.status()
+
+
+  def is_finished(self):
+    return self.state in ('done', 'failed', 'cancelled')
+
+
+  def check_cancelled(self):
+    if self.cancelled.is_set():
+      raise JobCancelled()
+
+
+  def cancel(self):
+    """ cancel the job, killing its running subprocesses or pool workers (called from the Tk thread) """
+    self.cancelled.set()
+
+    with self.lock:
+      for p in self.subprocesses:
+        p.kill()
+
+      if self.aligner:
+        self.aligner.cancel()
+
+
+  def run(self):
+    """ entry point, executed by the JobEngine's thread """
+    try:
+      self.check_cancelled()
+      self.stack()
+      self.set_state('done')
+    except JobCancelled:
+      self.set_state('cancelled')
+    except Exception as e:
+      self.error = str(e)
+      self.log('\n\n' + self.error + '\n')
+      self.set_state('failed')
+
+    self.post('finished', state=self.state)
+
+
+  def stack(self):
+    """ perform optional alignment and fusing the images """
+    s = self.settings
+
+    has_mask = False
+    for filepath in self.masks:
+      if len(self.masks[filepath]) > 0:
+        has_mask = True
+        break
+
+    masks_applied = False  # True if the aligner already wrote the masked images
+
+    reference = self.check_inputs()
+    exif_source = self.input_images[0]
+    capture_positions = {filepath: i for i, filepath in enumerate(self.input_images)}   # before the pre-pass
+    anchor = None
+    crop = None   # [x, y, width, height] of the canvas kept by the ECC autocrop
+
+    # checkpoints of the stages and frames completed, to pick up from after a restart
+    self.manifest = manifest = RunManifest(self.output_name, self.run_key())
+    if manifest.entries:
+      self.log('\nUsing the checkpoints of a previous run\n')
+
+    if s['en_prefs_scratch'].strip() and self.aligned_images is None:
+      self.setup_scratch(s['en_prefs_scratch'].strip(), s['ck_prefs_prefetch'])
+
+    if s['ck_prepass'] and self.aligned_images is None:
+      prepass = manifest.get('prepass')
+
+      if prepass:
+        self.input_images, anchor = prepass['order'], prepass['anchor']
+        self.log('\nUsing the focus pre-pass of a previous run\n')
+      else:
+        anchor = self.order_frames()
+        manifest.put('prepass', {'order': self.input_images, 'anchor': anchor})
+
+    images = self.input_images
+
+    if self.aligned_images is not None:
+      self.log('\nUsing the images aligned as they arrived\n')
+      images = aligned_images = self.aligned_images
+
+    elif s['ck_align']:
+      self.set_state('aligning')
+      aligned_prefix = s['en_prefs_align_prefix']
+
+      if s['cb_stack_aligner'] == 'align_image_stack':
+        aligned_images = []
+
+        for i, image in enumerate(self.input_images):
+          aligned_images.append(os.path.join(
+            self.scratch or os.path.dirname(image),
+            aligned_prefix + '{:04d}'.format(i) + '.tif'))
+
+        align_cmd = self.build_align_command()
+        print(align_cmd)
+
+        checkpoint = 'align_image_stack/' + digest(align_cmd)
+        if manifest.get(checkpoint):
+          self.log('\nUsing the images aligned by a previous run\n')
+        else:
+          if self.execute_cmd(align_cmd) > 0:
+            raise Exception('Error aligning images, please check output log.')
+
+          manifest.put(checkpoint, True, aligned_images)
 
       else:  # ECC alignment
-        self.opencv_aligner = OpenCV_Aligner()
         ecc_options = {
           'prefix'      : aligned_prefix,
-          'iteration'   : int(w['sp_ecc_iterations'].var.get()),
-          'ter_eps'     : float(w['sp_ecc_ter_eps'].var.get()),
-          'pool_size'   : int(w['sp_ecc_pool'].var.get()),
-          'signaler'    : self.returncode,
-          'align_images': [],
-          'logger'      : w['tx_log']
+          'iteration'   : int(s['sp_ecc_iterations']),
+          'ter_eps'     : float(s['sp_ecc_ter_eps']),
+          'pool_size'   : int(s['sp_ecc_pool']),
+          'interpolation': s['cb_ecc_interpolation'],
+          'remap_cache' : s['ck_ecc_remap_cache'],
+          'motion'      : s['cb_ecc_motion'],
+          'timeout'     : int(s['sp_ecc_timeout']),
+          'autocrop'    : s['ck_ecc_autocrop'],
+          'folder'      : self.scratch,
+          'source'      : self.source,
+          'memory'      : self.engine.memory,
+          'workers'     : self.engine.ecc_workers,
+          'job'         : self.id,
+          'log'         : self.log,
+          'progress'    : self.set_progress
         }
 
-        w['tx_log'].insert(tk.END, '\n======== Aligning images using ECC ======== ')
-        w['tx_log'].see(tk.END)
+        if anchor is not None:
+          ecc_options['anchor'] = anchor
+        anchor_index = ecc_options.get('anchor', math.floor(len(self.input_images)/2))
+
+        # warp and apply masks in a single pass, written out as RGBA intermediates
+        if has_mask:
+          ecc_options['masks'] = self.build_file_masks()
+          masks_applied = True
+
+        # the warps solved by a previous run with the same ECC options and anchor are reused, and
+        # the frames it wrote are skipped unless their masks or the folder of the intermediates
+        # changed: those are only warped again
+        solve_key = digest([ecc_options['iteration'], ecc_options['ter_eps'], ecc_options['motion'],
+                            self.input_images[anchor_index]])
+        solved_checkpoint = 'warp/' + solve_key + '/'
+        checkpoint = 'ecc/' + digest([solve_key, ecc_options['prefix'], ecc_options['interpolation'],
+                                      ecc_options['autocrop'], has_mask, self.scratch]) + '/'
+        input_images = self.input_images
+        mask_keys = self.frame_mask_keys(ecc_options.get('masks', {}))
+        solved = {}
+        done = {}
+
+        for i, filepath in enumerate(input_images):
+          warp = manifest.get(solved_checkpoint + filepath)
+          if warp:
+            solved[i] = warp
+
+          frame = manifest.get(checkpoint + filepath)
+          if frame and frame['masks'] == mask_keys[filepath]:
+            done[i] = frame
+
+        if len(solved) > 0:
+          self.log('\n' + str(len(solved)) + ' of ' + str(len(input_images)) + ' images solved by a previous run, ' +
+                   str(len(done)) + ' of them unchanged')
+
+        def frame_done(i, aligned, warp, crop):
+          manifest.put(solved_checkpoint + input_images[i], warp)
+          if aligned:
+            manifest.put(checkpoint + input_images[i],
+                         {'warp': warp, 'crop': crop, 'masks': mask_keys[input_images[i]]}, [aligned])
+
+        ecc_options['warps'] = solved
+        ecc_options['done'] = done
+        ecc_options['frame_done'] = frame_done
+
+        # start from the warps of a previous stack of the same rig and lens setup
+        rig = s['cb_ecc_rig'].strip()
+        positions = [capture_positions[filepath] for filepath in self.input_images]
+        if rig:
+          lens = rig_lens_key(self.engine.exiftool(s['en_exec_exiftool']).read_tags(
+                                self.input_images[:1], RIG_LENS_TAGS).get(self.input_images[0], {}))
+          frames = load_rig_profiles().get(rig, {}).get(lens)
+
+          if frames:
+            ecc_options['initial_warps'] = rig_initial_warps(frames, positions, anchor_index)
+            self.log('\nStarting from the warps of rig profile "' + rig + '" for ' + lens)
+          else:
+            self.log('\nNo warps yet in rig profile "' + rig + '" for ' + lens)
+
+        self.log('\n======== Aligning images using ECC ======== ')
+
+        with self.lock:
+          self.check_cancelled()
+          self.aligner = aligner = OpenCV_Aligner()
+
+        aligned_images = aligner.align(self.input_images, ecc_options)
+
+        with self.lock:
+          self.aligner = None
+
+        crop = aligner.crop
+
+        if rig and s['ck_ecc_rig_update'] and aligned_images is not None:
+          try:
+            if save_rig_warps(rig, lens, aligner.warps, anchor_index, positions):
+              self.log('\nSaved the solved warps to rig profile "' + rig + '"')
+            else:
+              self.log('\nNot saving rig profile "' + rig + '": neither its first frame nor any frame it ' +
+                       'already has was aligned')
+          except OSError as e:
+            self.log('\nCould not save rig profile "' + rig + '": ' + str(e))
+
+        # the frames that couldn't be aligned are left out of the stack
+        if aligned_images is not None and aligner.failed:
+          self.input_images = [filepath for filepath in self.input_images if filepath not in aligner.failed]
+          self.log('\nLeft out of the stack: ' + ', '.join(os.path.basename(f) for f in aligner.failed) + '\n')
+
+      self.check_cancelled()
+      self.log('\n\nDone aligning all images\n')
+      images = aligned_images
+
+    # generate masked images
+    if not has_mask:
+      self.log('\n\n===== NO MASK FOUND =====\n\n')
+    elif masks_applied:
+      self.log('\n\n===== MASKS APPLIED DURING ALIGNMENT =====\n\n')
+    else:
+      self.set_state('masking')
+      self.log('\n\n===== APPLYING MASK =====\n\n')
+      images = self.apply_masks_to_images(images)
+      self.check_cancelled()
+
+
+    # call enfuse, keeping the bit depth of the inputs
+    self.set_state('fusing')
+
+    # unaligned and unmasked inputs are fused from their local copies
+    images = [self.source(filepath) for filepath in images]
+
+    if len(self.sweep) == 0:
+      checkpoints = [self.fuse(images, reference['depth'], self.output_name)]
+
+    else:
+      # the variants of a sweep share the aligned and masked images, and run concurrently within
+      # the enfuse limit
+      self.log('\n\nFusing ' + str(len(self.sweep)) + ' variants of the enfuse settings\n')
+      self.set_progress(0, len(self.sweep))
+
+      with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.sweep), thread_name_prefix='sweep') as executor:
+        futures = [executor.submit(self.fuse, images, reference['depth'], sweep_output_name(self.output_name, label),
+                                   settings, '[' + label + '] ') for label, settings in self.sweep]
+
+        for completed, future in enumerate(concurrent.futures.as_completed(futures), 1):
+          self.set_progress(completed, len(futures))
+
+      # re-raise the first error, once all the variants are over
+      checkpoints = [future.result() for future in futures]
+
+    outputs = [sweep_output_name(self.output_name, label) for label, settings in self.sweep] or [self.output_name]
+
+    # reduced previews for the GUI, so that it doesn't have to decode the output
+    if self.interactive:
+      try:
+        if len(self.sweep) > 0:
+          # no single output to compare with the input: the variants side by side instead
+          self.preview = {
+            'output': preview_grid([image_preview(output) for output in outputs],
+                                   [label for label, settings in self.sweep])
+          }
+        else:
+          self.preview = {
+            'output': image_preview(self.output_name),
+            'input' : image_preview(exif_source)
+          }
+
+        # the same part of the input as the output, when cropped
+        if crop and 'input' in self.preview:
+          scale = self.preview['input'].shape[1] / reference['width']
+          x, y, width, height = [round(value * scale) for value in crop]
+          self.preview['input'] = self.preview['input'][y:y + height, x:x + width]
+      except (OSError, cv2.error) as e:
+        self.log('\nNo preview: ' + str(e) + '\n')
+
+
+    # copy EXIF
+    self.set_state('exif')
+    for output in outputs:
+      self.log('\nCopying EXIF from ' + exif_source + ' to ' + output + '\n\n')
+
+      self.log(self.engine.exiftool(s['en_exec_exiftool']).execute(
+        '-TagsFromFile', exif_source, '-all:all', '-overwrite_original', output))
+      self.check_cancelled()
+
+    if s['ck_prefs_incremental']:
+      # keep the intermediates and the checkpoints, with the outputs as their EXIF left them, so
+      # that stacking again only redoes the frames whose inputs or masks changed
+      for checkpoint, output in zip(checkpoints, outputs):
+        manifest.put(checkpoint, True, images + [output])
+
+      self.log('\nKept the intermediates for restacking\n\n')
+      return
+
+    # clean up aligned TIFFs
+    if masks_applied:
+      # aligned and masked images are the same files
+      if not s['ck_keep_aligned'] and not s['ck_keep_masked']:
+        for filename in images:
+          os.remove(filename)
+        self.log('\nRemoved aligned/masked images \n\n')
+
+    elif s['ck_align'] and not s['ck_keep_aligned']:
+      for filename in aligned_images:
+        os.remove(filename)
+      self.log('\nRemoved aligned images \n\n')
+
+    # clean up masked TIFFs
+    if has_mask and not masks_applied and not s['ck_keep_masked']:
+      for filename in images:
+        os.remove(filename)
+      self.log('\nRemoved masked images \n\n')
+
+    if self.scratch:
+      self.remove_scratch()
+
+    manifest.remove()
+
+
+  def fuse(self, images, depth, output_name, settings = None, prefix = ''):
+    """ run enfuse on images to output_name, with the job's settings updated by settings, unless
+        a previous run of the job already did. prefix: of the log lines, for concurrent runs.
+        Return the name of the checkpoint """
+    enfuse_cmd = self.build_enfuse_command(images, depth, output_name, dict(self.settings, **(settings or {})))
+    print(enfuse_cmd)
+
+    checkpoint = 'enfuse/' + digest(enfuse_cmd)
+    if self.manifest.get(checkpoint):
+      self.log('\n\nUsing ' + output_name + ' fused by a previous run\n\n')
+      return checkpoint
+
+    # enfuse runs are limited across jobs
+    if not self.engine.enfuse_slots.acquire(1):
+      self.log('\n\n' + prefix + 'Waiting for another stack to finish fusing...\n')
+      if not self.engine.enfuse_slots.wait(1, self.cancelled):
+        raise JobCancelled()
+
+    try:
+      self.log('\n\n===== CALLING ENFUSE =====\n')
+      self.log('output to ' + output_name + '\n\n')
+
+      if self.execute_cmd(enfuse_cmd, prefix) > 0:
+        raise Exception('Error stacking images to ' + os.path.basename(output_name) + ', please check output log.')
+    finally:
+      self.engine.enfuse_slots.release(1)
+
+    self.manifest.put(checkpoint, True, images + [output_name])
+    self.log('\nDone stacking to ' + output_name + '\n\n')
+    return checkpoint
+
+
+  def setup_scratch(self, root, prefetch):
+    """ use a folder of the scratch area for the intermediates, named after the stack so that a
+        resumed run finds them, and optionally copy the inputs there in the background """
+    basenames = [os.path.basename(filepath) for filepath in self.input_images]
+    if len(set(basenames)) < len(basenames):
+      self.log('\nInputs with the same name in different folders, writing the intermediates next to them\n')
+      return
+
+    prune_scratch(root)
+    self.scratch = os.path.join(root, 'mftker-' + self.manifest.key)
+    os.makedirs(self.scratch, exist_ok=True)
+    self.log('\nWriting the intermediates to ' + self.scratch + '\n')
+
+    if prefetch:
+      folder = os.path.join(self.scratch, 'inputs')
+      os.makedirs(folder, exist_ok=True)
+
+      executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+      for filepath in self.input_images:
+        self.prefetched[filepath] = executor.submit(copy_file, filepath, folder, self.cancelled)
+      executor.shutdown(wait=False)
+
+
+  def source(self, filepath):
+    """ where to read an input from: its prefetched copy once complete, else the file itself """
+    future = self.prefetched.get(filepath)
+    if future is None:
+      return filepath
+
+    try:
+      return future.result()
+    except OSError as e:
+      self.log('\nCould not copy ' + os.path.basename(filepath) + ' to the scratch area: ' + str(e) + '\n')
+      del self.prefetched[filepath]
+      return filepath
+
+
+  def remove_scratch(self):
+    """ remove the prefetched inputs and the stack's scratch folder, unless intermediates were kept """
+    for future in self.prefetched.values():
+      future.cancel()
+    self.prefetched = {}
+
+    rmtree(os.path.join(self.scratch, 'inputs'), ignore_errors=True)
+
+    try:
+      os.rmdir(self.scratch)
+    except OSError:
+      self.log('\nKept the intermediates in ' + self.scratch + '\n')
+
+
+  def run_key(self):
+    """ identity of the stack for its checkpoints: the inputs' fingerprints. The masks are part of
+        the checkpoints of each frame, so that editing them only invalidates the frames they cover """
+    return digest([[filepath, file_fingerprint(filepath)] for filepath in self.input_images])
+
+
+  def frame_mask_keys(self, file_masks):
+    """ digest of the masks rasterized on each input (see build_file_masks), indexed by filepath """
+    return {filepath: digest([[mask['type'], polygon_array(mask['mask']).tolist()]
+                              for mask in file_masks.get(filepath, [])])
+            for filepath in self.input_images}
+
+
+  def order_frames(self):
+    """ focus pre-pass on small proxies: order the frames by focus distance, drop the ones that
+        only cost time (duplicates, nothing in focus) and pick the sharpest one as the ECC anchor.
+        Updates self.input_images and returns the index of the anchor """
+    s = self.settings
+    self.set_state('analysing')
+    self.log('\n===== FOCUS PRE-PASS =====\n')
+
+    images = self.input_images
+
+    # a few threads are enough, the proxies of JPEGs are decoded at reduced size
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      profiles = dict(zip(images, executor.map(lambda filepath: focus_profile(self.source(filepath)), images)))
+
+    self.check_cancelled()
+
+    # order by focus distance when the camera recorded it for every frame
+    try:
+      info = self.engine.exiftool(s['en_exec_exiftool']).capture_info(images)
+      distances = [info[filepath]['focus_distance'] for filepath in images]
+    except (OSError, ValueError):
+      distances = [None]
+
+    if None not in distances and len(set(distances)) > 1:
+      images = sorted(images, key=lambda filepath: info[filepath]['focus_distance'])
+      self.log('Ordered by focus distance\n')
+    else:
+      self.log('No focus distance recorded, keeping the given order\n')
+
+    # per tile, the best sharpness of the stack. Tiles without detail in any frame are ignored
+    best = np.max([profile['tiles'] for profile in profiles.values()], axis=0)
+    detailed = best >= 0.1 * best.max()
+
+    kept = []
+    for i, filepath in enumerate(images):
+      tiles = profiles[filepath]['tiles']
+      reason = None
+
+      if len(kept) > 0:
+        previous = profiles[kept[-1]]['tiles']
+        if (np.abs(tiles - previous) <= 0.03 * (tiles + previous)).all():
+          reason = 'duplicate of ' + os.path.basename(kept[-1])
+
+      if reason is None and not (tiles[detailed] >= 0.25 * best[detailed]).any():
+        reason = 'out of focus'
+
+      # frames with masks are the user's choice, and at least 2 frames are needed
+      remaining = len(kept) + len(images) - i
+      if reason and len(self.masks.get(filepath, [])) == 0 and remaining > 2:
+        self.log('Dropped ' + os.path.basename(filepath) + ': ' + reason + '\n')
+        continue
+
+      kept.append(filepath)
+
+    self.input_images = kept
+
+    anchor = max(range(len(kept)), key=lambda i: profiles[kept[i]]['sharpness'])
+    self.log('Sharpest frame: ' + os.path.basename(kept[anchor]) + '\n')
+
+    return anchor
+
+
+  def check_inputs(self):
+    """ probe the headers of the input images, failing early if any of them can't be read or
+        stacked with the others. Return the probe of the first image """
+    probes = probe_images(self.input_images)
+    reference = None
+
+    for filepath in self.input_images:
+      probe = probes[filepath]
+
+      if isinstance(probe, Exception):
+        raise Exception('Cannot read ' + os.path.basename(filepath) + ': ' + str(probe))
+
+      if reference is None:
+        reference = probe
+
+      mismatch = image_mismatch(reference, probe)
+      if mismatch:
+        raise Exception('Cannot stack ' + os.path.basename(filepath) + ': ' + mismatch)
+
+    return reference
+
+
+  def execute_cmd(self, cmd, prefix = ''):
+    """ run cmd, sending its output to the log with each line prefixed. Return the exit code """
+    working_dir = self.scratch or os.path.dirname(self.input_images[0])
+
+    with self.lock:
+      self.check_cancelled()
+      p = subprocess.Popen(cmd, cwd=working_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      self.subprocesses.add(p)
+
+    for line in p.stdout:
+      self.log(prefix + line.decode(errors='replace'))
+
+    p.wait()
+
+    with self.lock:
+      self.subprocesses.discard(p)
+
+    self.check_cancelled()
+    return p.returncode
+
+
+  def build_align_command(self):
+    s = self.settings
+
+    align_exec = s['en_exec_align']
+    align_prefix = s['en_prefs_align_prefix']
+
+    if self.scratch:
+      align_prefix = os.path.join(self.scratch, align_prefix)
+
+    cmd = [align_exec, '-v', '-a'+align_prefix, '--use-given-order', '--distortion']
+
+    if s['ck_prefs_align_gpu']:
+      cmd.append('--gpu')
+
+    # get the alignment options
+
+    if s['ck_autocrop']:
+      cmd.append('-C')
+
+    if s['ck_centershift']:
+      cmd.append('-i')
+
+    if s['ck_fov']:
+      cmd.append('-m')
+
+    cmd.append('--corr=' + str(s['sp_corr_threshold']))
+    cmd.append('-t ' + str(s['sp_error_threshold']))
+    cmd.append('-c ' + str(s['sp_control_points']))
+    cmd.append('-g ' + str(s['sp_grid_size']))
+    cmd.append('-s ' + str(s['sp_scale_factor']))
+
+    cmd = cmd + [self.source(filepath) for filepath in self.input_images]
+    return cmd
+
+
+
+  def build_enfuse_command(self, images, depth = '8', output_name = None, settings = None):
+    """ depth: bit depth of the images (see probe_image), kept in the output where the format allows.
+        output_name and settings default to the job's """
+    s = settings or self.settings
+
+    cmd = [s['en_exec_enfuse'], '-v', '-o', output_name or self.output_name,
+           '--exposure-weight=0',
+           '--saturation-weight=0',
+           '--contrast-weight=1',
+           '--blend-colorspace=CIECAM']
+
+    if s['ck_hard_mask']:
+      cmd.append('--hard-mask')
+
+    if not s['ck_levels']:
+      cmd.append('--levels=' + str(s['sp_levels']))
+
+    if s['ck_edge_scale']:
+      opt = str(s['sp_edge_scale']) + ':'
+      opt += str(s['sp_lce_scale']) + ('%' if s['ck_lce_scale'] else '')
+      opt += ':' + str(s['sp_lce_level']) + ('%' if s['ck_lce_level'] else '')
+      cmd.append('--contrast-edge-scale=' + opt)
+
+    if s['ck_curvature']:
+      cmd.append('--contrast-min-curvature=' + str(s['sp_curvature']) +
+                 ('%' if s['ck_curvature_pc'] else ''))
+
+    cmd.append('--gray-projector=' + str(s['cb_gray_proj']))
+    cmd.append('--contrast-window-size=' + str(s['sp_window_size']))
+
+    if s['cb_file_format'] == 'JPG':
+      cmd.append('--compression=' + str(s['sp_jpg_quality']))
+      if depth != '8':
+        cmd.append('--depth=8')  # JPEG only supports 8-bit
+    else:
+      cmd.append('--compression=' + str(s['cb_tif_compression']))
+      if depth != '8':
+        cmd.append('--depth=' + depth)
+
+    cmd = cmd + images
+    return cmd
+
+
+
+  def build_file_masks(self):
+    """ return the masks to rasterize for each input image, indexed by filepath """
+    # each "include" mask is equivalent to "exclude" masks for each of the other images
+    file_masks = copy.deepcopy(self.masks)
+
+    for filepath in self.masks:
+      for mask in file_masks[filepath]:
+        if mask['type'] == 'include':
+          for other_filepath in self.input_images:
+            if filepath != other_filepath:
+              exclude_mask = copy.deepcopy(mask)
+              exclude_mask['type'] = 'exclude'
+
+              if other_filepath not in file_masks:
+                file_masks[other_filepath] = []
+
+              file_masks[other_filepath].append(exclude_mask)
+
+    return file_masks
+
+
+  def apply_masks_to_images(self, images):
+    """ applied masks to images, assuming that they are aligned """
+    masked_images = []
+
+    # images might have different filename/path from original input
+    images_map = {}
+    for i, filepath in enumerate(self.input_images):
+      images_map[filepath] = images[i]
+
+    file_masks = self.build_file_masks()
+    mask_keys = self.frame_mask_keys(file_masks)
+    reused = 0
+
+    for i, filepath in enumerate(self.input_images):
+      self.check_cancelled()
+
+      new_path = masked_filepath(images_map[filepath], self.scratch)
+      checkpoint = 'masked/' + filepath
+
+      # a masked image is only written again if its aligned image, its masks or the folder of
+      # the intermediates changed
+      frame = self.manifest.get(checkpoint)
+      if frame is None or frame['masks'] != mask_keys[filepath] or frame['filepath'] != new_path:
+        # important: treat every image as having mask. Our outputs might have
+        # different format/setting than the original, don't mix them
+        img = read_image(self.source(images_map[filepath]))
+
+        alpha = rasterize_masks((img.shape[1], img.shape[0]), file_masks.get(filepath, []))
+
+        write_with_alpha(new_path, img, alpha)
+        self.manifest.put(checkpoint, {'filepath': new_path, 'masks': mask_keys[filepath]},
+                          [images_map[filepath], new_path])
+      else:
+        reused += 1
+
+      masked_images.append(new_path)
+      self.set_progress(i + 1, len(self.input_images))
+
+    if reused > 0:
+      self.log(str(reused) + ' of ' + str(len(self.input_images)) + ' masked images unchanged since a previous run\n')
+
+    return masked_images
+
+
+
+SCRATCH_MAX_AGE = 7 * 24 * 3600   # seconds, stack folders of the scratch area unused for longer are removed
+
+def prune_scratch(root):
+  """ remove the stack folders of the scratch area left by runs that were never resumed """
+  for filename in os.listdir(root):
+    path = os.path.join(root, filename)
+
+    try:
+      if filename.startswith('mftker-') and time.time() - os.path.getmtime(path) > SCRATCH_MAX_AGE:
+        rmtree(path)
+    except OSError:
+      pass
+
+
+def copy_file(filepath, folder, cancelled):
+  """ copy filepath into folder, keeping its mtime, unless an identical copy is already there.
+      Return the filepath of the copy """
+  target = os.path.join(folder, os.path.basename(filepath))
+  if file_fingerprint(target) == file_fingerprint(filepath):
+    return target
+
+  if cancelled.is_set():
+    raise OSError('cancelled')
+
+  copy2(filepath, target + '.part')
+  os.replace(target + '.part', target)
+  return target
+
+
+def file_fingerprint(filepath):
+  """ [size, mtime in ns] of a file, None if it doesn't exist """
+  try:
+    stat = os.stat(filepath)
+  except OSError:
+    return None
+
+  return [stat.st_size, stat.st_mtime_ns]
+
+
+def digest(value):
+  """ short hash of a JSON-serializable value """
+  return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class RunManifest():
+  """ checkpoints of a StackJob, kept next to its output until the job is done: the stages and
+      frames completed, with the fingerprints of the files they wrote. The manifest belongs to a
+      key of the job's inputs, so that a restart of the same stack picks up the checkpoints that
+      are still valid and a different stack starts over """
+
+  def __init__(self, output_name, key):
+    self.filepath = os.path.join(os.path.dirname(output_name), '.' + os.path.basename(output_name) + '.run.json')
+    self.key = key
+    self.entries = {}
+    self.lock = threading.Lock()   # concurrent enfuse runs of a sweep record their checkpoints
+
+    try:
+      with open(self.filepath) as infile:
+        data = json.load(infile)
+
+      if data.get('key') == key:
+        self.entries = data['entries']
+    except (OSError, ValueError, KeyError):
+      pass
+
+
+  def get(self, name):
+    """ value of a checkpoint, None if there is none or if a file it wrote has changed since """
+    entry = self.entries.get(name)
+
+    if entry is None:
+      return None
+
+    for filepath, fingerprint in entry['files'].items():
+      if file_fingerprint(filepath) != fingerprint:
+        return None
+
+    return entry['value']
+
+
+  def put(self, name, value, files = ()):
+    """ record a checkpoint, once the files it wrote are complete """
+    with self.lock:
+      self.entries[name] = {'value': value, 'files': {filepath: file_fingerprint(filepath) for filepath in files}}
+
+      temp_filepath = self.filepath + '.tmp'
+      with open(temp_filepath, 'w') as outfile:
+        json.dump({'key': self.key, 'entries': self.entries}, outfile)
+      os.replace(temp_filepath, self.filepath)
+
+
+  def remove(self):
+    self.entries = {}
+
+    if os.path.exists(self.filepath):
+      os.remove(self.filepath)
+
+
+
+class JobEngine():
+  """ runs StackJobs on background threads in the order they are submitted, up to max_jobs at
+      a time. The running jobs share one ECC memory budget and worker limit, and the enfuse limit """
+
+  def __init__(self, max_jobs = 1):
+    # dispatch() limits the running jobs, the executor only provides the threads
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='stack')
+    self.jobs = collections.OrderedDict()   # all submitted jobs, indexed by id
+    self.pending = collections.deque()      # jobs waiting for a free slot
+    self.running = 0
+    self.max_jobs = max_jobs
+    self.next_id = 1
+    self.lock = threading.Lock()
+
+    # shared by the running jobs, sized by configure()
+    self.memory       = ResourceBudget(8 * 2**30)
+    self.ecc_workers  = ResourceBudget(max(1, math.floor(mp.cpu_count()/2)))
+    self.enfuse_slots = ResourceBudget(1)
+
+    self.exiftools = {}   # shared ExifTool per executable
+
+
+  def exiftool(self, executable):
+    """ the ExifTool shared by all the jobs for the given executable """
+    with self.lock:
+      if executable not in self.exiftools:
+        self.exiftools[executable] = ExifTool(executable)
+
+      return self.exiftools[executable]
+
+
+  def configure(self, settings, max_jobs = None):
+    """ apply the concurrency limits from settings (see App.get_settings()), max_jobs overrides
+        the number of concurrent stacks """
+    self.max_jobs = min(32, max(1, int(max_jobs or settings['sp_queue_jobs'])))
+    self.enfuse_slots.budget = max(1, int(settings['sp_queue_enfuse']))
+    self.ecc_workers.budget = max(1, int(settings['sp_ecc_pool']))
+    self.memory.budget = int(settings['sp_ecc_mem_budget']) * 2**30
+
+    # more jobs may fit now
+    self.dispatch()
+
+
+  def submit(self, job):
+    with self.lock:
+      job.id = self.next_id
+      job.engine = self
+      self.next_id += 1
+
+      self.jobs[job.id] = job
+      self.pending.append(job)
+
+    job.post('state', state=job.state)
+    self.dispatch()
+    return job
+
+
+  def dispatch(self):
+    """ start pending jobs while there are free slots """
+    with self.lock:
+      while len(self.pending) > 0 and self.running < self.max_jobs:
+        self.running += 1
+        self.executor.submit(self.run_job, self.pending.popleft())
+
+
+  def run_job(self, job):
+    try:
+      job.run()
+    finally:
+      with self.lock:
+        self.running -= 1
+
+      self.dispatch()
+
+
+  def active_jobs(self):
+    """ jobs that are queued or running """
+    return [job for job in list(self.jobs.values()) if not job.is_finished()]
+
+
+  def cancel(self, job_id = None):
+    """ cancel the given job, or all the active jobs """
+    for job in self.active_jobs():
+      if job_id is not None and job.id != job_id:
+        continue
+
+      with self.lock:
+        pending = job in self.pending
+        if pending:
+          self.pending.remove(job)
+
+      if pending:
+        # never started, report it as the running jobs do
+        job.set_state('cancelled')
+        job.post('finished', state=job.state)
+      else:
+        job.cancel()
+
+
+  def forget_finished(self):
+    """ drop the finished jobs, return their ids """
+    with self.lock:
+      finished = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+
+      for job_id in finished:
+        del self.jobs[job_id]
+
+    return finished
+
+
+  def shutdown(self):
+    self.cancel()
+    self.executor.shutdown(wait=False)
+
+    for exiftool in self.exiftools.values():
+      exiftool.close()
+
+
+
+class ExifTool():
+  """ a long-lived exiftool process in -stay_open mode, saving the Perl startup of one exiftool
+      per command. Thread-safe, the commands are executed one at a time """
+
+  def __init__(self, executable = 'exiftool'):
+    self.executable = executable
+    self.process = None
+    self.lock = threading.Lock()
+    self.count = 0
+
+
+  def start(self):
+    self.process = subprocess.Popen([self.executable, '-stay_open', 'True', '-@', '-'],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+  def execute(self, *args):
+    """ run exiftool with args, return its output (stdout then stderr) """
+    with self.lock:
+      if self.process is None or self.process.poll() is not None:
+        self.start()
+
+      # the numbered -execute and -echo4 mark the end of the output on both streams
+      self.count += 1
+      ready = '{ready' + str(self.count) + '}'
+      command = list(args) + ['-echo4', ready, '-execute' + str(self.count)]
+
+      self.process.stdin.write(('\n'.join(command) + '\n').encode())
+      self.process.stdin.flush()
+
+      return self.read_until(self.process.stdout, ready) + self.read_until(self.process.stderr, ready)
+
+
+  def read_until(self, stream, ready):
+    lines = []
+
+    for line in stream:
+      line = line.decode(errors='replace')
+      if line.strip() == ready:
+        break
+      lines.append(line)
+    else:
+      # end of stream without the marker, the process died
+      raise OSError('exiftool exited unexpectedly')
+
+    return ''.join(lines)
+
+
+  def read_tags(self, filepaths, tags):
+    """ values of the given tags (numeric where possible), indexed by filepath """
+    output = self.execute('-json', '-n', *(['-' + tag for tag in tags] + list(filepaths)))
+    output = output[:output.rfind(']') + 1]  # drop the error messages, if any
+
+    values = {}
+    for item in json.loads(output or '[]'):
+      values[os.path.normpath(item.pop('SourceFile'))] = item
+
+    return {filepath: values.get(os.path.normpath(filepath), {}) for filepath in filepaths}
+
+
+  def capture_info(self, filepaths):
+    """ capture time (timestamp) and focus distance of each image, None when not recorded """
+    info = {}
+
+    for filepath, tags in self.read_tags(filepaths, ['DateTimeOriginal', 'SubSecTimeOriginal', 'FocusDistance']).items():
+      timestamp = None
+      try:
+        timestamp = time.mktime(time.strptime(str(tags['DateTimeOriginal']).strip(), '%Y:%m:%d %H:%M:%S'))
+        subsec = str(tags.get('SubSecTimeOriginal', '')).strip()
+        if subsec.isdigit():
+          timestamp += float('0.' + subsec)
+      except (KeyError, ValueError):
+        pass
+
+      focus_distance = tags.get('FocusDistance')
+      if not isinstance(focus_distance, (int, float)):
+        focus_distance = math.inf if str(focus_distance).lower() in ('inf', 'infinity') else None
+
+      info[filepath] = {
+        'timestamp'     : timestamp,
+        'focus_distance': focus_distance
+      }
+
+    return info
+
+
+  def close(self):
+    with self.lock:
+      if self.process is None or self.process.poll() is not None:
+        return
+
+      try:
+        self.process.stdin.write(b'-stay_open\nFalse\n')
+        self.process.stdin.flush()
+        self.process.wait(timeout=5)
+      except (OSError, subprocess.TimeoutExpired):
+        self.process.kill()
+
+
+
+class FolderWatcher():
+  """ polls a folder for new images, groups them into focus brackets and queues a StackJob for
+      each completed bracket. With ECC alignment, the frames are aligned against the first frame
+      of their bracket as they arrive, so that only fusing is left once the bracket is complete.
+      Reports as {'type': 'watch', 'msg': ...} events """
+
+  interval = 1   # seconds between polls
+
+  def __init__(self, folder, settings, engine, events):
+    self.folder = os.path.abspath(folder)
+    self.settings = settings
+    self.engine = engine
+    self.events = events
+
+    self.gap = float(settings['sp_watch_gap'])
+    self.frames_per_stack = int(settings['sp_watch_frames'])
+    self.by_sequence = settings['cb_watch_group'] == 'filename sequence'
+    self.incremental = settings['ck_align'] and settings['cb_stack_aligner'] == 'ECC'
+
+    self.seen = set(list_images(self.folder, settings))   # files already there are left alone
+    self.sizes = {}          # new files not yet ready, with their size at the previous poll
+    self.group = None        # the bracket being collected
+    self.stopped = threading.Event()
+    self.thread = None
+
+    self.aligner = OpenCV_Aligner()
+    self.aligner.prefix = settings['en_prefs_align_prefix']
+
+    # the frames aligned as they arrive go to the scratch area too
+    if settings['en_prefs_scratch'].strip():
+      self.aligner.folder = os.path.join(settings['en_prefs_scratch'].strip(), 'mftker-watch')
+      os.makedirs(self.aligner.folder, exist_ok=True)
+    self.pool = None
+    self.reserved = set()    # tasks holding ECC memory/worker reservations
+    self.lock = threading.Lock()
+
+
+  def post(self, msg):
+    self.events.put({'type': 'watch', 'msg': msg})
+
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='watch', daemon=True)
+    self.thread.start()
+
+
+  def stop(self):
+    self.stopped.set()
+
+
+  def run(self):
+    self.post('Watching ' + self.folder)
+
+    try:
+      if self.incremental:
+        self.pool = mp.Pool(max(1, int(self.settings['sp_ecc_pool'])))
+
+      while not self.stopped.wait(self.interval):
+        for filepath in self.ready_files():
+          try:
+            self.add_frame(filepath)
+          except Exception as e:
+            self.post('Skipped ' + os.path.basename(filepath) + ': ' + str(e))
+
+        # no new frame for a while, the bracket is complete
+        if self.group and time.time() - self.group['arrival'] > self.gap:
+          self.close_group()
+
+      msg = 'Stopped watching ' + self.folder
+    except Exception as e:
+      msg = 'Stopped watching ' + self.folder + ': ' + str(e)
+
+    if self.pool:
+      self.pool.terminate()
+
+    # the terminated tasks never call back
+    with self.lock:
+      for task in self.reserved:
+        self.release(task)
+      self.reserved.clear()
+
+    # drop the incomplete bracket along with what was aligned for it
+    if self.group:
+      for filepath in self.group['aligned']:
+        if os.path.exists(filepath):
+          os.remove(filepath)
+
+      msg += ', dropped ' + str(len(self.group['frames'])) + ' frames of an incomplete bracket'
+
+    self.post(msg)
+
+
+  def ready_files(self):
+    """ new files whose size didn't change since the previous poll """
+    ready = []
+
+    for filepath in list_images(self.folder, self.settings):
+      if filepath in self.seen:
+        continue
+
+      try:
+        size = os.path.getsize(filepath)
+      except OSError:
+        continue
+
+      if size > 0 and self.sizes.get(filepath) == size:
+        ready.append(filepath)
+        self.seen.add(filepath)
+        del self.sizes[filepath]
+      else:
+        self.sizes[filepath] = size
+
+    return ready
+
+
+  def capture_time(self, filepath):
+    """ capture time read by exiftool, which knows more formats/makers than PIL """
+    try:
+      timestamp = self.engine.exiftool(self.settings['en_exec_exiftool']).capture_info([filepath])[filepath]['timestamp']
+      if timestamp is not None:
+        return timestamp
+    except (OSError, ValueError):
+      pass
+
+    return capture_time(filepath)
+
+
+  def continues_group(self, filepath, timestamp):
+    group = self.group
+
+    if self.by_sequence:
+      match = re.match(r'(.*?)(\d+)$', os.path.splitext(os.path.basename(filepath))[0])
+      return match is not None and group['sequence'] is not None \
+             and match.group(1) == group['sequence'][0] and int(match.group(2)) == group['sequence'][1] + 1
+
+    return timestamp - group['timestamp'] <= self.gap
+
+
+  def add_frame(self, filepath):
+    probe = probe_image(filepath)  # raises on files that aren't readable images
+    timestamp = self.capture_time(filepath)
+
+    # a frame that can't be stacked with the bracket starts a new one
+    if self.group and (image_mismatch(self.group['probe'], probe) or not self.continues_group(filepath, timestamp)):
+      self.close_group()
+
+    match = re.match(r'(.*?)(\d+)$', os.path.splitext(os.path.basename(filepath))[0])
+    sequence = (match.group(1), int(match.group(2))) if match else None
+
+    if self.group is None:
+      group = {'frames': [], 'aligned': [], 'results': [], 'probe': probe}
+
+      if self.incremental:
+        # the first frame is the anchor, written out as-is as align() does
+        anchor_img = read_image(filepath)
+        cv2.imwrite(self.aligner.aligned_filepath(filepath, self.aligner.prefix), anchor_img)
+        group['task_memory'] = self.aligner.estimate_task_memory(probe, False, self.settings['ck_ecc_remap_cache'])
+
+      self.group = group
+
+    elif self.incremental:
+      self.align_frame(filepath)
+
+    group = self.group
+    group['frames'].append(filepath)
+    group['aligned'].append(self.aligner.aligned_filepath(filepath, self.aligner.prefix))
+    group['timestamp'] = timestamp
+    group['sequence'] = sequence
+    group['arrival'] = time.time()
+
+    self.post('Bracket of ' + os.path.basename(group['frames'][0]) + ': ' + str(len(group['frames'])) + ' frames')
+
+    if self.frames_per_stack > 0 and len(group['frames']) >= self.frames_per_stack:
+      self.close_group()
+
+
+  def align_frame(self, filepath):
+    """ align a frame against the anchor in the pool, within the ECC limits shared with the jobs """
+    group = self.group
+    memory = self.engine.memory
+    workers = self.engine.ecc_workers
+    task_memory = group['task_memory']
+
+    if not workers.wait(1, self.stopped):
+      return
+
+    if not memory.wait(task_memory, self.stopped):
+      workers.release(1)
+      return
+
+    task = (filepath, task_memory)
+    with self.lock:
+      self.reserved.add(task)
+
+    def done(result):
+      with self.lock:
+        if task in self.reserved:
+          self.reserved.remove(task)
+          self.release(task)
+
+    options = {
+      'prefix'       : self.aligner.prefix,
+      'iteration'    : int(self.settings['sp_ecc_iterations']),
+      'ter_eps'      : float(self.settings['sp_ecc_ter_eps']),
+      'interpolation': self.settings['cb_ecc_interpolation'],
+      'remap_cache'  : self.settings['ck_ecc_remap_cache'],
+      'motion'       : self.settings['cb_ecc_motion']
+    }
+
+    group['results'].append(self.pool.apply_async(self.aligner.align_pyramid, (group['frames'][0], filepath, options),
+                                                  callback=done, error_callback=done))
+
+
+  def release(self, task):
+    self.engine.ecc_workers.release(1)
+    self.engine.memory.release(task[1])
+
+
+  def close_group(self):
+    """ queue a stacking job for the current bracket """
+    group = self.group
+    self.group = None
+    frames = group['frames']
+
+    if len(frames) < 2:
+      self.post('Skipped ' + os.path.basename(frames[0]) + ': a single frame')
+      for filepath in group['aligned']:
+        if os.path.exists(filepath):
+          os.remove(filepath)
+      return
+
+    aligned_images = None
+
+    if self.incremental:
+      try:
+        for result in group['results']:
+          result.get()
+        aligned_images = group['aligned']
+      except Exception as e:
+        self.post('Error aligning ' + os.path.basename(frames[0]) + ' (' + error_reason(e) + '), the job aligns it again')
+
+    job = StackJob(frames, {}, default_output_name(frames, self.settings), self.settings, self.events,
+                   name=os.path.basename(frames[0]) + ' (' + str(len(frames)) + ' frames)',
+                   aligned_images=aligned_images)
+    self.engine.submit(job)
+
+    self.post('Queued job ' + str(job.id) + ': ' + job.name)
+
+
+
+# ==== helpers shared by the GUI and the worker processes ====
+
+def load_config():
+  """ read config.ini, with the defaults for all the settings """
+  c = configparser.ConfigParser()
+
+  if os.path.isfile('config.ini'):
+    c.read('config.ini')
+
+  c['DEFAULT'] = {
+    'ck_align'                : 'True',
+    'cb_stack_aligner'        : 'ECC',
+    'ck_prepass'              : 'False',
+    'sp_ecc_iterations'       : '50',
+    'sp_ecc_ter_eps'          : '1e-1',
+    'sp_ecc_pool'             : math.floor(mp.cpu_count()/2),
+    'cb_ecc_interpolation'    : 'linear',
+    'cb_ecc_motion'           : 'homography',
+    'cb_ecc_rig'              : '',
+    'ck_ecc_rig_update'       : 'True',
+    'ck_ecc_remap_cache'      : 'False',
+    'sp_ecc_timeout'          : '600',
+    'ck_ecc_autocrop'         : 'False',
+    'sp_ecc_mem_budget'       : max(1, math.floor(total_memory()/2**30/2)) if total_memory() > 0 else 8,
+    'ck_autocrop'             : 'True',
+    'ck_centershift'          : 'True',
+    'ck_fov'                  : 'True',
+    'sp_corr_threshold'       : '0.95',
+    'sp_error_threshold'      : '1',
+    'sp_control_points'       : '20',
+    'sp_grid_size'            : '5',
+    'sp_scale_factor'         : '0',
+    'ck_hard_mask'            : 'True',
+    'sp_levels'               : '29',
+    'ck_levels'               : 'True',
+    'sp_window_size'          : '5',
+    'ck_edge_scale'           : 'False',
+    'sp_edge_scale'           : '0',
+    'sp_lce_scale'            : '0',
+    'ck_lce_scale'            : 'False',
+    'sp_lce_level'            : '0',
+    'ck_lce_level'            : 'False',
+    'ck_curvature'            : 'False',
+    'sp_curvature'            : '0',
+    'ck_curvature_pc'         : 'False',
+    'cb_gray_proj'            : 'l-star',
+    'en_sweep'                : '',
+    'en_preview_w'            : '640',
+    'en_preview_h'            : '640',
+    'ck_output_size'          : 'False',
+    'en_output_w'             : '0',
+    'en_output_h'             : '0',
+    'en_output_xoffset'       : '0',
+    'en_output_yoffset'       : '0',
+    'cb_file_format'          : 'JPG',
+    'sp_jpg_quality'          : '90',
+    'cb_tif_compression'      : 'lzw',
+    'ck_keep_aligned'         : False,
+    'ck_keep_masked'          : False,
+    'ck_preview_compare'      : False,
+
+    # one stack per 4 cores and 16 GB, the ECC budget and enfuse limit are shared by all of them
+    'sp_queue_jobs'           : max(1, min(math.floor(mp.cpu_count()/4), math.floor(total_memory()/2**30/16))),
+    'sp_queue_enfuse'         : '1',
+    'cb_watch_group'          : 'time gap',
+    'sp_watch_gap'            : '10',
+    'sp_watch_frames'         : '0',
+
+    # preferences
+    'sp_mask_add_type'        : 'exclude',
+    'en_exec_align'           : 'align_image_stack',
+    'en_exec_enfuse'          : 'enfuse',
+    'en_exec_exiftool'        : 'exiftool',
+    'ck_prefs_align_gpu'      : False,
+
+    'en_prefs_align_prefix'     : 'aligned__',
+    'en_prefs_scratch'          : '',
+    'ck_prefs_prefetch'         : 'True',
+    'ck_prefs_incremental'      : 'False',
+    'en_prefs_gui_mask_include' : '#00ff00',
+    'en_prefs_gui_mask_exclude' : '#ff0000',
+    'en_prefs_gui_mask_active'  : '#ffff00'
+  }
+
+  if not c.has_section('prefs'):
+    c.add_section('prefs')
+
+  if not c.has_section('widgets'):
+    c.add_section('widgets')
+
+  return c
+
+
+def settings_from_config(config):
+  """ settings as returned by App.get_settings(), read from the saved widget values """
+  settings = {}
+
+  for name, value in config['widgets'].items():
+    settings[name] = (value == 'True') if name.startswith('ck_') else value
+
+  return settings
+
+
+AUTOSAVE_INTERVAL = 30000   # ms between autosaves of the changed masks/images
+
+PROJECT_SCHEMA = """
+  CREATE TABLE IF NOT EXISTS meta   (key TEXT PRIMARY KEY, value TEXT);
+  CREATE TABLE IF NOT EXISTS images (position INTEGER PRIMARY KEY, path TEXT, mtime REAL, probe TEXT);
+  CREATE TABLE IF NOT EXISTS masks  (image TEXT, position INTEGER, type TEXT, points BLOB,
+                                     PRIMARY KEY (image, position));
+"""
+
+def is_project_db(filepath):
+  """ True for a project file in the SQLite format, False for the old JSON one """
+  with open(filepath, 'rb') as infile:
+    return infile.read(16) == b'SQLite format 3\x00'
+
+
+def write_project(filepath, input_images, masks):
+  """ write a whole project as a SQLite file: images with their header probes, and the mask
+      polygons as packed float32 points. Written aside and renamed, so a failed save keeps the
+      previous file """
+  temp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+  if os.path.exists(temp_filepath):
+    os.remove(temp_filepath)
+
+  conn = sqlite3.connect(temp_filepath)
+  try:
+    with conn:
+      conn.executescript(PROJECT_SCHEMA)
+      conn.execute("INSERT INTO meta VALUES ('version', '1')")
+      write_project_images(conn, input_images)
+      for image_id in masks:
+        write_project_masks(conn, image_id, masks[image_id])
+  finally:
+    conn.close()
+
+  os.replace(temp_filepath, filepath)
+
+
+def update_project(filepath, input_images, masks):
+  """ autosave into an existing project file: the image list if input_images isn't None, and
+      only the masks of the images in masks """
+  conn = sqlite3.connect(filepath)
+  try:
+    with conn:
+      if input_images is not None:
+        write_project_images(conn, input_images)
+      for image_id in masks:
+        write_project_masks(conn, image_id, masks[image_id])
+  finally:
+    conn.close()
+
+
+def write_project_images(conn, input_images):
+  rows = []
+  for position, filepath in enumerate(input_images):
+    try:
+      mtime = os.path.getmtime(filepath)
+      probe = json.dumps(probe_image(filepath))
+    except (OSError, ValueError):
+      mtime, probe = None, None
+    rows.append((position, filepath, mtime, probe))
+
+  conn.execute('DELETE FROM images')
+  conn.executemany('INSERT INTO images VALUES (?, ?, ?, ?)', rows)
+
+
+def write_project_masks(conn, image_id, image_masks):
+  conn.execute('DELETE FROM masks WHERE image = ?', (image_id,))
+  conn.executemany('INSERT INTO masks VALUES (?, ?, ?, ?)',
+                   [(image_id, position, mask['type'], polygon_array(mask['mask']).tobytes())
+                    for position, mask in enumerate(image_masks)])
+
+
+def read_project_db(filepath):
+  """ load a SQLite project file. The stored probes of unchanged images prime probe_cache """
+  conn = sqlite3.connect(filepath)
+  try:
+    input_images = []
+    for image_path, mtime, probe in conn.execute('SELECT path, mtime, probe FROM images ORDER BY position'):
+      input_images.append(image_path)
+
+      if probe is not None and os.path.exists(image_path) and os.path.getmtime(image_path) == mtime:
+        with probe_cache_lock:
+          probe_cache[(image_path, mtime)] = json.loads(probe)
+
+    masks = {}
+    for image_id, mask_type, points in conn.execute('SELECT image, type, points FROM masks ORDER BY image, position'):
+      masks.setdefault(image_id, []).append({
+        'mask': np.frombuffer(points, dtype=np.float32).reshape(-1, 2).copy(),
+        'type': mask_type
+      })
+  except sqlite3.Error as e:
+    raise ValueError(str(e))
+  finally:
+    conn.close()
+
+  return {
+    'input_images': input_images,
+    'masks'       : masks
+  }
+
+
+def read_project(filepath):
+  """ load a .mft project file (SQLite, or the older JSON), raise ValueError if it can't be parsed """
+  if is_project_db(filepath):
+    return read_project_db(filepath)
+
+  with open(filepath) as infile:
+    data = json.load(infile)
+
+  if 'input_images' not in data:
+    raise ValueError('no input images in the project')
+
+  # masks are stored as flat [x0, y0, x1, y1, ...] lists
+  masks = {}
+  for image_id, image_masks in data.get('masks', {}).items():
+    masks[image_id] = [{'mask': polygon_array(mask['mask']), 'type': mask['type']} for mask in image_masks]
+
+  return {
+    'input_images': data['input_images'],
+    'masks'       : masks
+  }
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+def list_images(folder, settings, recursive = False):
+  """ images of a folder in filename order, skipping the files written by previous stacks.
+      With recursive, the images of the subfolders follow, in folder name order """
+  skip_prefixes = (settings['en_prefs_align_prefix'], 'masked_')
+  filepaths = []
+  subfolders = []
+
+  for filename in sorted(os.listdir(folder)):
+    stem, extension = os.path.splitext(filename)
+
+    if recursive and os.path.isdir(os.path.join(folder, filename)) \
+       and not os.path.islink(os.path.join(folder, filename)):
+      subfolders.append(os.path.join(folder, filename))
+      continue
+
+    if extension.lower() not in IMAGE_EXTENSIONS or filename.startswith(skip_prefixes) \
+       or stem.endswith('_fused'):
+      continue
+
+    filepaths.append(os.path.join(folder, filename))
+
+  for subfolder in subfolders:
+    filepaths += list_images(subfolder, settings, recursive)
+
+  return filepaths
+
+
+def batch_job(path, settings, events):
+  """ StackJob for a project file or a folder of images. The output is written next to the
+      first image as <stem>_fused.jpg/tif, the default name offered by the Stack button """
+  path = os.path.abspath(path)
+
+  if os.path.isdir(path):
+    input_images = list_images(path, settings)
+    masks = {}
+  else:
+    project = read_project(path)
+    input_images = [filepath for filepath in project['input_images'] if os.path.exists(filepath)]
+    masks = {filepath: project['masks'][filepath] for filepath in project['masks'] if filepath in input_images}
+
+  if len(input_images) < 2:
+    raise ValueError('at least two images are needed')
+
+  return StackJob(input_images, masks, default_output_name(input_images, settings), settings, events,
+                  name=os.path.basename(path))
+
+
+def default_output_name(input_images, settings):
+  """ <stem of the first image>_fused.jpg/tif, next to the first image """
+  extension = '.jpg' if settings['cb_file_format'] == 'JPG' else '.tif'
+
+  return os.path.join(
+    os.path.dirname(input_images[0]),
+    os.path.splitext(os.path.basename(input_images[0]))[0] + '_fused' + extension
+  )
+
+
+# enfuse settings a sweep can vary: name ==> (setting, settings that enable it)
+SWEEP_SETTINGS = collections.OrderedDict([
+  ('levels',    ('sp_levels',      {'ck_levels': False})),
+  ('window',    ('sp_window_size', {})),
+  ('edge',      ('sp_edge_scale',  {'ck_edge_scale': True})),
+  ('curvature', ('sp_curvature',   {'ck_curvature': True})),
+  ('projector', ('cb_gray_proj',   {}))
+])
+SWEEP_MAX = 16   # enfuse variants of a single sweep
+
+def parse_sweep(text):
+  """ variants of the enfuse settings for a sweep like "window=5,9; projector=l-star,luminance":
+      every combination of the values, as [(label, settings)]. [] for an empty text, ValueError
+      if it can't be parsed """
+  axes = []
+
+  for part in text.split(';'):
+    if not part.strip():
+      continue
+
+    name, sep, values = part.partition('=')
+    name = name.strip().lower()
+    values = [value.strip() for value in values.split(',') if value.strip()]
+
+    if not sep or name not in SWEEP_SETTINGS or len(values) == 0:
+      raise ValueError('Expected ' + '|'.join(SWEEP_SETTINGS) + '=value,value,..., not "' + part.strip() + '"')
+
+    setting, enabling = SWEEP_SETTINGS[name]
+    for value in values:
+      if not re.fullmatch(r'[\d.]+' if setting.startswith('sp_') else r'[\w-]+', value):
+        raise ValueError('Invalid ' + name + ': "' + value + '"')
+
+    axes.append([(name + value, dict(enabling, **{setting: value})) for value in values])
+
+  if len(axes) == 0:
+    return []
+
+  variants = []
+  for combination in itertools.product(*axes):
+    label = '_'.join(name for name, settings in combination)
+    variant = {}
+    for name, settings in combination:
+      variant.update(settings)
+    variants.append((label, variant))
+
+  if len(variants) > SWEEP_MAX:
+    raise ValueError(str(len(variants)) + ' variants, the sweep is limited to ' + str(SWEEP_MAX))
+
+  return variants
+
+
+def sweep_output_name(output_name, label):
+  """ output of a sweep variant: <stem>_<label><extension> """
+  if not label:
+    return output_name
+
+  stem, extension = os.path.splitext(output_name)
+  return stem + '_' + label + extension
+
+
+def capture_time(filepath):
+  """ EXIF DateTimeOriginal of an image as a timestamp, or its modification time """
+  try:
+    with Image.open(filepath) as img:
+      exif = img.getexif()
+      exif_ifd = exif.get_ifd(0x8769)
+      value = exif_ifd.get(36867) or exif.get(306)  # DateTimeOriginal, DateTime
+
+      if value:
+        timestamp = time.mktime(time.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S'))
+        subsec = str(exif_ifd.get(37521, '')).strip('\x00 ')  # SubSecTimeOriginal
+        if subsec.isdigit():
+          timestamp += float('0.' + subsec)
+        return timestamp
+  except (OSError, ValueError, SyntaxError):
+    pass
+
+  return os.path.getmtime(filepath)
+
+
+def polygon_array(points):
+  """ the points of a polygon as an Nx2 float32 array, from a flat [x0, y0, x1, y1, ...] list
+      or a list of (x, y) pairs """
+  return np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
+
+def simplify_polygon(poly, tolerance):
+  """ Douglas-Peucker simplification of a closed polygon (Nx2 array), dropping the points
+      closer than tolerance to the outline. Keeps at least a triangle """
+  if len(poly) <= 3:
+    return poly
+
+  simplified = cv2.approxPolyDP(poly.reshape(-1, 1, 2), tolerance, True).reshape(-1, 2)
+  if len(simplified) < 3:
+    return poly
+
+  return simplified
+
+
+def rasterize_masks(size, masks):
+  """ rasterize the masks of an image into an 8-bit alpha channel of size (width, height) """
+  alpha = Image.new('L', size, 255)
+  alpha_mask = ImageDraw.Draw(alpha)
+
+  for mask in masks:
+    if mask['type'] == 'exclude':
+      alpha_mask.polygon(polygon_array(mask['mask']).ravel().tolist(), fill=126)
+
+  # add include mask after exclude masks
+  for mask in masks:
+    if mask['type'] == 'include':
+      alpha_mask.polygon(polygon_array(mask['mask']).ravel().tolist(), fill=255)
+
+  return np.array(alpha)
+
+
+def read_image(filepath, gray = False):
+  """ read an image at its native bit depth (8/16-bit or float), dropping any alpha channel.
+      Unlike the default flags, EXIF orientation is ignored, as in PIL and enfuse """
+  if gray:
+    return cv2.imread(filepath, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH | cv2.IMREAD_IGNORE_ORIENTATION)
+
+  img = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+
+  if len(img.shape) == 3 and img.shape[2] == 4:
+    img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+
+  return img
+
+
+def to_8bit(img, depth):
+  """ an image read by read_image() scaled to 8 bits, for display """
+  if depth == '8':
+    return img
+
+  return np.clip(img.astype(np.float32) * (1/257 if depth == '16' else 255), 0, 255).astype(np.uint8)
+
+
+PREVIEW_SIZE = 2048   # long edge of the output previews handed to the GUI
+
+def image_preview(filepath, size = PREVIEW_SIZE):
+  """ 8-bit RGB array of an image reduced to fit in size x size """
+  probe = probe_image(filepath)
+
+  if probe['depth'] == '8':
+    # let the decoder reduce the image (JPEG decodes at 1/2, 1/4 or 1/8 of the size directly)
+    flag = cv2.IMREAD_COLOR
+    for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                 (2, cv2.IMREAD_REDUCED_COLOR_2)):
+      if max(probe['width'], probe['height']) // factor >= size:
+        flag = reduced_flag
+        break
+
+    img = cv2.imread(filepath, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+  else:
+    img = read_image(filepath)
+    if img is not None:
+      img = to_8bit(img, probe['depth'])
+
+  if img is None:
+    raise OSError('Cannot read ' + filepath)
+
+  img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB if len(img.shape) == 2 else cv2.COLOR_BGR2RGB)
+
+  scale = size / max(img.shape[0], img.shape[1])
+  if scale < 1:
+    img = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))),
+                     interpolation=cv2.INTER_AREA)
+
+  return img
+
+
+def preview_grid(previews, labels, size = PREVIEW_SIZE):
+  """ previews of the same size side by side in a grid of size wide, each with its label """
+  columns = math.ceil(math.sqrt(len(previews)))
+  rows = math.ceil(len(previews) / columns)
+  cell_width = size // columns
+  cell_height = max(1, round(cell_width * previews[0].shape[0] / previews[0].shape[1]))
+  gap = 4
+
+  grid = np.full((rows * cell_height, columns * cell_width, 3), 32, np.uint8)
+
+  for index, (preview, label) in enumerate(zip(previews, labels)):
+    row, column = divmod(index, columns)
+    x, y = column * cell_width, row * cell_height
+
+    grid[y:y + cell_height - gap, x:x + cell_width - gap] = \
+      cv2.resize(preview, (cell_width - gap, cell_height - gap), interpolation=cv2.INTER_AREA)
+
+    # outlined so that it reads on any content
+    for color, thickness in (((0, 0, 0), 4), ((255, 255, 255), 1)):
+      cv2.putText(grid, label, (x + 10, y + 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, thickness, cv2.LINE_AA)
+
+  return grid
+
+
+def focus_profile(filepath, proxy_width = 512):
+  """ sharpness (variance of the Laplacian) of a grayscale proxy of an image at most proxy_width
+      wide, over the whole image and over a grid of 8x8 tiles """
+  probe = probe_image(filepath)
+
+  if probe['depth'] == '8':
+    # let the decoder reduce the image (JPEG decodes at 1/2, 1/4 or 1/8 of the size directly)
+    flag = cv2.IMREAD_GRAYSCALE
+    for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                 (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+      if probe['width'] // factor >= proxy_width:
+        flag = reduced_flag
+        break
+
+    gray = cv2.imread(filepath, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+  else:
+    # 16-bit/float: scale to the 8-bit range so that the metrics compare across depths
+    gray = read_image(filepath, gray=True)
+    if gray is not None:
+      gray = gray.astype(np.float32) * (1/257 if probe['depth'] == '16' else 255)
+
+  if gray is None:
+    raise OSError('Cannot read ' + filepath)
+
+  if gray.shape[1] > proxy_width:
+    gray = cv2.resize(gray, (proxy_width, round(gray.shape[0] * proxy_width / gray.shape[1])),
+                      interpolation=cv2.INTER_AREA)
+
+  laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+  h, w = laplacian.shape
+
+  tiles = np.array([[laplacian[h*i//8 : h*(i+1)//8, w*j//8 : w*(j+1)//8].var() for j in range(8)]
+                    for i in range(8)])
+
+  return {
+    'sharpness': float(laplacian.var()),
+    'tiles'    : tiles
+  }
+
+
+INTERPOLATIONS = collections.OrderedDict([
+  ('linear' , cv2.INTER_LINEAR),
+  ('cubic'  , cv2.INTER_CUBIC),
+  ('lanczos', cv2.INTER_LANCZOS4)
+])
+
+MOTION_MODELS = collections.OrderedDict([
+  ('auto'       , None),   # affine, or homography where it correlates clearly better
+  ('translation', cv2.MOTION_TRANSLATION),
+  ('euclidean'  , cv2.MOTION_EUCLIDEAN),
+  ('affine'     , cv2.MOTION_AFFINE),
+  ('homography' , cv2.MOTION_HOMOGRAPHY)
+])
+
+AUTO_MOTION_GAIN = 0.002   # correlation a homography must add over the affine model in auto mode
+
+def to_homography(warp_matrix):
+  """ 3x3 version of a 2x3 ECC warp matrix (a 3x3 one is returned as is) """
+  if warp_matrix.shape == (3, 3):
+    return warp_matrix
+
+  return np.vstack([warp_matrix, [0, 0, 1]]).astype(np.float32)
+
+
+RIG_PROFILES = 'rig_profiles.json'   # next to config.ini
+RIG_LENS_TAGS = ['LensModel', 'LensID', 'FocalLength']
+rig_profiles_lock = threading.Lock()
+
+def load_rig_profiles():
+  """ the saved rig profiles: name ==> lens setup ==> capture position ==> 3x3 warp from the
+      first frame of the rig to that frame """
+  try:
+    with open(RIG_PROFILES) as infile:
+      return json.load(infile)
+  except (OSError, ValueError):
+    return {}
+
+
+def rig_lens_key(tags):
+  """ lens setup of a rig profile, from the EXIF tags of a stack's first image """
+  lens = tags.get('LensModel') or tags.get('LensID') or 'unknown lens'
+  return str(lens).strip() + ' @ ' + str(tags.get('FocalLength', '?')) + 'mm'
+
+
+def rig_initial_warps(frames, positions, anchor_index):
+  """ initial ECC warps (anchor ==> frame, by frame index) from the warps of a profile.
+      positions: capture position of each frame index, the profile's keys """
+  if str(positions[anchor_index]) not in frames:
+    return {}
+
+  from_anchor = np.linalg.inv(np.array(frames[str(positions[anchor_index])]))
+  return {index: np.array(frames[str(position)]) @ from_anchor for index, position in enumerate(positions)
+          if index != anchor_index and str(position) in frames}
+
+
+def save_rig_warps(name, lens, warps, anchor_index, positions):
+  """ merge the warps solved by a stack (anchor ==> frame, by frame index) into a profile,
+      where they're stored by capture position (see rig_initial_warps) relative to the first
+      frame of the rig, so that any anchor can use them. Return False if they can't be: neither
+      the first frame nor any frame already in the profile was solved """
+  warps = {positions[index]: warp for index, warp in warps.items()}
+  warps[positions[anchor_index]] = np.eye(3)
+
+  with rig_profiles_lock:
+    profiles = load_rig_profiles()
+    frames = profiles.setdefault(name, {}).setdefault(lens, {})
+
+    # relative to the first frame, through a frame of the profile when the first one is missing
+    if 0 in warps:
+      reference = 0
+      to_first = np.linalg.inv(warps[0])
+    else:
+      common = [position for position in sorted(warps) if str(position) in frames]
+      if len(common) == 0:
+        return False
+
+      reference = common[0]
+      to_first = np.linalg.inv(warps[reference]) @ np.array(frames[str(reference)])
+
+    for position, warp in warps.items():
+      warp = warp @ to_first
+      frames[str(position)] = (warp / warp[2, 2]).tolist()
+
+    temp_filepath = RIG_PROFILES + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filepath, 'w') as outfile:
+      json.dump(profiles, outfile, indent=1)
+    os.replace(temp_filepath, RIG_PROFILES)
+
+  return True
+
+
+REMAP_CACHE_DIR  = os.path.join(os.path.expanduser('~'), '.cache', 'mftker', 'remap')
+REMAP_CACHE_SIZE = 4 * 2**30   # bytes, least recently used maps are removed beyond this
+
+def warp_maps(warp_matrix, size):
+  """ fixed-point remap() maps doing the same as warpPerspective() with warp_matrix and
+      WARP_INVERSE_MAP to an image of size (width, height). They're cached on disk for the
+      frames that come back to the same geometry, as the positions of a rig do: the key is
+      where the image corners land, to 1/4 pixel. Return (map1, map2, True if cached) """
+  w, h = size
+  corners = np.array([[[0, 0], [w, 0], [0, h], [w, h]]], dtype=np.float64)
+  warped_corners = cv2.perspectiveTransform(corners, warp_matrix.astype(np.float64))
+  key = repr((w, h, np.round(warped_corners * 4).astype(int).ravel().tolist()))
+  filepath = os.path.join(REMAP_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+  try:
+    with np.load(filepath) as data:
+      map1, map2 = data['map1'], data['map2']
+    os.utime(filepath)  # recently used
+    return map1, map2, True
+  except (OSError, KeyError, ValueError):
+    pass
+
+  # compute in bands of rows to keep the float coordinates small
+  map1 = np.empty((h, w, 2), dtype=np.int16)
+  map2 = np.empty((h, w), dtype=np.uint16)
+  xs = np.arange(w, dtype=np.float32)
+
+  for top in range(0, h, 256):
+    bottom = min(h, top + 256)
+    grid = np.dstack(np.meshgrid(xs, np.arange(top, bottom, dtype=np.float32)))
+    coords = cv2.perspectiveTransform(grid, warp_matrix.astype(np.float64))
+    map1[top:bottom], map2[top:bottom] = cv2.convertMaps(coords[..., 0], coords[..., 1], cv2.CV_16SC2)
+
+  # other workers may write the same maps, only complete files get the final name
+  try:
+    os.makedirs(REMAP_CACHE_DIR, exist_ok=True)
+    temp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filepath, 'wb') as outfile:
+      np.savez(outfile, map1=map1, map2=map2)
+    os.replace(temp_filepath, filepath)
+
+    prune_remap_cache()
+  except OSError:
+    pass
+
+  return map1, map2, False
+
+
+def prune_remap_cache():
+  """ remove the least recently used maps beyond REMAP_CACHE_SIZE """
+  entries = []
+  for filename in os.listdir(REMAP_CACHE_DIR):
+    if filename.endswith('.npz'):
+      stat = os.stat(os.path.join(REMAP_CACHE_DIR, filename))
+      entries.append((stat.st_mtime, stat.st_size, filename))
+
+  total = sum([entry[1] for entry in entries])
+  for mtime, size, filename in sorted(entries):
+    if total <= REMAP_CACHE_SIZE:
+      break
+
+    os.remove(os.path.join(REMAP_CACHE_DIR, filename))
+    total -= size
+
+
+def to_gray(img):
+  """ grayscale version of an image read by read_image(), keeping its bit depth """
+  if len(img.shape) == 2:
+    return img
+
+  return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def ecc_gray(gray, scale, downcast):
+  """ convert a grayscale pyramid level to a type accepted by findTransformECC: 8-bit if
+      downcast (stretching deeper data by scale), float otherwise """
+  if downcast:
+    if gray.dtype == np.uint8:
+      return gray
+    return cv2.convertScaleAbs(gray, alpha=scale)
+
+  if gray.dtype == np.float32:
+    return gray
+
+  return gray.astype(np.float32)
+
+
+KEYPOINT_SIZE    = 2048   # pixels, widest pyramid level used for keypoint alignment
+KEYPOINT_MATCHES = 20     # RANSAC inliers below which a keypoint warp isn't trusted
+
+def keypoint_warp(gray1_pyr, gray2_pyr, scale):
+  """ fallback for the frames where ECC fails: 3x3 homography (anchor ==> target, as solved by
+      findTransformECC with WARP_INVERSE_MAP) from ORB keypoints matched on the finest pyramid
+      level no wider than KEYPOINT_SIZE, scaled back to full resolution """
+  level = max([0] + [i for i, gray in enumerate(gray1_pyr) if gray.shape[1] <= KEYPOINT_SIZE])
+  gray1 = ecc_gray(gray1_pyr[level], scale, True)
+  gray2 = ecc_gray(gray2_pyr[level], scale, True)
+
+  orb = cv2.ORB_create(5000)
+  keypoints1, descriptors1 = orb.detectAndCompute(gray1, None)
+  keypoints2, descriptors2 = orb.detectAndCompute(gray2, None)
+  if descriptors1 is None or descriptors2 is None:
+    raise ValueError('no keypoints found')
+
+  matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(descriptors1, descriptors2)
+  if len(matches) < KEYPOINT_MATCHES:
+    raise ValueError('only ' + str(len(matches)) + ' keypoint matches')
+
+  points1 = np.float32([keypoints1[m.queryIdx].pt for m in matches])
+  points2 = np.float32([keypoints2[m.trainIdx].pt for m in matches])
+  warp_matrix, inliers = cv2.findHomography(points1, points2, cv2.RANSAC, 3.0)
+  if warp_matrix is None or inliers.sum() < KEYPOINT_MATCHES:
+    raise ValueError('no consistent keypoint matches')
+
+  # from level coordinates to full resolution
+  factor = 2 ** (len(gray1_pyr) - 1 - level)
+  rescale = np.diag([factor, factor, 1.0])
+  warp_matrix = rescale @ warp_matrix @ np.linalg.inv(rescale)
+  return (warp_matrix / warp_matrix[2, 2]).astype(np.float32)
+
+
+def valid_rect(warps, size, samples = 512):
+  """ largest rectangle [x, y, width, height] of a canvas of size (width, height) where all the
+      frames warped onto it have pixels, like the autocrop of align_image_stack. warps are the 3x3
+      warps (anchor ==> frame, for WARP_INVERSE_MAP) of frames of the canvas size. None if the
+      frames have no common area """
+  w, h = size
+  corners = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+
+  # the valid area of each frame is its outline mapped back onto the canvas (a convex
+  # quadrilateral), and the common area their intersection
+  region = corners
+  for warp in warps:
+    outline = cv2.perspectiveTransform(corners[None].astype(np.float64), np.linalg.inv(warp))[0]
+    area, region = cv2.intersectConvexConvex(region, outline.astype(np.float32))
+    if area <= 0:
+      return None
+    region = region.reshape(-1, 2)
+
+  # horizontal extent of the region on sampled rows
+  region = region.astype(np.float64)
+  ys = np.linspace(region[:, 1].min(), region[:, 1].max(), samples)
+  a, b = region, np.roll(region, -1, axis=0)
+  dy = b[:, 1] - a[:, 1]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = (ys[:, None] - a[:, 1]) / dy
+    xs = a[:, 0] + t * (b[:, 0] - a[:, 0])
+  crossing = (dy != 0) & (t >= 0) & (t <= 1)
+  left = np.where(crossing, xs, np.inf).min(axis=1)
+  right = np.where(crossing, xs, -np.inf).max(axis=1)
+
+  # the region is convex, so between two rows it's at least as wide as on both of them:
+  # the best rectangle spans the pair of rows with the largest area
+  x0 = np.maximum(left[:, None], left[None, :])
+  x1 = np.minimum(right[:, None], right[None, :])
+  area = np.clip(x1 - x0, 0, None) * np.clip(ys[None, :] - ys[:, None], 0, None)
+  top, bottom = np.unravel_index(np.argmax(area), area.shape)
+  if area[top, bottom] <= 0:
+    return None
+
+  x, y = math.ceil(x0[top, bottom]), math.ceil(ys[top])
+  return [x, y, math.floor(x1[top, bottom]) - x + 1, math.floor(ys[bottom]) - y + 1]
+
+
+def shift_masks(masks, dx, dy):
+  """ copies of the masks of an image, moved by (-dx, -dy) for a crop of it starting at (dx, dy) """
+  return [dict(mask, mask=polygon_array(mask['mask']) - (dx, dy)) for mask in masks]
+
+
+def error_reason(e):
+  """ one-line reason of an exception, without OpenCV's source location """
+  match = re.search(r'\(-?\d+:([^)]*)\)\s*(.*?)\s*in function', str(e))
+  if match:
+    return match.group(1) + ': ' + match.group(2)
+
+  return str(e).strip().split('\n')[-1]
+
+
+anchor_pyramids = {}   # in a pool worker: (filepath, mtime, levels) ==> gray pyramid of the ECC anchor
+
+def anchor_pyramid(filepath, levels):
+  """ grayscale pyramid of the ECC anchor (coarsest level first), decoded once per worker
+      process instead of once per aligned frame. Only the latest anchor is kept """
+  key = (filepath, os.path.getmtime(filepath), levels)
+
+  if key not in anchor_pyramids:
+    anchor_pyramids.clear()
+
+    pyramid = [read_image(filepath, gray=True)]
+    for level in range(levels):
+      pyramid.insert(0, cv2.resize(pyramid[0], None, fx=1/2, fy=1/2, interpolation=cv2.INTER_AREA))
+
+    anchor_pyramids[key] = pyramid
+
+  return anchor_pyramids[key]
+
+
+def write_with_alpha(filepath, img, alpha):
+  """ write an OpenCV (BGR or grayscale) image with the given 8-bit alpha channel as RGBA,
+      keeping the bit depth of the image """
+  if len(img.shape) == 2:
+    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+  if img.dtype == np.uint8:
+    rgba = cv2.cvtColor(img, cv2.COLOR_BGR2RGBA)
+    rgba[:, :, 3] = alpha
+
+    # save through PIL, which tags the 4th channel as alpha (ExtraSamples) for enfuse
+    Image.fromarray(rgba, 'RGBA').save(filepath)
+    return
+
+  # PIL can't write 16-bit/float RGBA, let OpenCV write it with the alpha scaled to the depth
+  if img.dtype == np.uint16:
+    alpha = alpha.astype(np.uint16) * 257
+  else:
+    alpha = alpha.astype(img.dtype) / 255
+
+  if not cv2.imwrite(filepath, cv2.merge((*cv2.split(img), alpha))):
+    raise OSError('Cannot write ' + filepath)
+
+  # OpenCV doesn't tag the 4th channel, without which enfuse may not take it as the alpha
+  tag_tiff_alpha(filepath)
+
+
+def tag_tiff_alpha(filepath):
+  """ mark the 4th channel of an RGBA TIFF as unassociated alpha (ExtraSamples = 2). The first
+      IFD is copied with the tag to the end of the file, leaving the image data in place """
+  with open(filepath, 'r+b') as fp:
+    header = fp.read(8)
 
+    if header[:4] == b'II*\0':
+      order = '<'
+    elif header[:4] == b'MM\0*':
+      order = '>'
+    else:
+      raise OSError('Cannot tag the alpha channel of ' + filepath + ', not a classic TIFF file')
 
-        self.returncode.set(-1)
-        self.thread = threading.Thread(target=self.opencv_aligner.align, args=[self.input_images, ecc_options], daemon=True).start()
-        self.wait_variable(self.returncode)
-        self.aligned_images = ecc_options['aligned_images']
+    fp.seek(struct.unpack(order + 'I', header[4:])[0])
+    entry_count = struct.unpack(order + 'H', fp.read(2))[0]
+    entries = [fp.read(12) for i in range(entry_count)]
+    next_ifd = fp.read(4)
 
+    # entries are sorted by tag, a SHORT value is left-justified in the 4 bytes of the entry
+    entries = [entry for entry in entries if struct.unpack(order + 'H', entry[:2])[0] != 338]
+    entries.append(struct.pack(order + 'HHIHH', 338, 3, 1, 2, 0))
+    entries.sort(key=lambda entry: struct.unpack(order + 'H', entry[:2])[0])
 
-    if self.stack_cancelled == True:
-      return
+    # IFDs start on a word boundary
+    fp.seek(0, os.SEEK_END)
+    if fp.tell() % 2:
+      fp.write(b'\0')
 
-    # flush the queue
-    self.read_queue()
-    w['tx_log'].insert(tk.END, '\n\nDone aligning all images\n')
-    w['tx_log'].see(tk.END)
+    offset = fp.tell()
+    if offset >= 2**32:
+      raise OSError('Cannot tag the alpha channel of ' + filepath + ', too large')
 
+    fp.write(struct.pack(order + 'H', len(entries)) + b''.join(entries) + next_ifd)
+    fp.seek(4)
+    fp.write(struct.pack(order + 'I', offset))
 
-    if w['ck_align'].var.get():
-      images = self.aligned_images
-    else:
-      images = self.input_images
 
-    # generate masked images
-    has_mask = False
-    for filepath in self.masks:
-      for mask in self.masks[filepath]:
-        has_mask = True
-        break
-      if has_mask == True:
-        break
+def read_tiff_tags(fp):
+  """ read the (numeric) tags of the first IFD of a TIFF file, without going through PIL
+      which can't open some 16-bit/float variants. Return None if fp isn't a TIFF file """
+  fp.seek(0)
+  header = fp.read(8)
 
-    if not has_mask:
-      w['tx_log'].insert(tk.END, '\n\n===== NO MASK FOUND =====\n\n')
+  if header[:4] == b'II*\0':
+    order = '<'
+  elif header[:4] == b'MM\0*':
+    order = '>'
+  else:
+    return None
+
+  # field type => struct format for SHORT, LONG and SHORT-like types
+  formats = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i'}
+
+  fp.seek(struct.unpack(order + 'I', header[4:])[0])
+  entry_count = struct.unpack(order + 'H', fp.read(2))[0]
+  entries = fp.read(12 * entry_count)
+
+  tags = {}
+  for i in range(entry_count):
+    tag, field_type, count = struct.unpack(order + 'HHI', entries[12*i:12*i+8])
+
+    if field_type not in formats:
+      continue
+
+    fmt = order + formats[field_type] * count
+    size = struct.calcsize(fmt)
+
+    if size <= 4:
+      data = entries[12*i+8:12*i+8+size]
     else:
-      w['tx_log'].insert(tk.END, '\n\n===== APPLYING MASK =====\n\n')
-      images = self.apply_masks_to_images(images)
+      position = fp.tell()
+      fp.seek(struct.unpack(order + 'I', entries[12*i+8:12*i+12])[0])
+      data = fp.read(size)
+      fp.seek(position)
+
+    tags[tag] = struct.unpack(fmt, data)
+
+  return tags
+
+
+def read_image_header(filepath):
+  """ read the size, mode, number of color channels, bit depth and EXIF orientation of an image
+      from its header, without decoding the pixels. The depth is as used by enfuse's --depth
+      ('8', '16', '32' or 'r32') """
+  with open(filepath, 'rb') as fp:
+    tags = read_tiff_tags(fp)
+
+  if tags is not None:
+    bits = max(tags.get(258, (8,)))      # BitsPerSample
+    depth = str(bits)
+    if tags.get(339, (1,))[0] == 3:      # SampleFormat: IEEE float
+      depth = 'r' + depth
+
+    samples = tags.get(277, (1,))[0]     # SamplesPerPixel
+
+    return {
+      'width'      : tags[256][0],
+      'height'     : tags[257][0],
+      'mode'       : {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}.get(samples, str(samples)),
+      'channels'   : 1 if samples <= 2 else 3,   # alpha is dropped by read_image()
+      'depth'      : depth,
+      'orientation': tags.get(274, (1,))[0]
+    }
 
+  with Image.open(filepath) as img:
+    depth = '8'
+
+    if img.format == 'PNG':
+      # PIL reduces 16-bit RGB(A) PNGs to 8-bit modes, read the depth from IHDR instead
+      img.fp.seek(24)
+      depth = str(img.fp.read(1)[0])
+    elif img.mode in ('I;16', 'I;16B', 'I;16L'):
+      depth = '16'
+
+    return {
+      'width'      : img.width,
+      'height'     : img.height,
+      'mode'       : img.mode,
+      'channels'   : 1 if len(img.getbands()) <= 2 else 3,
+      'depth'      : depth,
+      'orientation': img.getexif().get(274, 1)
+    }
 
-    # call enfuse
-    enfuse_cmd = self.build_enfuse_command(images)
-    print(enfuse_cmd)
 
-    w['tx_log'].insert(tk.END, '\n\n===== CALLING ENFUSE =====\n')
-    w['tx_log'].insert(tk.END, 'output to ' + self.output_name + '\n\n')
+probe_cache = {}   # read_image_header() results, indexed by (filepath, mtime)
+probe_cache_lock = threading.Lock()
 
-    self.returncode.set(-1)
-    self.thread = threading.Thread(target=self.execute_cmd, args=[enfuse_cmd], daemon=True).start()
-    self.wait_variable(self.returncode)
+def probe_image(filepath):
+  """ read_image_header(), cached until the file is modified """
+  key = (filepath, os.path.getmtime(filepath))
 
-    if self.stack_cancelled == True:
-      return
+  with probe_cache_lock:
+    if key in probe_cache:
+      return probe_cache[key]
 
-    if self.returncode.get() > 0:
-      tk.messagebox.showerror(message='Error stacking images, please check output log.')
-      w['bt_cancel_stack'].configure(state=tk.DISABLED)
-      w['bt_stack'].configure(state=tk.NORMAL)
-      return
+  probe = read_image_header(filepath)
 
-    w['tx_log'].insert(tk.END, '\nDone stacking to ' + self.output_name + '\n\n')
-    w['tx_log'].see(tk.END)
+  with probe_cache_lock:
+    probe_cache[key] = probe
 
+  return probe
 
-    # copy EXIF
-    w['tx_log'].insert(tk.END, '\nCopying EXIF from ' + self.input_images[0] + ' to ' + self.output_name + '\n\n')
-    w['tx_log'].see(tk.END)
 
-    exiftool_exec = self.config.get('widgets', 'en_exec_exiftool')
-    exiftool_cmd = [exiftool_exec, '-TagsFromFile', self.input_images[0],
-                    '-all:all', '-overwrite_original', self.output_name]
-    self.execute_cmd(exiftool_cmd)
+def probe_images(filepaths):
+  """ probe_image() of several files in parallel, indexed by filepath. A file that can't be
+      probed gets the exception instead """
+  def probe(filepath):
+    try:
+      return probe_image(filepath)
+    except (OSError, ValueError, KeyError, IndexError, SyntaxError, struct.error) as e:
+      return e
 
-    # clean up aligned TIFFs
-    if w['ck_align'].var.get() and not w['ck_keep_aligned'].var.get():
-      for filename in self.aligned_images:
-        os.remove(filename)
-      w['tx_log'].insert(tk.END, '\nRemoved aligned images \n\n')
-      w['tx_log'].see(tk.END)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    return dict(zip(filepaths, executor.map(probe, filepaths)))
 
-    # clean up masked TIFFs
-    if has_mask and not w['ck_keep_masked'].var.get():
-      for filename in images:
-        os.remove(filename)
-      w['tx_log'].insert(tk.END, '\nRemoved masked images \n\n')
-      w['tx_log'].see(tk.END)
 
+ORIENTATIONS = {1: 'normal', 2: 'mirrored', 3: 'rotated 180', 4: 'mirrored 180',
+                5: 'mirrored 90', 6: 'rotated 90 CW', 7: 'mirrored 270', 8: 'rotated 90 CCW'}
 
-    # load the output file into the result pane
-    self.output_image = os.path.join(
-      os.path.basename(self.input_images[0]),
-      self.output_name
-    )
+def image_mismatch(reference, probe):
+  """ why an image can't be stacked with the reference one (both from probe_image()), or None.
+      Images are read without applying the EXIF orientation, so it has to match too """
+  if (probe['width'], probe['height']) != (reference['width'], reference['height']):
+    return 'size ' + str(probe['width']) + 'x' + str(probe['height']) + ' differs from ' + \
+           str(reference['width']) + 'x' + str(reference['height'])
 
-    self.update_output_image_preview()
-    self.toggle_log(False)
+  if probe['depth'] != reference['depth']:
+    return 'depth ' + format_depth(probe['depth']) + ' differs from ' + format_depth(reference['depth'])
 
-    w['bt_cancel_stack'].configure(state=tk.DISABLED)
-    w['bt_stack'].configure(state=tk.NORMAL)
+  if probe['orientation'] != reference['orientation']:
+    return 'orientation ' + ORIENTATIONS.get(probe['orientation'], str(probe['orientation'])) + \
+           ' differs from ' + ORIENTATIONS.get(reference['orientation'], str(reference['orientation']))
 
-    self.flags['queue_is_active'] = False
+  return None
 
 
+def format_depth(depth):
+  return depth.lstrip('r') + '-bit' + (' float' if depth.startswith('r') else '')
 
 
-  def cancel_stack_images(self):
-    w = self.widgets
-    self.stack_cancelled = True
-    self.output_name = None
+def total_memory():
+  """ physical memory of the machine in bytes, 0 if unknown """
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    return 0
 
-    w['bt_cancel_stack'].configure(state=tk.DISABLED)
-    w['bt_stack'].configure(state=tk.NORMAL)
 
-    if self.subprocess:
-      self.subprocess.kill()
+def format_size(size):
+  return '{:.1f} GB'.format(size / 2**30)
 
-    if self.thread:
-      self.thread.join()
 
-    if self.opencv_aligner:
-      self.opencv_aligner.cancel()
+def peak_rss():
+  """ peak resident memory of the current process in bytes, 0 if unknown """
+  if resource is None:
+    return 0
 
-    w['tx_log'].insert(tk.END, '\n\nStacking cancelled by user.\n\n')
-    w['tx_log'].see(tk.END)
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
+  # bytes on macOS, kilobytes elsewhere
+  return maxrss if platform.system() == 'Darwin' else maxrss * 1024
 
 
-  def execute_cmd(self, cmd):
-    log_box = self.widgets['tx_log']
-    working_dir = os.path.dirname(self.input_images[0])
 
-    p = subprocess.Popen(cmd, cwd=working_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    self.subprocess = p
+IMAGE_CHUNK = 250   # images listed/probed/inserted at a time when adding images
 
-    while p.poll() is None:
-      msg = p.stdout.readline()
-      log_box.insert(tk.END, msg)
-      log_box.see(tk.END)
+class ImageRegistry():
+  """ the input images in order, indexed by filepath, with their header probes. Iterates and
+      indexes like a list of filepaths """
 
-    self.subprocess = None
-    self.returncode.set(p.returncode)
+  def __init__(self):
+    self.images = collections.OrderedDict()   # filepath ==> probe
 
 
+  def __contains__(self, filepath):
+    return filepath in self.images
 
-  def read_queue(self):
-    # global main_queue
-    w = self.widgets
 
-    while main_queue.qsize():
-      try:
-        item = main_queue.get(0)
+  def __len__(self):
+    return len(self.images)
 
-        if item['type'] == 'message':
-          w['tx_log'].insert(tk.END, item['msg'])
-          w['tx_log'].see(tk.END)
 
-      except queue.Empty:
-        pass
+  def __iter__(self):
+    return iter(self.images)
 
-    if self.flags['queue_is_active'] == True:
-      self.after_handle = self.after(500, self.read_queue)
 
+  def __getitem__(self, index):
+    if index == 0 and len(self.images) > 0:
+      return next(iter(self.images))
 
+    return list(self.images)[index]
 
-  def save_project(self):
-    # ask if we don't have a save file yet
-    if self.save_file == None:
-      if len(self.input_images) > 0:
-        initial_dir = os.path.dirname(self.input_images[0])
-        default_filename = os.path.splitext(os.path.basename(self.input_images[0]))[0] + '.mft'
-      else:
-        initial_dir = self.config['prefs']['last_opened_location']
-        default_filename = 'new_project.mft'
 
-      save_file = tk.filedialog.asksaveasfilename(
-        initialdir= initial_dir,
-        confirmoverwrite=True,
-        defaultextension='mft',
-        initialfile=default_filename
-      )
+  def add(self, filepath, probe):
+    self.images[filepath] = probe
 
-      if save_file == '':
-        return
 
-      self.save_file = save_file
+  def remove(self, filepaths):
+    for filepath in filepaths:
+      self.images.pop(filepath, None)
 
-    data = {
-      'input_images': self.input_images,
-      'masks'       : self.masks
-    }
 
-    with open(self.save_file, 'w') as outfile:
-      outfile.write(json.dumps(data))
+  def clear(self):
+    self.images.clear()
 
-    # set the window title to the filename
-    self.title('MFTker - ' + os.path.basename(self.save_file))
 
+  def probe(self, filepath):
+    return self.images[filepath]
 
-  def load_project(self):
-    w = self.widgets
 
-    load_file = tk.filedialog.askopenfilename(
-      title = 'Load a project file',
-      initialdir = self.config['prefs']['last_opened_location'],
-      filetypes = [('MFTker project file', '.mft')],
-      multiple = False
-    )
 
-    if load_file != '':
-      with open(load_file) as infile:
-        try:
-          data = json.load(infile)
-          infile.close()
-        except json.JSONDecodeError as e:
-          tk.messagebox.showerror(message='Error parsing project file "' +
-                                  os.path.basename(load_file) + '":\n' + str(e))
-          infile.close()
-          return
+class ResourceBudget():
+  """ thread-safe accounting of a resource (bytes of memory, worker slots) reserved by
+      running tasks, possibly shared by several jobs """
+
+  def __init__(self, budget):
+    self.budget = budget
+    self.in_use = 0
+    self.lock   = threading.Lock()
 
-        # clean out the current files
-        for image_id in self.input_images[:]:
-          w['tr_images'].delete(image_id)
-          w['tr_mask_images'].delete(image_id)
-          self.input_images.remove(image_id)
+  def acquire(self, size):
+    """ reserve size units if the budget allows it. A task is always allowed to run
+        when nothing else is, so that a single oversized task doesn't stall """
+    with self.lock:
+      if self.in_use > 0 and self.in_use + size > self.budget:
+        return False
 
-        self.add_images(data['input_images'])
+      self.in_use += size
+      return True
 
-        self.masks.clear()
-        for image_id in data['masks']:
-          if image_id in self.input_images:
-            self.masks[image_id] = data['masks'][image_id]
+  def release(self, size):
+    with self.lock:
+      self.in_use -= size
 
-        self.update_mask_image_list()
-        self.update_mask_canvas()
+  def wait(self, size, cancelled):
+    """ block until size units are reserved. Return False instead if the cancelled event is set """
+    while not self.acquire(size):
+      if cancelled.wait(0.2):
+        return False
 
-        # set the window title to the filename
-        self.title('MFTker - ' + os.path.basename(load_file))
-        self.save_file = load_file
+    return True
 
 
+def masked_filepath(filepath, folder = None):
+  """ filepath of the masked TIFF generated for filepath, next to it unless in folder """
+  return os.path.join(
+    folder or os.path.dirname(filepath),
+    'masked_' + os.path.splitext(os.path.basename(filepath))[0] + '.tif'
+  )
 
 
 
@@ -2221,11 +4990,28 @@ class OpenCV_Aligner():
   iteration = 20
   ter_eps = 1e-1
   pool_size = math.floor(mp.cpu_count()/2)
+  memory_budget = 8 * 2**30   # bytes that the running tasks may use together
   cancelled = False  # flag to terminate processes
+  cancel_event = None   # set along with cancelled, for waits on budgets shared with other jobs
+  pool = None
+  warps = None       # after align(): 3x3 warps (anchor ==> frame) solved for each frame index
+  folder = None      # where the aligned images are written, None: next to their input
+  crop = None        # after align() with autocrop: [x, y, width, height] of the canvas kept
+  failed = None      # after align(): filepaths of the frames that couldn't be aligned
+
+  def __getstate__(self):
+    # the aligner is pickled along with align_pyramid() for the pool workers, which
+    # only need its settings
+    state = self.__dict__.copy()
+    state.pop('pool', None)
+    state.pop('cancel_event', None)
+    return state
+
 
   def align(self, image_list, options = {}):
-    """ root-level function for multiprocessing """
-    global pool
+    """ root-level function for multiprocessing. Return the aligned filepaths, in the
+        order of image_list without the frames that failed, or None if cancelled """
+    log = options.get('log', print)
 
     if 'prefix' in options:
       self.prefix = options['prefix']
@@ -2239,83 +5025,442 @@ class OpenCV_Aligner():
     if 'pool_size' in options:
       self.pool_size = options['pool_size']
 
-    anchor_index = math.floor(len(image_list)/2)
-    anchor_img = cv2.imread(image_list[anchor_index])
+    if 'memory_budget' in options:
+      self.memory_budget = options['memory_budget']
 
-    # write out anchor image as-is
-    aligned_filename = os.path.join(
-      os.path.dirname(image_list[anchor_index]),
-      self.prefix + os.path.basename(image_list[anchor_index])
-    )
+    if 'folder' in options:
+      self.folder = options['folder']
+
+    # where to read each input from, e.g. a local copy (called here, not in the workers)
+    source = options.get('source', lambda filepath: filepath)
+
+    # masks to be applied while warping, indexed by filepath (None: write plain aligned images)
+    masks = options.get('masks')
+
+    # frames already aligned by a previous run, {index: {'warp': anchor ==> frame, 'crop': ...}},
+    # which are skipped, and warps solved by it {index: warp}, which are only applied.
+    # frame_done(index, aligned filepath, warp, crop) is called as the others are written (with
+    # autocrop, also as they're solved, without filepath and crop)
+    done_frames = options.get('done', {})
+    solved_warps = options.get('warps', {})
+    frame_done = options.get('frame_done', lambda index, filepath, warp, crop: None)
+
+    # autocrop: solve all the warps first, then write the frames cropped to their common area.
+    # Each frame is decoded and pyramided once more for the second pass. Without autocrop, the
+    # borders the warps leave empty get zero alpha and enfuse ignores them
+    autocrop = options.get('autocrop', False)
+    crop = None
+
+    def is_done(index):
+      return index in done_frames and done_frames[index].get('crop') == crop
+
+    anchor_index = options.get('anchor', math.floor(len(image_list)/2))
+    anchor_filepath = image_list[anchor_index]
+
+    def write_anchor():
+      # write out anchor image as-is, only cropping it and adding the alpha channel if masking
+      aligned_filename = self.aligned_filepath(anchor_filepath, self.prefix, masks is not None)
+      anchor_img = read_image(source(anchor_filepath))
+      anchor_masks = masks.get(anchor_filepath, []) if masks is not None else None
+
+      if crop:
+        anchor_img = anchor_img[crop[1]:crop[1] + crop[3], crop[0]:crop[0] + crop[2]]
+        if anchor_masks:
+          anchor_masks = shift_masks(anchor_masks, crop[0], crop[1])
+
+      if masks is None:
+        cv2.imwrite(aligned_filename, anchor_img)
+      else:
+        alpha = rasterize_masks((anchor_img.shape[1], anchor_img.shape[0]), anchor_masks)
+        write_with_alpha(aligned_filename, anchor_img, alpha)
+
+      frame_done(anchor_index, aligned_filename, np.eye(3).tolist(), crop)
 
-    cv2.imwrite(aligned_filename, anchor_img)
-    options['logger'].insert(tk.END, '\nUsing "' + os.path.basename(image_list[anchor_index]) + '" as anchor')
-    options['logger'].see(tk.END)
+    if not autocrop and not is_done(anchor_index):
+      write_anchor()
+    log('\nUsing "' + os.path.basename(anchor_filepath) + '" as anchor')
+
+    # estimate the memory held by each task, and how many of them fit in the budget. The budget
+    # and the worker slots may be shared with other jobs, which then limit our dispatching
+    task_memory = self.estimate_task_memory(probe_image(image_list[anchor_index]), masks is not None,
+                                            options.get('remap_cache', False))
+    memory = options.get('memory') or ResourceBudget(self.memory_budget)
+    workers = options.get('workers') or ResourceBudget(self.pool_size)
+    pending = len(image_list) - 1 - len(set(done_frames) - {anchor_index})
+    pool_size = max(1, min(self.pool_size, memory.budget // task_memory, pending))
 
     # initiate a pool
-    pool = mp.Pool(self.pool_size)
+    self.pool = pool = mp.Pool(pool_size)
+
+    # cancel() may have been called before the pool existed
+    if self.cancelled:
+      pool.terminate()
+      return None
 
-    options['logger'].insert(tk.END, '\nInitated a pool of ' + str(self.pool_size) + ' workers\n')
-    options['logger'].see(tk.END)
+    log('\nEstimated memory per image: ' + format_size(task_memory) + ', budget: ' + format_size(memory.budget))
+    log('\nInitated a pool of ' + str(pool_size) + ' workers\n')
 
     aligned_images = []
-    results = []
-    self.cancelled = False
+    tasks = []
 
     worker_options = {
       'prefix'      :  str(options['prefix']),
       'iteration'   :  int(options['iteration']),
-      'ter_eps'     :  float(options['ter_eps'])
+      'ter_eps'     :  float(options['ter_eps']),
+      'interpolation': options.get('interpolation', 'linear'),
+      'remap_cache' :  bool(options.get('remap_cache', False)),
+      'motion'      :  options.get('motion', 'homography'),
+      'job'         :  options.get('job')
     }
 
 
-    results = []
+    initial_warps = options.get('initial_warps', {})
+    self.warps = {index: np.array(warp) for index, warp in solved_warps.items() if index != anchor_index}
+    self.warps.update({index: np.array(frame['warp']) for index, frame in done_frames.items() if index != anchor_index})
+
     for i, filepath in enumerate(image_list):
-      if i != anchor_index:
-        # important: do not pass any widget to apply_async since we're copying the parent into the child processes
-        result = pool.apply_async(self.align_pyramid, (str(image_list[anchor_index]), str(filepath), worker_options.copy()))
+      if i != anchor_index and i in self.warps and not autocrop and not is_done(i):
+        # solved before, e.g. only its masks changed: warp it again without solving
+        task_options = worker_options.copy()
+        if masks is not None:
+          task_options['masks'] = masks.get(filepath, [])
+
+        task_options['warp_matrix'] = self.warps[i].tolist()
+        tasks.append((i, (str(anchor_filepath), str(filepath), task_options)))
+
+      elif i != anchor_index and i not in self.warps:
+        task_options = worker_options.copy()
+        if masks is not None:
+          task_options['masks'] = masks.get(filepath, [])
+
+        if i in initial_warps:
+          task_options['initial_warp'] = np.asarray(initial_warps[i]).tolist()
+
+        if autocrop:
+          task_options['solve_only'] = True
+
+        tasks.append((i, (str(anchor_filepath), str(filepath), task_options)))
+
+      aligned_images.append(self.aligned_filepath(filepath, self.prefix, masks is not None))
+
+    self.cancel_event = threading.Event()
+    if self.cancelled:
+      self.cancel_event.set()
+
+    def reserve(block = False):
+      if block:
+        # none of our tasks is running, other jobs hold the slots or the memory: sleep until they
+        # give some back rather than polling
+        if not workers.wait(1, self.cancel_event):
+          return False
+
+        if not memory.wait(task_memory, self.cancel_event):
+          workers.release(1)
+          return False
+
+        return True
+
+      if not workers.acquire(1):
+        return False
+
+      if not memory.acquire(task_memory):
+        workers.release(1)
+        return False
+
+      return True
+
+    # a frame that fails or times out is retried with the next options of retry_options(),
+    # and left out of the stack once they're exhausted instead of aborting it
+    timeout = options.get('timeout', 0)   # seconds per attempt at a frame, 0 for none
+    attempts = {}
+    failed = set()
+
+    running = []   # (frame index, task, async result, start time)
+    worker_peak = 0
+    job_peak = 0      # memory reserved by this alignment's tasks at once
+    shared_peak = 0   # by the tasks of all the jobs sharing the budget, while this one ran
+    total = len(tasks)
+    completed = 0
+
+    def retry(index, task, reason):
+      nonlocal completed
+      anchor_filepath, target_filepath, task_options = task
+      attempts[index] = attempts.get(index, 0) + 1
+      name = os.path.basename(target_filepath)
+
+      retry_options, change = self.retry_options(task_options, attempts[index])
+      if retry_options is None:
+        log('\nCould not align ' + name + ' (' + reason + '), leaving it out of the stack\n')
+        failed.add(index)
+
+        completed += 1
+        if 'progress' in options:
+          options['progress'](completed, total)
+        return
 
-        # for single-process debugging:
-        # result = self.align_pyramid(str(image_list[anchor_index]), str(filepath), worker_options.copy())
+      log('\nAligning ' + name + ' failed (' + reason + '), retrying with ' + change + '\n')
+      tasks.insert(0, (index, (anchor_filepath, target_filepath, retry_options)))
 
-        if self.cancelled == True:
-          break
+    # dispatch the tasks to the pool as the memory budget and worker slots allow
+    try:
+      while (len(tasks) > 0 or len(running) > 0 or (autocrop and crop is None)) and self.cancelled == False:
+        if autocrop and crop is None and len(tasks) == 0 and len(running) == 0:
+          # all the warps are solved: crop to the area common to the frames, and queue the
+          # frames to warp (with the anchor, which isn't warped)
+          size = (probe_image(anchor_filepath)['width'], probe_image(anchor_filepath)['height'])
+          crop = valid_rect([np.eye(3)] + [warp for index, warp in self.warps.items() if index not in failed], size)
+
+          if crop is None or crop[2] * crop[3] < size[0] * size[1] / 2:
+            log('\nThe frames have too little area in common, not cropping\n')
+            crop = [0, 0, size[0], size[1]]
+          else:
+            log('\nCropping to the area common to all frames: ' + str(crop[2]) + 'x' + str(crop[3]) +
+                ' at (' + str(crop[0]) + ', ' + str(crop[1]) + ')\n')
+
+          if not is_done(anchor_index):
+            write_anchor()
+
+          for index, warp in self.warps.items():
+            if index not in failed and not is_done(index):
+              task_options = worker_options.copy()
+              if masks is not None:
+                task_options['masks'] = masks.get(image_list[index], [])
+
+              task_options['warp_matrix'] = warp.tolist()
+              task_options['crop'] = crop
+              tasks.append((index, (str(anchor_filepath), str(image_list[index]), task_options)))
+
+          completed, total = 0, len(tasks)
+          continue
+
+        while len(tasks) > 0 and len(running) < pool_size and reserve(len(running) == 0):
+          # important: do not pass any widget to apply_async since we're copying the parent into the child processes
+          index, task = tasks.pop(0)
+          anchor_filepath, target_filepath, task_options = task
+          running.append((index, task, pool.apply_async(self.align_pyramid,
+                                                        (source(anchor_filepath), source(target_filepath), task_options)),
+                          time.monotonic()))
+
+          job_peak = max(job_peak, len(running) * task_memory)
+          shared_peak = max(shared_peak, memory.in_use)
+
+          # for single-process debugging:
+          # self.align_pyramid(*tasks.pop(0)[1])
+
+        # collect the results as they complete, in any order
+        for entry in running[:]:
+          index, task, result, started = entry
+
+          if result.ready():
+            running.remove(entry)
+            workers.release(1)
+            memory.release(task_memory)
+
+            # get() re-raises the error of the subprocess, which only costs this frame an attempt
+            try:
+              output = result.get()
+            except Exception as e:
+              retry(index, task, error_reason(e))
+              continue
+
+            worker_peak = max(worker_peak, output['peak_rss'])
+            self.warps[index] = np.array(output['warp'])
+            frame_done(index, output.get('filepath'), output['warp'], crop)
+
+            completed += 1
+            if 'progress' in options:
+              options['progress'](completed, total)
+
+          elif timeout and time.monotonic() - started > timeout:
+            # a single task can't be stopped: restart the pool, the other frames in flight start over
+            pool.terminate()
+            for other in running:
+              workers.release(1)
+              memory.release(task_memory)
+              if other is not entry:
+                tasks.insert(0, other[:2])
+            running = []
+
+            retry(index, task, 'timed out after ' + str(timeout) + ' seconds')
+
+            self.pool = pool = mp.Pool(pool_size)
+            if self.cancelled:
+              pool.terminate()
+            break
 
-        results.append(result)
+        if len(running) > 0:
+          running[0][2].wait(0.1)
 
-      aligned_filename = os.path.join(
-        os.path.dirname(filepath),
-        self.prefix + os.path.basename(filepath)
-      )
-      aligned_images.append(aligned_filename)
+    except Exception:
+      pool.terminate()
 
-    for result in results:
-      if result:
-        result.get()    # needed to catch any error/exception from subprocesses
+      # cancel() terminating the pool under the dispatch (e.g. "Pool not running") isn't an error
+      if self.cancelled:
+        self.pool = None
+        return None
+      raise
 
+    finally:
+      # give back what the unfinished tasks reserved, other jobs may be waiting for it
+      for entry in running:
+        workers.release(1)
+        memory.release(task_memory)
 
     # close Pool and let all the processes complete
     pool.close()
     pool.join()  # wait for all processes
+    self.pool = None
+
+    if self.cancelled:
+      return None
+
+    msg = '\nPeak memory: ' + format_size(job_peak) + ' estimated for the concurrent tasks of this stack'
+    if shared_peak > job_peak:
+      msg += ' (' + format_size(shared_peak) + ' with the other stacks running meanwhile)'
+    if worker_peak > 0:
+      msg += ', ' + format_size(worker_peak) + ' measured in a single worker'
+    log(msg + '\n')
+
+    self.failed = [image_list[index] for index in sorted(failed)]
+    self.crop = crop
+    if len(image_list) - len(failed) < 2:
+      raise Exception('Too few images could be aligned, please check output log.')
 
-    options['aligned_images'] = aligned_images
-    options['signaler'].set(0)
+    return [filepath for index, filepath in enumerate(aligned_images) if index not in failed]
 
 
+  def retry_options(self, task_options, attempt):
+    """ options for another attempt at a frame after the previous one failed or timed out, and
+        a description of what they change. (None, None) once the attempts are exhausted """
+    retry_options = task_options.copy()
+
+    if attempt == 1:
+      # ECC from scratch with more smoothing, and the affine model that auto only
+      # upgrades to a homography when it helps
+      retry_options.pop('initial_warp', None)
+      retry_options['blur'] = 9
+      if retry_options.get('motion', 'homography') == 'homography':
+        retry_options['motion'] = 'auto'
+      return retry_options, 'relaxed ECC settings'
+
+    if attempt == 2:
+      retry_options['method'] = 'keypoints'
+      return retry_options, 'keypoint matching'
+
+    return None, None
+
 
 
   def align_pyramid(self, anchor_filepath, target_filepath, options):
-    ''' pyramid algorithm from https://stackoverflow.com/questions/45997891/cv2-motion-euclidean-for-the-warp-mode-in-ecc-image-alignment-method '''
+    """ align the target image against the anchor and write it out: solve the warp (see
+        solve_warp()) unless options['warp_matrix'] already has it, then warp the image to the
+        anchor's canvas, or to options['crop'] = [x, y, width, height] of it. With
+        options['solve_only'] nothing is written """
     # global main_queue
 
-    msg = '\nECC aligning ' + os.path.basename(target_filepath) + ' against ' + os.path.basename(anchor_filepath)
+    if 'warp_matrix' in options:
+      method = 'Warping'
+    else:
+      method = ('Keypoint' if options.get('method') == 'keypoints' else 'ECC') + ' aligning'
+
+    msg = '\n' + method + ' ' + os.path.basename(target_filepath) + ' against ' + os.path.basename(anchor_filepath)
+    print(msg)
+    main_queue.put({'type': 'message', 'job': options.get('job'), 'msg': msg})
+
+    prefix = options['prefix']
+    start_time = timeit.default_timer()
+
+    target_img = read_image(target_filepath)
+
+    if 'warp_matrix' in options:
+      warp_matrix = np.array(options['warp_matrix'], dtype=np.float32)
+      motion = 'solved'
+    else:
+      warp_matrix, motion = self.solve_warp(anchor_filepath, target_img, options)
+
+    if options.get('solve_only'):
+      msg = '\nSolved ' + os.path.basename(target_filepath) + ' (' + '{:.2f}'.format(timeit.default_timer() - start_time)
+      msg += ' seconds, ' + motion + ' motion)'
+      print(msg)
+      main_queue.put({'type': 'message', 'job': options.get('job'), 'msg': msg})
+
+      return {
+        'warp'    : warp_matrix.tolist(),
+        'peak_rss': peak_rss()
+      }
+
+    # the anchor's canvas, or the part of it to keep
+    probe = probe_image(anchor_filepath)
+    size = (probe['width'], probe['height'])
+    interpolation = INTERPOLATIONS[options.get('interpolation', 'linear')]
+    masks = options.get('masks')
+
+    output_warp = warp_matrix
+    crop = options.get('crop')
+    if crop:
+      size = (crop[2], crop[3])
+      output_warp = warp_matrix @ np.array([[1, 0, crop[0]], [0, 1, crop[1]], [0, 0, 1]], dtype=np.float32)
+      if masks is not None:
+        masks = shift_masks(masks, crop[0], crop[1])
+
+    warp_start_time = timeit.default_timer()
+    warp_method = 'warpPerspective'
+
+    if options.get('remap_cache'):
+      map1, map2, cached = warp_maps(output_warp, size)
+      warp_method = 'remap, ' + ('cached' if cached else 'new') + ' maps'
+
+      aligned_img = cv2.remap(target_img, map1, map2, interpolation,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    else:
+      aligned_img = cv2.warpPerspective(
+                          target_img,
+                          output_warp,
+                          size,
+                          borderMode=cv2.BORDER_CONSTANT,
+                          borderValue=0,
+                          flags=interpolation + cv2.WARP_INVERSE_MAP)
+
+    if masks is not None:
+      # the warped-in border becomes fully transparent
+      full = np.full(target_img.shape[:2], 255, dtype=np.uint8)
+
+      if options.get('remap_cache'):
+        # the integer part of the fixed-point map is the nearest neighbour
+        border = cv2.remap(full, map1, None, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        del map1, map2
+      else:
+        border = cv2.warpPerspective(full, output_warp, size, borderMode=cv2.BORDER_CONSTANT,
+                                     borderValue=0, flags=cv2.INTER_NEAREST + cv2.WARP_INVERSE_MAP)
+
+    warp_time = timeit.default_timer() - warp_start_time
+
+    aligned_filename = self.aligned_filepath(target_filepath, prefix, masks is not None)
+
+    if masks is None:
+      cv2.imwrite(aligned_filename, aligned_img)
+    else:
+      # single pass: the masks are rasterized on top of the border and the
+      # frame is written once as RGBA
+      alpha = np.minimum(rasterize_masks(size, masks), border)
+      write_with_alpha(aligned_filename, aligned_img, alpha)
+
+    msg = '\nDone ' + method + ', written to: ' + os.path.basename(aligned_filename)
+    msg += ' (' + '{:.2f}'.format(timeit.default_timer() - start_time) + ' seconds, warp: '
+    msg += '{:.2f}'.format(warp_time) + ' seconds with ' + warp_method + ', ' + motion + ' motion)'
     print(msg)
-    main_queue.put({'type': 'message', 'msg': msg})
+    main_queue.put({'type': 'message', 'job': options.get('job'), 'msg': msg})
+
+    return {
+      'filepath': aligned_filename,
+      'warp'    : warp_matrix.tolist(),
+      'peak_rss': peak_rss()
+    }
 
-    anchor_img = cv2.imread(anchor_filepath)
-    anchor_img_gray = cv2.cvtColor(anchor_img, cv2.COLOR_RGB2GRAY)
 
-    prefix    = options['prefix']
+  def solve_warp(self, anchor_filepath, target_img, options):
+    ''' pyramid algorithm from https://stackoverflow.com/questions/45997891/cv2-motion-euclidean-for-the-warp-mode-in-ecc-image-alignment-method
+        Return the 3x3 warp (anchor ==> target, for WARP_INVERSE_MAP) and the name of its motion model '''
     iteration = options['iteration']
     ter_eps   = options['ter_eps']
 
@@ -2324,12 +5469,23 @@ class OpenCV_Aligner():
       pyramid_level = options['pyramid_level']
 
 
-    warp_mode = cv2.MOTION_HOMOGRAPHY
+    motion = options.get('motion', 'homography')
+    warp_mode = cv2.MOTION_AFFINE if motion == 'auto' else MOTION_MODELS[motion]
 
-    # Initialize the matrix to identity
+    # Initialize the matrix to identity, or to the warp of a rig profile
     warp_matrix = np.array([[1,0,0],[0,1,0],[0,0,1]], dtype=np.float32)
+    if 'initial_warp' in options:
+      warp_matrix = np.array(options['initial_warp'], dtype=np.float32)
+
+      # auto keeps a profile's perspective rather than rediscovering it
+      if motion == 'auto' and np.abs(warp_matrix[2, :2]).max() > 1e-7:
+        warp_mode = cv2.MOTION_HOMOGRAPHY
 
-    w = anchor_img_gray.shape[1]
+    # (2x3 for the models other than homography)
+    if warp_mode != cv2.MOTION_HOMOGRAPHY:
+      warp_matrix = warp_matrix[:2] / warp_matrix[2, 2]
+
+    w = probe_image(anchor_filepath)['width']
 
     # determine number of levels
     if pyramid_level is None:
@@ -2341,83 +5497,476 @@ class OpenCV_Aligner():
 
     warp_matrix[0][2] /= (2**nol)
     warp_matrix[1][2] /= (2**nol)
+    if warp_mode == cv2.MOTION_HOMOGRAPHY:
+      warp_matrix[2][0] *= (2**nol)
+      warp_matrix[2][1] *= (2**nol)
 
-    target_img = cv2.imread(target_filepath)
-    target_img_gray = cv2.cvtColor(target_img, cv2.COLOR_RGB2GRAY)
+    target_img_gray = to_gray(target_img)
 
-    # construct grayscale pyramid
-    gray1_pyr = [anchor_img_gray]
+    # construct grayscale pyramid, the anchor's is shared by the tasks of this worker
+    gray1_pyr = anchor_pyramid(anchor_filepath, nol)
+    anchor_img_gray = gray1_pyr[-1]
     gray2_pyr = [target_img_gray]
 
     # print('target_img: ', target_img_gray.shape)
 
     for level in range(nol):
-      # print('level: ', level, ', gray1_pyr[0].shape: ', gray1_pyr[0].shape)
+      # print('level: ', level, ', gray2_pyr[0].shape: ', gray2_pyr[0].shape)
 
-      gray1_pyr.insert(0, cv2.resize(gray1_pyr[0], None, fx=1/2, fy=1/2, interpolation=cv2.INTER_AREA))
       gray2_pyr.insert(0, cv2.resize(gray2_pyr[0], None, fx=1/2, fy=1/2, interpolation=cv2.INTER_AREA))
 
+    # 16-bit/float levels are stretched to 8-bit for ECC where the extra precision doesn't matter:
+    # always on the coarse levels, and on the finest level only if the data fits in 8 bits
+    max_value = max(cv2.minMaxLoc(anchor_img_gray)[1], cv2.minMaxLoc(target_img_gray)[1])
+    ecc_scale = 255 / max_value if max_value > 0 else 1
+    fits_8bit = max_value <= 255 and np.issubdtype(anchor_img_gray.dtype, np.integer) \
+                                 and np.issubdtype(target_img_gray.dtype, np.integer)
+
     # Terminate the optimizer if either the max iterations or the threshold are reached
     criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iteration, ter_eps )
+    blur = options.get('blur', 5)   # size of the Gaussian that ECC smooths the levels with
+
+    if options.get('method') == 'keypoints':
+      warp_matrix = keypoint_warp(gray1_pyr, gray2_pyr, ecc_scale)
+      warp_mode = cv2.MOTION_HOMOGRAPHY
+
+    else:
+      # run pyramid ECC
+      for level in range(nol+1):
+        # lvl_start_time = timeit.default_timer()
+
+        downcast = level < nol or fits_8bit
+        grad1 = ecc_gray(gray1_pyr[level], ecc_scale, downcast)
+        grad2 = ecc_gray(gray2_pyr[level], ecc_scale, downcast)
+
+        # print('level:', level, ', gray1_pyr[level].shape:', gray1_pyr[level].shape)
+
+        cc, warp_matrix = cv2.findTransformECC(grad1, grad2, warp_matrix, warp_mode, criteria, None, blur)
+
+        # auto: on the level before the finest (the cheaper one), try a homography from the
+        # affine result and keep it for the finest level if it correlates clearly better
+        if motion == 'auto' and warp_mode != cv2.MOTION_HOMOGRAPHY and level == max(0, nol-1):
+          try:
+            homography_cc, homography = cv2.findTransformECC(grad1, grad2, to_homography(warp_matrix),
+                                                             cv2.MOTION_HOMOGRAPHY, criteria, None, blur)
+            if homography_cc - cc > AUTO_MOTION_GAIN:
+              cc, warp_matrix, warp_mode = homography_cc, homography, cv2.MOTION_HOMOGRAPHY
+          except cv2.error:
+            pass
+
+        del grad1, grad2
+
+        if level < nol:
+          # scale up for the next pyramid level
+          if warp_mode == cv2.MOTION_HOMOGRAPHY:
+            warp_matrix = warp_matrix * np.array([[1,1,2],[1,1,2],[0.5,0.5,1]], dtype=np.float32)
+          else:
+            warp_matrix = warp_matrix * np.array([[1,1,2],[1,1,2]], dtype=np.float32)
 
-    # run pyramid ECC
-    pyr_start_time = timeit.default_timer()
+        # print('Level %i time:'%level, timeit.default_timer() - lvl_start_time)
 
-    for level in range(nol+1):
-      # lvl_start_time = timeit.default_timer()
+    # returned as 3x3, whatever the model
+    motion = [name for name in MOTION_MODELS if MOTION_MODELS[name] == warp_mode][0]
+    return to_homography(warp_matrix), motion
 
-      grad1 = gray1_pyr[level]
-      grad2 = gray2_pyr[level]
 
-      # print('level:', level, ', gray1_pyr[level].shape:', gray1_pyr[level].shape)
 
-      cc, warp_matrix = cv2.findTransformECC(grad1, grad2, warp_matrix, warp_mode, criteria)
+  def estimate_task_memory(self, probe, masked = False, remap = False):
+    """ rough estimate of the peak memory (in bytes) used by align_pyramid() for an image
+        with the size/depth returned by probe_image() """
+    pixels = probe['width'] * probe['height']
+    sample = {'8': 1, '16': 2}.get(probe['depth'], 4)
+    color = pixels * probe['channels'] * sample
 
-      if level < nol:
-        # scale up for the next pyramid level
-        warp_matrix = warp_matrix * np.array([[1,1,2],[1,1,2],[0.5,0.5,1]], dtype=np.float32)
+    # while running ECC: target image, both gray pyramids (4/3 of the full level), float
+    # copies of the finest level and ECC's own float buffers (images, gradients, jacobian)
+    ecc = color + 2 * pixels * sample * 4/3 + 14 * 4 * pixels
+    if sample > 1:
+      ecc += 2 * 4 * pixels
 
-      # print('Level %i time:'%level, timeit.default_timer() - lvl_start_time)
+    # while warping: target and warped images, the worker's cached anchor pyramid, border and
+    # alpha masks, RGBA output buffer
+    warp = 2 * color + pixels * sample * 4/3
+    if masked:
+      warp += 2 * pixels + 4 * pixels * sample
+    if remap:
+      warp += 6 * pixels   # fixed-point maps
 
-    # print('Pyramid time (', os.path.basename(target_filepath), '): ', timeit.default_timer() - pyr_start_time)
+    # plus some allowance for the interpreter and libraries of the worker process
+    return int(max(ecc, warp)) + 2**26
 
-    # Get the target size from the desired image
-    target_shape = anchor_img.shape
 
-    aligned_img = cv2.warpPerspective(
-                        target_img,
-                        warp_matrix,
-                        (target_shape[1], target_shape[0]),
-                        borderMode=cv2.BORDER_CONSTANT,
-                        borderValue=0,
-                        flags=cv2.INTER_AREA + cv2.WARP_INVERSE_MAP)
 
+  def aligned_filepath(self, filepath, prefix, masked = False):
+    """ filepath of the aligned (or aligned and masked) image written for filepath """
     aligned_filename = os.path.join(
-      os.path.dirname(target_filepath),
-      prefix + os.path.basename(target_filepath)
+      self.folder or os.path.dirname(filepath),
+      prefix + os.path.basename(filepath)
     )
 
-    cv2.imwrite(aligned_filename, aligned_img)
+    if masked:
+      return masked_filepath(aligned_filename)
 
-    msg = '\nDone ECC aligning, written to: ' + os.path.basename(aligned_filename)
-    msg += ' (' + '{:.2f}'.format(timeit.default_timer() - pyr_start_time) + ' seconds)'
-    print(msg)
-    main_queue.put({'type': 'message', 'msg': msg})
+    return aligned_filename
 
 
 
   def cancel(self):
-    global pool
-
+    """ stop dispatching tasks and kill the pool workers (called from another thread) """
     self.cancelled = True
-    pool.close()
-    pool.terminate()
-    pool.join()
+
+    if self.cancel_event:
+      self.cancel_event.set()
+
+    pool = self.pool
+    if pool:
+      pool.terminate()
+
+
+
+
+
+
+
+
+TILE_SIZE        = 256
+TILE_CACHE_DIR   = os.path.join(os.path.expanduser('~'), '.cache', 'mftker', 'tiles')
+TILE_CACHE_SIZE  = 2 * 2**30   # bytes, least recently viewed images are removed beyond this
+TILE_PRUNE_INTERVAL = 600000   # ms between prunings of the tile cache
+
+# builds the pyramid levels and prunes the cache off the Tk thread, one at a time to bound the memory
+tile_builder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='tiles')
+
+class TilePyramid():
+  """ deep-zoom style pyramid of an image for display: level 0 is the full resolution, each
+      level halves the previous one, down to a level that fits a single tile. A level is only
+      built when first needed, in the background (see request()), as 8-bit JPEG tiles of
+      TILE_SIZE pixels cached on disk """
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+    probe = probe_image(filepath)
+    self.width, self.height, self.depth = probe['width'], probe['height'], probe['depth']
+    self.levels = 1 + max(0, math.ceil(math.log2(max(self.width, self.height) / TILE_SIZE)))
+
+    stat = os.stat(filepath)
+    key = repr((os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size))
+    self.folder = os.path.join(TILE_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest())
+    self.building = {}   # level ==> future of its build by tile_builder
+    self.failed = set()  # levels that couldn't be built, not tried again
+    self.error = None    # why the last of them couldn't
+
+
+  def level_size(self, level):
+    """ (width, height) of the image at a level """
+    return (math.ceil(self.width / 2**level), math.ceil(self.height / 2**level))
+
+
+  def level_tiles(self, level):
+    """ (columns, rows) of tiles at a level """
+    width, height = self.level_size(level)
+    return (math.ceil(width / TILE_SIZE), math.ceil(height / TILE_SIZE))
+
+
+  def is_built(self, level):
+    return os.path.isdir(os.path.join(self.folder, str(level)))
+
+
+  def request(self, level):
+    """ start building a level in the background, unless it's being built along with a finer one """
+    if level in self.failed or any(building <= level for building in self.building):
+      return
+
+    self.building[level] = tile_builder.submit(self.build, level)
+
+
+  def collect(self):
+    """ forget the finished builds. Return True if any of them finished, built or failed """
+    finished = False
+
+    for level, future in list(self.building.items()):
+      if future.done():
+        del self.building[level]
+        finished = True
+
+        if future.exception() is not None:
+          self.error = str(future.exception())
+          self.failed.add(level)
+
+    return finished
+
+
+  def tile(self, level, col, row):
+    """ a tile of a built level as a PIL image """
+    img = Image.open(os.path.join(self.folder, str(level), str(col) + '_' + str(row) + '.jpg'))
+    img.load()
+    return img
+
+
+  def build(self, level):
+    """ write the tiles of a level and of the coarser levels not built yet, from one decode """
+    factor = 2**level
+
+    if self.depth == '8':
+      # let the decoder reduce the image (JPEG decodes at 1/2, 1/4 or 1/8 of the size directly)
+      flag = cv2.IMREAD_COLOR
+      for reduce, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                   (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if factor >= reduce:
+          flag = reduced_flag
+          break
+
+      img = cv2.imread(self.filepath, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+      img = read_image(self.filepath)
+      if img is not None:
+        img = to_8bit(img, self.depth)
+
+    if img is None:
+      raise OSError('Cannot read ' + self.filepath)
+
+    for current in range(level, self.levels):
+      size = self.level_size(current)
+      if (img.shape[1], img.shape[0]) != size:
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+      level_folder = os.path.join(self.folder, str(current))
+      if current > level and os.path.isdir(level_folder):
+        continue
+
+      # write into a temporary folder, only complete levels get the final name
+      temp_folder = level_folder + '.' + str(os.getpid()) + '.tmp'
+      os.makedirs(temp_folder, exist_ok=True)
+
+      cols, rows = self.level_tiles(current)
+      for row in range(rows):
+        for col in range(cols):
+          tile = img[row*TILE_SIZE : (row+1)*TILE_SIZE, col*TILE_SIZE : (col+1)*TILE_SIZE]
+          cv2.imwrite(os.path.join(temp_folder, str(col) + '_' + str(row) + '.jpg'), tile,
+                      [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+      try:
+        os.replace(temp_folder, level_folder)
+      except OSError:
+        rmtree(temp_folder, ignore_errors=True)
+
+    os.utime(self.folder)  # recently viewed
+
+
+def prune_tile_cache(keep = ()):
+  """ remove the pyramids of the least recently viewed images beyond TILE_CACHE_SIZE, except
+      the folders in keep """
+  if not os.path.isdir(TILE_CACHE_DIR):
+    return
+
+  entries = []
+  for name in os.listdir(TILE_CACHE_DIR):
+    folder = os.path.join(TILE_CACHE_DIR, name)
+    size = 0
+    for root, dirs, files in os.walk(folder):
+      size += sum([os.path.getsize(os.path.join(root, filename)) for filename in files])
+    entries.append((os.path.getmtime(folder), size, folder))
+
+  total = sum([entry[1] for entry in entries])
+  for mtime, size, folder in sorted(entries):
+    if total <= TILE_CACHE_SIZE:
+      break
+
+    if folder not in keep:
+      rmtree(folder, ignore_errors=True)
+      total -= size
+
+
+
+class TileView():
+  """ zoom and pan of an image on a canvas, drawn with only the visible tiles of its TilePyramid.
+      The image is placed by scale (canvas pixels per image pixel) and origin (canvas position of
+      its top-left corner), and fits the canvas until zoomed or panned. The tile PhotoImages are
+      kept in a least recently used cache of max_pixels """
+  max_scale = 4
+
+  def __init__(self, canvas, max_pixels = 32 * 2**20):
+    self.canvas = canvas
+    self.max_pixels = max_pixels
+    self.pyramid = None
+    self.scale = 1
+    self.origin = (0, 0)
+    self.fit = True
+    self.items = {}     # (level, col, row) ==> (canvas item, photo key)
+    self.photos = collections.OrderedDict()   # (filepath, level, col, row, width, height) ==> PhotoImage
+    self.pan_start = None
+    self.build_check = None   # after() handle polling the levels built in the background
+
+
+  def show(self, filepath):
+    """ switch to an image, fitting it in the canvas """
+    if self.pyramid != None and self.pyramid.filepath == filepath:
+      return
+
+    self.clear()
+    self.pyramid = TilePyramid(filepath)
 
 
+  def clear(self):
+    for item, photo_key in self.items.values():
+      self.canvas.delete(item)
+    self.canvas.delete('tile_error')
 
+    self.items = {}
+    self.pyramid = None
+    self.fit = True
 
 
+  def fit_scale(self):
+    return min(self.canvas.winfo_width() / self.pyramid.width,
+               self.canvas.winfo_height() / self.pyramid.height, 1)
+
+
+  def reset(self):
+    self.fit = True
+
+
+  def zoom(self, factor, x, y):
+    """ zoom by factor, keeping the image point under (x, y) in place """
+    if self.pyramid == None:
+      return
+
+    scale = min(self.max_scale, self.scale * factor)
+    if scale <= self.fit_scale():
+      self.fit = True
+      return
+
+    self.origin = (x - (x - self.origin[0]) * scale/self.scale, y - (y - self.origin[1]) * scale/self.scale)
+    self.scale = scale
+    self.fit = False
+
+
+  def start_pan(self, x, y):
+    self.pan_start = (x, y)
+
+
+  def pan_to(self, x, y):
+    if self.pyramid == None or self.pan_start == None:
+      return
+
+    self.origin = (self.origin[0] + x - self.pan_start[0], self.origin[1] + y - self.pan_start[1])
+    self.pan_start = (x, y)
+    self.fit = False
+
+
+  def redraw(self):
+    """ place the visible tiles of the level matching the scale, dropping the others """
+    cv = self.canvas
+    if self.pyramid == None:
+      return
+
+    width = cv.winfo_width()
+    height = cv.winfo_height()
+    pyramid = self.pyramid
+
+    if self.fit:
+      self.scale = self.fit_scale()
+      self.origin = ((width - pyramid.width * self.scale)/2, (height - pyramid.height * self.scale)/2)
+
+    # the coarsest level still at or above the display resolution. Until it's built in the
+    # background, the next coarser level that is built stands in for it
+    level = 0
+    if self.scale < 1:
+      level = min(pyramid.levels - 1, math.floor(math.log2(1/self.scale)))
+
+    if not pyramid.is_built(level):
+      pyramid.request(level)
+      if len(pyramid.building) > 0 and self.build_check == None:
+        self.build_check = cv.after(100, self.check_builds)
+
+      built = [coarser for coarser in range(level + 1, pyramid.levels) if pyramid.is_built(coarser)]
+      if len(built) == 0:
+        # nothing to show: say why if the image can't be read
+        cv.delete('tile_error')
+        if pyramid.error != None:
+          cv.create_text(width/2, height/2, text='Cannot show ' + os.path.basename(pyramid.filepath) + ':\n' +
+                         pyramid.error, justify=tk.CENTER, width=max(100, width - 40), tags=('tile_error'))
+        return
+
+      level = built[0]
+
+    step = TILE_SIZE * 2**level * self.scale   # canvas size of a tile
+    cols, rows = pyramid.level_tiles(level)
+    first_col, last_col = max(0, math.floor(-self.origin[0]/step)), min(cols, math.ceil((width - self.origin[0])/step))
+    first_row, last_row = max(0, math.floor(-self.origin[1]/step)), min(rows, math.ceil((height - self.origin[1])/step))
+
+    level_width, level_height = pyramid.level_size(level)
+    shown = {}
+
+    for row in range(first_row, last_row):
+      for col in range(first_col, last_col):
+        # round the edges rather than the sizes, so that tiles join without gaps
+        x0, y0 = round(self.origin[0] + col*step), round(self.origin[1] + row*step)
+        x1 = round(self.origin[0] + min(level_width,  (col+1)*TILE_SIZE) * 2**level * self.scale)
+        y1 = round(self.origin[1] + min(level_height, (row+1)*TILE_SIZE) * 2**level * self.scale)
+
+        photo_key = (pyramid.filepath, level, col, row, max(1, x1 - x0), max(1, y1 - y0))
+        try:
+          photo = self.photo(photo_key)
+        except OSError:
+          continue   # e.g. pruned meanwhile, rebuilt on the next redraw
+
+        key = (level, col, row)
+        if key in self.items:
+          item, previous_key = self.items.pop(key)
+          cv.coords(item, x0, y0)
+          if previous_key != photo_key:
+            cv.itemconfigure(item, image=photo)
+        else:
+          item = cv.create_image(x0, y0, anchor=tk.NW, image=photo, tags=('image'))
+
+        shown[key] = (item, photo_key)
+
+    for item, photo_key in self.items.values():
+      cv.delete(item)
+
+    self.items = shown
+    cv.tag_lower('image')
+
+    # forget the least recently used tiles that aren't shown
+    shown_keys = set([photo_key for item, photo_key in shown.values()])
+    pixels = sum([key[4] * key[5] for key in self.photos])
+    for key in list(self.photos):
+      if pixels <= self.max_pixels:
+        break
+
+      if key not in shown_keys:
+        del self.photos[key]
+        pixels -= key[4] * key[5]
+
+
+  def check_builds(self):
+    """ redraw once a level built in the background is ready (polled from the Tk thread) """
+    self.build_check = None
+    if self.pyramid == None:
+      return
+
+    if self.pyramid.collect():
+      self.redraw()
+    elif len(self.pyramid.building) > 0:
+      self.build_check = self.canvas.after(100, self.check_builds)
+
+
+  def photo(self, key):
+    """ PhotoImage of a tile at its displayed size """
+    if key in self.photos:
+      self.photos.move_to_end(key)
+      return self.photos[key]
+
+    filepath, level, col, row, width, height = key
+    img = self.pyramid.tile(level, col, row)
+    if img.size != (width, height):
+      # zoomed past 100%, show the pixels (a coarser level standing in is smoothed)
+      resample = Image.Resampling.NEAREST if level == 0 and width > img.width else Image.Resampling.BILINEAR
+      img = img.resize((width, height), resample)
+
+    self.photos[key] = ImageTk.PhotoImage(img)
+    return self.photos[key]
 
 
 
@@ -2495,12 +6044,86 @@ class ScrollableFrame(tk.Canvas):
 
 
 
+def run_batch(paths, max_jobs = None, watch_folder = None):
+  """ stack project files/image folders without the GUI, using the settings saved in
+      config.ini and printing the jobs' logs. With watch_folder, also stack the brackets
+      arriving there until interrupted. Return the exit code """
+  settings = settings_from_config(load_config())
+
+  engine = JobEngine()
+  engine.configure(settings, max_jobs)
+
+  unfinished = set()
+  skipped = 0
+  for path in paths:
+    try:
+      job = batch_job(path, settings, main_queue)
+    except (OSError, ValueError) as e:
+      print('Skipping ' + path + ': ' + str(e))
+      skipped += 1
+      continue
+
+    engine.submit(job)
+    unfinished.add(job.id)
+    print('[job ' + str(job.id) + '] ' + job.name + ' -> ' + job.output_name)
+
+  watcher = None
+  if watch_folder:
+    watcher = FolderWatcher(watch_folder, settings, engine, main_queue)
+    watcher.start()
+
+  try:
+    while len(unfinished) > 0 or watcher is not None:
+      try:
+        item = main_queue.get(timeout=0.5)
+      except queue.Empty:
+        continue
+
+      prefix = '[job ' + str(item.get('job')) + '] ' if item.get('job') else '[watch] '
+
+      if item['type'] in ('message', 'watch') and item['msg'].strip() != '':
+        print(prefix + item['msg'].strip())
+      elif item['type'] == 'state':
+        print(prefix + item['state'])
+      elif item['type'] == 'finished':
+        unfinished.discard(item['job'])
+
+  except KeyboardInterrupt:
+    print('Cancelling...')
+
+    if watcher is not None:
+      watcher.stop()
+      watcher.thread.join()
+
+    engine.cancel()
+    engine.executor.shutdown(wait=True)
+
+  engine.shutdown()
+
+  jobs = list(engine.jobs.values())
+  print('\n' + '\n'.join([job.describe() + ', ' + job.output_name for job in jobs]))
+
+  return 0 if skipped == 0 and all([job.state == 'done' for job in jobs]) else 1
+
+
+
+
 if __name__ == "__main__":
   main_queue = mp.Queue()
 
   mp.freeze_support()
-  app = App()
-  app.mainloop()
 
-  # global placeholder to work around multiprocessing
-  pool = None
\ No newline at end of file
+  parser = argparse.ArgumentParser(description='Focus stacking with enfuse')
+  parser.add_argument('--batch', nargs='+', metavar='PATH',
+                      help='stack .mft project files and image folders without the GUI')
+  parser.add_argument('--watch', metavar='FOLDER',
+                      help='stack the brackets of images arriving in FOLDER without the GUI, until interrupted')
+  parser.add_argument('--jobs', type=int,
+                      help='number of stacks to run concurrently (default: from config.ini)')
+  args = parser.parse_args()
+
+  if args.batch or args.watch:
+    sys.exit(run_batch(args.batch or [], args.jobs, args.watch))
+
+  app = App()
+  app.mainloop()
\ No newline at end of file